@@ -13,7 +13,9 @@ import cv2
 import numpy as np
 import torch
 
-import pyiqa
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.metric_registry import metric_registry, PYIQA_VERSION
+from utils.score_store import score_store
 from basicsr.utils import img2tensor
 
 def get_timestamp():
@@ -109,7 +111,15 @@ def main():
         help="Crop border for calculating PSNR/SSIM."
     )
 
+    parser.add_argument(
+        "--score_store",
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "memory", "scores.sqlite"),
+        help="SQLite score store the per-image metrics are read through, shared with the pipeline. An empty string disables it."
+    )
+
     args = parser.parse_args()
+    score_store.configure(args.score_store or None)
 
     # Set device
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
@@ -132,18 +142,23 @@ def main():
     # Initialize IQA metrics excluding FID
     logger.info("Initializing IQA metrics...")
     iqa_metrics = {
-        'PSNR': pyiqa.create_metric('psnr', test_y_channel=True, color_space='ycbcr').to(device),
-        'SSIM': pyiqa.create_metric('ssim', test_y_channel=True, color_space='ycbcr').to(device),
-        'LPIPS': pyiqa.create_metric('lpips', device=device),
-        'DISTS': pyiqa.create_metric('dists', device=device),
-        'CLIPIQA': pyiqa.create_metric('clipiqa', device=device),
-        'NIQE': pyiqa.create_metric('niqe', device=device),
-        'MUSIQ': pyiqa.create_metric('musiq', device=device),
-        'MANIQA': pyiqa.create_metric('maniqa', device=device)
+        'PSNR': metric_registry.get('psnr', test_y_channel=True, color_space='ycbcr'),
+        'SSIM': metric_registry.get('ssim', test_y_channel=True, color_space='ycbcr'),
+        'LPIPS': metric_registry.get('lpips'),
+        'DISTS': metric_registry.get('dists'),
+        'CLIPIQA': metric_registry.get('clipiqa'),
+        'NIQE': metric_registry.get('niqe'),
+        'MUSIQ': metric_registry.get('musiq'),
+        'MANIQA': metric_registry.get('maniqa')
     }
+    # names of the metrics in the score store, the PSNR and SSIM being those of the Y channel
+    metric_keys = {'PSNR': 'psnr_y', 'SSIM': 'ssim_y', 'LPIPS': 'lpips', 'DISTS': 'dists', 'CLIPIQA': 'clipiqa', 'NIQE': 'niqe', 'MUSIQ': 'musiq', 'MANIQA': 'maniqa'}
+    score_params = {'pyiqa': PYIQA_VERSION}
+    if args.crop_border > 0:
+        score_params['crop_border'] = args.crop_border
 
     # Initialize FID separately
-    fid_metric = pyiqa.create_metric('fid', device=device)
+    fid_metric = metric_registry.get('fid')
     logger.info("IQA metrics initialized.\n")
 
     # Validate input and GT directories
@@ -199,14 +214,15 @@ def main():
             sr_tensor = img2tensor(sr_img, bgr2rgb=True, float32=True).unsqueeze(0).to(device).contiguous() / 255.0
             gt_tensor = img2tensor(gt_img, bgr2rgb=True, float32=True).unsqueeze(0).to(device).contiguous() / 255.0
 
-            # Compute metrics
+            # Compute metrics, reading through the score store
+            fr_score_params = {**score_params, 'ref': score_store.digest(gt_path)} if score_store.enabled else score_params
             with torch.no_grad():
                 metrics = {}
                 for name, metric in iqa_metrics.items():
                     if name in ['CLIPIQA', 'NIQE', 'MUSIQ', 'MANIQA']:
-                        metrics[name] = metric(sr_tensor).item()
+                        metrics[name] = score_store.score(sr_path, metric_keys[name], lambda: metric(sr_tensor).item(), score_params)
                     else:
-                        metrics[name] = metric(sr_tensor, gt_tensor).item()
+                        metrics[name] = score_store.score(sr_path, metric_keys[name], lambda: metric(sr_tensor, gt_tensor).item(), fr_score_params)
 
             # Accumulate metrics
             for name in metrics_accum:
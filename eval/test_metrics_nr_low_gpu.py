@@ -13,7 +13,9 @@ import cv2
 import numpy as np
 import torch
 
-import pyiqa
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.metric_registry import metric_registry, PYIQA_VERSION
+from utils.score_store import score_store
 from basicsr.utils import img2tensor
 
 def get_timestamp():
@@ -85,7 +87,11 @@ def main():
                         help="Base name for the log files.")
     parser.add_argument("--crop_border", type=int, default=0,
                         help="Crop border for PSNR/SSIM cropping.")
+    parser.add_argument("--score_store", type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "memory", "scores.sqlite"),
+                        help="SQLite score store the metrics are read through, shared with the pipeline. An empty string disables it.")
     args = parser.parse_args()
+    score_store.configure(args.score_store or None)
 
     # Device selection: prefer GPU, otherwise CPU
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
@@ -108,6 +114,11 @@ def main():
     # Define list of IQA metrics to evaluate sequentially
     metric_names = ['CLIPIQA', 'NIQE', 'MUSIQ', 'MANIQA']
     metric_list = ['clipiqa', 'niqe', 'musiq', 'maniqa-pipal']
+    # only the metric in use stays on the GPU, the others wait on the CPU instead of being created per image
+    metric_registry.configure(max_gpu_mb=0, offload_to_cpu=True)
+    score_params = {'pyiqa': PYIQA_VERSION}
+    if args.crop_border > 0:
+        score_params['crop_border'] = args.crop_border
 
     # Collect all directories
     all_dirs = [os.path.normpath(d) for d in args.inp_imgs]
@@ -153,17 +164,16 @@ def main():
 
             sr_tensor = img2tensor(sr_img, bgr2rgb=True, float32=True).unsqueeze(0).to(device).contiguous() / 255.0
 
+            def evaluate(metric_name):
+                with metric_registry.use(metric_name) as metric:
+                    return metric(sr_tensor).item()
+
+            # scores in the score store are reused
             metrics = {}
             for name, metric_name in zip(metric_names, metric_list):
-                # Load one metric at a time
                 # logger.info(f"Loading metric: {metric_name}")
                 # print(f"Loading metric: {metric_name}")
-                metric = pyiqa.create_metric(metric_name, device=device)
-                # Evaluate and record average
-                metrics[name] = metric(sr_tensor).item()
-                # Release GPU memory
-                del metric
-                torch.cuda.empty_cache()
+                metrics[name] = score_store.score(sr_path, metric_name, lambda: evaluate(metric_name), score_params)
 
             # Accumulate metrics
             for name in metrics_accum:
@@ -3,6 +3,7 @@ from pathlib import Path
 import shutil
 import time
 import cv2
+from typing import Optional
 
 from utils.custom_types import Subtask, ToolName
 
@@ -18,6 +19,13 @@ from .face_restoration import face_restoration_toolbox
 from .old_photo_restoration import old_photo_restoration_toolbox
 
 from .tool import Tool
+from .multitask_tools import DiffPlugin, MAXIM
+from .worker import WorkerPool, DEFAULT_MAX_CACHE_MB
+from .tool_pool import ToolPool, ToolJob, ToolJobResult
+from .output_cache import ToolOutputCache
+from .dispatcher import ToolDispatcher, LocalToolCluster
+from .cost_model import ToolStatsStore
+from .jax_cache import JaxCompilationCache
 
 
 __all__ = ['executor']
@@ -31,6 +39,108 @@ class Executor:
     def register_subtask(self, subtask_name, subtask_toolbox) -> None:
         self.toolbox_router[subtask_name] = subtask_toolbox
 
+    def enable_warm_workers(self, max_cache_mb: int = DEFAULT_MAX_CACHE_MB) -> None:
+        """Runs tools in warm workers (one per environment and GPU) that keep imports and checkpoints resident, instead of a cold subprocess per invocation."""
+        if Tool.worker_pool is None:
+            Tool.worker_pool = WorkerPool(max_cache_mb=max_cache_mb)
+
+    def disable_warm_workers(self) -> None:
+        if Tool.worker_pool is not None:
+            Tool.worker_pool.shutdown()
+            Tool.worker_pool = None
+
+    def enable_output_cache(self, cache_dir: Path, max_size_gb: float = 50.) -> None:
+        """Looks up tool outputs in a content-addressed store at `cache_dir` before invoking tools, see `ToolOutputCache`."""
+        Tool.output_cache = ToolOutputCache(cache_dir, max_size_gb=max_size_gb)
+
+    def disable_output_cache(self) -> None:
+        Tool.output_cache = None
+
+    @property
+    def output_cache(self) -> Optional[ToolOutputCache]:
+        return Tool.output_cache
+
+    def enable_stats(self, stats_path: Path) -> None:
+        """Records the wall time, CPU time and peak memory of every tool invocation in `stats_path`, see `ToolStatsStore`."""
+        Tool.stats_store = ToolStatsStore(stats_path)
+
+    def disable_stats(self) -> None:
+        Tool.stats_store = None
+
+    @property
+    def stats_store(self) -> Optional[ToolStatsStore]:
+        return Tool.stats_store
+
+    def set_png_compression(self, level: Optional[int]) -> None:
+        """Compression level (0-9) of the PNGs written by the tools run in warm workers, None leaves it to the scripts. Most scripts save with PIL at level 6, several times slower than level 0 or 1 on 4K images."""
+        assert level is None or 0 <= level <= 9, f"Invalid PNG compression level: {level}."
+        Tool.png_compression = level
+
+    @property
+    def png_compression(self) -> Optional[int]:
+        return Tool.png_compression
+
+    def set_tile_memory_budget(self, memory_mb: Optional[int]) -> None:
+        """GPU memory budget of a forward pass of the tiled tools (SwinIR, Restormer, MPRNet, DRBNet, DRCT), from which they pick their tile size, at most their fixed one, and how many tiles to run per pass. None runs their fixed tiles one at a time."""
+        assert memory_mb is None or memory_mb > 0, f"Invalid tile memory budget: {memory_mb}."
+        Tool.tile_memory_mb = memory_mb
+
+    def set_diffplugin_options(self, num_inference_steps: int = 20, plugin_cache_size: int = 4) -> None:
+        """Denoising steps of Diff-Plugin for all its subtasks, and the number of its task plugins kept resident next to the shared Stable Diffusion base in warm workers (see `enable_warm_workers`)."""
+        assert num_inference_steps >= 1 and plugin_cache_size >= 1, "Diff-Plugin options should be positive."
+        DiffPlugin.num_inference_steps = num_inference_steps
+        DiffPlugin.plugin_cache_size = plugin_cache_size
+
+    def enable_jax_compilation_cache(self, cache_dir: Path, max_size_gb: float = 10.) -> None:
+        """Persists the model compiled by the JAX tool (MAXIM) in `cache_dir` for each input shape, so that later runs of all its subtasks, in any process, skip the compilation, see `JaxCompilationCache`."""
+        MAXIM.jax_cache = JaxCompilationCache(cache_dir, max_size_gb=max_size_gb)
+
+    def disable_jax_compilation_cache(self) -> None:
+        MAXIM.jax_cache = None
+
+    @property
+    def jax_compilation_cache(self) -> Optional[JaxCompilationCache]:
+        return MAXIM.jax_cache
+
+    def set_maxim_options(self, shape_buckets: bool = False) -> None:
+        """Whether MAXIM pads its inputs to a few bucket shapes (sides of 256, 384, 512, 768, ... pixels) rather than to multiples of 64, so that the model compiled for a shape serves images of nearby sizes. The padding changes the outputs and makes each side up to 1.5 times longer, hence the memory of the run, so it is off by default."""
+        MAXIM.shape_buckets = shape_buckets
+
+    def settings(self) -> dict:
+        """The settings set by the methods above, as JSON, for `apply_settings` in another process (e.g. a tool server run by a `ToolDispatcher`). The stats are left to each process. Paths are sent as they are, so that the caches are shared by the hosts of a shared file system."""
+        return {
+            "warm_worker_cache_mb": None if Tool.worker_pool is None else Tool.worker_pool.max_cache_mb,
+            "output_cache": None if Tool.output_cache is None else
+                {"cache_dir": str(Tool.output_cache.cache_dir.absolute()), "max_size_gb": Tool.output_cache.max_bytes / 1024 ** 3},
+            "png_compression": Tool.png_compression,
+            "tile_memory_mb": Tool.tile_memory_mb,
+            "diffplugin": {"num_inference_steps": DiffPlugin.num_inference_steps, "plugin_cache_size": DiffPlugin.plugin_cache_size},
+            "jax_compilation_cache": None if MAXIM.jax_cache is None else
+                {"cache_dir": str(MAXIM.jax_cache.cache_dir.absolute()), "max_size_gb": MAXIM.jax_cache.max_bytes / 1024 ** 3},
+            "maxim_shape_buckets": MAXIM.shape_buckets,
+        }
+
+    def apply_settings(self, settings: dict) -> None:
+        """Applies `settings`, as given by `settings()` in another process, keeping the warm workers and caches that already match."""
+        current = self.settings()
+        if settings.get("warm_worker_cache_mb") != current["warm_worker_cache_mb"]:
+            self.disable_warm_workers()
+            if settings.get("warm_worker_cache_mb") is not None:
+                self.enable_warm_workers(max_cache_mb=settings["warm_worker_cache_mb"])
+        if settings.get("output_cache") != current["output_cache"]:
+            self.disable_output_cache()
+            if settings.get("output_cache") is not None:
+                self.enable_output_cache(Path(settings["output_cache"]["cache_dir"]), settings["output_cache"]["max_size_gb"])
+        if settings.get("jax_compilation_cache") != current["jax_compilation_cache"]:
+            self.disable_jax_compilation_cache()
+            if settings.get("jax_compilation_cache") is not None:
+                self.enable_jax_compilation_cache(
+                    Path(settings["jax_compilation_cache"]["cache_dir"]), settings["jax_compilation_cache"]["max_size_gb"])
+        self.set_png_compression(settings.get("png_compression"))
+        self.set_tile_memory_budget(settings.get("tile_memory_mb"))
+        self.set_diffplugin_options(**(settings.get("diffplugin") or {}))
+        self.set_maxim_options(shape_buckets=settings.get("maxim_shape_buckets", False))
+
     @property
     def subtasks(self) -> set[str]:
         return set(self.toolbox_router.keys())
@@ -89,6 +199,7 @@ class Executor:
     def invoke_a_tool(self, 
                       subtask_name: str, tool_name: str, 
                       input_dir: Path, output_dir: Path):
+        """Invokes the tool `tool_name` of `subtask_name`; the output is taken from the output cache if enabled."""
         toolbox = self.toolbox_router[subtask_name]
         for tool in toolbox:
             if tool.tool_name == tool_name:
@@ -0,0 +1,122 @@
+"""Writes safetensors copies of the tool checkpoints, which the scripts memory-map instead of unpickling the `.pth` files (see `executor/tool_utils/checkpoint_loading.py`). Run from the project root, in an environment with torch and safetensors:
+```
+python -m executor.convert_checkpoints            # the checkpoints the tools point to
+python -m executor.convert_checkpoints --scan     # and every other .pth / .pt under pretrained_ckpts
+python -m executor.convert_checkpoints --verify   # checks the copies against the manifest
+```
+The SHA-256 of every converted checkpoint and of its copy are recorded in `pretrained_ckpts/safetensors_manifest.json`, with the tools using it. Up-to-date copies are kept; checkpoints holding values that safetensors cannot store (e.g. pickled modules) are skipped and keep loading from the `.pth`.
+"""
+
+import sys
+import json
+from pathlib import Path
+
+from . import executor
+from .output_cache import content_hash
+
+sys.path.append(str(Path(__file__).resolve().parent / "tool_utils"))
+from checkpoint_loading import NotConvertibleError, convert, fresh_copy, safetensors_path  # noqa: E402
+
+
+project_root = Path(__file__).resolve().parents[1]
+ckpt_root = project_root / "pretrained_ckpts"
+manifest_path = ckpt_root / "safetensors_manifest.json"
+# checkpoints loaded out of the toolboxes, by user
+EXTRA_CHECKPOINTS = {
+    "face_identity": [ckpt_root / "Face_eval" / "resnet18_110.pth"],
+}
+
+
+def referenced_checkpoints(scan: bool = False) -> dict[Path, list[str]]:
+    """The checkpoints the tools point to (see `Tool.checkpoint_paths`) and those of `EXTRA_CHECKPOINTS`, with the names of their users. `scan` adds every `.pth` / `.pt` file under `pretrained_ckpts`."""
+    users: dict[Path, list[str]] = {}
+    for toolbox in executor.toolbox_router.values():
+        for tool in toolbox:
+            for ckpt_path in tool.checkpoint_paths():
+                names = users.setdefault(ckpt_path.resolve(), [])
+                if tool.tool_name not in names:
+                    names.append(tool.tool_name)
+    for name, ckpt_paths in EXTRA_CHECKPOINTS.items():
+        for ckpt_path in ckpt_paths:
+            if ckpt_path.is_file():
+                users.setdefault(ckpt_path.resolve(), []).append(name)
+    if scan:
+        for ckpt_path in sorted([*ckpt_root.rglob("*.pth"), *ckpt_root.rglob("*.pt")]):
+            users.setdefault(ckpt_path.resolve(), [])
+    return users
+
+
+def load_manifest() -> dict[str, dict]:
+    if not manifest_path.is_file():
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict[str, dict]) -> None:
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    tmp_path.replace(manifest_path)
+
+
+def _manifest_key(path: Path) -> str:
+    try:
+        return str(path.relative_to(ckpt_root.resolve()))
+    except ValueError:
+        return str(path)
+
+
+def convert_checkpoints(ckpt_users: dict[Path, list[str]], force: bool = False) -> None:
+    """Converts the checkpoints of `ckpt_users` that have no up-to-date copy (all of them if `force`), and records them in the manifest."""
+    manifest = load_manifest()
+    for ckpt_path, names in ckpt_users.items():
+        key = _manifest_key(ckpt_path)
+        if not force and fresh_copy(ckpt_path) is not None and key in manifest:
+            print(f"up to date\t{key}")
+            continue
+        try:
+            copy_path = convert(ckpt_path)
+        except NotConvertibleError as e:
+            print(f"skipped\t{key}: {e}")
+            continue
+        manifest[key] = {
+            "safetensors": _manifest_key(copy_path),
+            "sha256": content_hash(ckpt_path),
+            "safetensors_sha256": content_hash(copy_path),
+            "users": names,
+        }
+        save_manifest(manifest)
+        print(f"converted\t{key} ({copy_path.stat().st_size / 1024 ** 2:.1f} MB)")
+
+
+def verify_checkpoints() -> bool:
+    """Checks the checkpoints of the manifest and their copies against their recorded hashes. Returns whether all match."""
+    ok = True
+    for key, entry in load_manifest().items():
+        ckpt_path = ckpt_root / key
+        copy_path = safetensors_path(ckpt_path)
+        if not ckpt_path.is_file() or not copy_path.is_file():
+            status = "missing"
+        elif content_hash(ckpt_path) != entry["sha256"]:
+            status = "checkpoint changed"
+        elif content_hash(copy_path) != entry["safetensors_sha256"]:
+            status = "copy corrupted"
+        else:
+            status = "ok"
+        ok &= status == "ok"
+        print(f"{status}\t{key}")
+    return ok
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Safetensors copies of the tool checkpoints")
+    parser.add_argument("--scan", action="store_true", help="Also convert every .pth / .pt under pretrained_ckpts")
+    parser.add_argument("--force", action="store_true", help="Convert again the checkpoints with an up-to-date copy")
+    parser.add_argument("--verify", action="store_true", help="Check the copies against the manifest instead of converting")
+    args = parser.parse_args()
+    if args.verify:
+        sys.exit(0 if verify_checkpoints() else 1)
+    convert_checkpoints(referenced_checkpoints(scan=args.scan), force=args.force)
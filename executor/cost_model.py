@@ -0,0 +1,120 @@
+"""Persistent per-tool cost statistics and the cost model fitted on them. Every invocation of a tool (see `Tool.__call__`) appends a line to a JSONL file:
+```
+{"tool": ..., "subtask": ..., "pixels": <input H*W>, "wall_s": ..., "cpu_s": ..., "peak_rss_mb": ...}
+```
+`cpu_s` and `peak_rss_mb` are those of the tool process (the subprocess, or the warm worker for the call), null when unknown. Costs are modelled per tool as linear in the number of input pixels, fitted on the most recent runs.
+"""
+
+import os
+import json
+import threading
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+
+_N_RECENT_RUNS = 200
+
+
+def run_measured(cmd: str, cwd: Optional[Path] = None) -> dict[str, float]:
+    """`subprocess.run(cmd, shell=True, check=True)` with the output discarded, returning the CPU time and peak RSS of the process tree."""
+    process = subprocess.Popen(cmd, cwd=cwd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return {
+        "cpu_s": rusage.ru_utime + rusage.ru_stime,
+        "peak_rss_mb": rusage.ru_maxrss / 1024,  # KiB on Linux
+    }
+
+
+class ToolStatsStore:
+    """
+    Args:
+        path (Path): JSONL file of the runs, created if missing and shared by the processes appending to it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._runs: dict[str, list[dict]] = {}
+        self._fits: dict[tuple[str, str], Optional[tuple[float, float]]] = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        run = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # partially written by a killed process
+                    self._runs.setdefault(run["tool"], []).append(run)
+
+    def record(
+        self,
+        tool_name: str,
+        subtask: str,
+        n_pixels: int,
+        wall_s: float,
+        cpu_s: Optional[float] = None,
+        peak_rss_mb: Optional[float] = None,
+    ) -> None:
+        run = {
+            "tool": tool_name,
+            "subtask": subtask,
+            "pixels": n_pixels,
+            "wall_s": round(wall_s, 3),
+            "cpu_s": None if cpu_s is None else round(cpu_s, 3),
+            "peak_rss_mb": None if peak_rss_mb is None else round(peak_rss_mb, 1),
+        }
+        with self._lock:
+            self._runs.setdefault(tool_name, []).append(run)
+            self._fits = {key: fit for key, fit in self._fits.items() if key[0] != tool_name}
+            with open(self.path, "a") as f:
+                f.write(json.dumps(run) + "\n")
+
+    def n_runs(self, tool_name: str) -> int:
+        return len(self._runs.get(tool_name, []))
+
+    def predict_seconds(self, tool_name: str, n_pixels: int) -> Optional[float]:
+        """Predicted wall time of `tool_name` on an input of `n_pixels` pixels, None if the tool has never run."""
+        return self._predict(tool_name, "wall_s", n_pixels)
+
+    def predict_peak_rss_mb(self, tool_name: str, n_pixels: int) -> Optional[float]:
+        return self._predict(tool_name, "peak_rss_mb", n_pixels)
+
+    def _predict(self, tool_name: str, key: str, n_pixels: int) -> Optional[float]:
+        with self._lock:
+            if (tool_name, key) not in self._fits:
+                self._fits[(tool_name, key)] = self._fit(tool_name, key)
+            fit = self._fits[(tool_name, key)]
+        if fit is None:
+            return None
+        intercept, slope = fit
+        return intercept + slope * n_pixels
+
+    def _fit(self, tool_name: str, key: str) -> Optional[tuple[float, float]]:
+        """Least-squares `intercept + slope * pixels` with non-negative coefficients. Runs of a single input size give a line through the origin."""
+        points = [
+            (run["pixels"], run[key]) for run in self._runs.get(tool_name, [])[-_N_RECENT_RUNS:]
+            if run.get(key) is not None and run["pixels"] > 0
+        ]
+        if not points:
+            return None
+        n = len(points)
+        mean_x = sum(x for x, _ in points) / n
+        mean_y = sum(y for _, y in points) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in points)
+        if var_x == 0:
+            return 0., mean_y / mean_x
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+        slope = max(slope, 0.)
+        intercept = mean_y - slope * mean_x
+        if intercept < 0:
+            intercept, slope = 0., sum(x * y for x, y in points) / sum(x * x for x, _ in points)
+        return intercept, slope
@@ -98,7 +98,8 @@ class DRBNet(Tool):
             "--net_mode", "single",
             "--tile", "1024",
             "--tile_overlap", "64",
-            "--save_images"
+            "--save_images",
+            *self._tile_opts(),
         ]
     
     def _postprocess(self):
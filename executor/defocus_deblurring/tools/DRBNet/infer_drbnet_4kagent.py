@@ -9,15 +9,19 @@ Copyright (c) 2022-present, Lingyan Ruan
 '''
 
 import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))
+from tiled_inference import TiledInference
+
 from options.test_options import TestOptions
 from datetime import datetime
 import torch
 import torchvision.utils as vutils
 from ptflops import get_model_complexity_info
 from util.util import *
-from pathlib import Path
 import time
-import sys
 import lpips
 from glob import glob
 from natsort import natsorted
@@ -100,27 +104,12 @@ for i, filename in enumerate(input_c_file_path_list):
                 # crop back to original size
                 output = output[..., 0:ori_h, 0:ori_w]
             else:
-                # test the image tile by tile
-                b, c, h, w = C.shape
-                tile = min(opt.tile, h, w)
-                assert tile % 8 == 0, "tile size should be multiple of 8"
-                tile_overlap = opt.tile_overlap
-
-                stride = tile - tile_overlap
-                h_idx_list = list(range(0, h-tile, stride)) + [h-tile]
-                w_idx_list = list(range(0, w-tile, stride)) + [w-tile]
-                E = torch.zeros(b, c, h, w).type_as(C)
-                W = torch.zeros_like(E)
-
-                for h_idx in h_idx_list:
-                    for w_idx in w_idx_list:
-                        in_patch = C[..., h_idx:h_idx+tile, w_idx:w_idx+tile]
-                        out_patch = network(in_patch)
-                        out_patch_mask = torch.ones_like(out_patch)
-
-                        E[..., h_idx:(h_idx+tile), w_idx:(w_idx+tile)].add_(out_patch)
-                        W[..., h_idx:(h_idx+tile), w_idx:(w_idx+tile)].add_(out_patch_mask)
-                output = E.div_(W)
+                # test the image tile by tile, several tiles per forward pass
+                tiler = TiledInference(
+                    network, tile=opt.tile, overlap=opt.tile_overlap, multiple=8,
+                    batch_size=opt.tile_batch, memory_budget_mb=opt.tile_memory_mb,
+                )
+                output = tiler(C, out_device=C.device)
                 # crop back to original size
                 output = output[..., 0:ori_h, 0:ori_w]
             time_per = time.time() - start_time
@@ -1,4 +1,5 @@
 from .base_options import BaseOptions
+from tiled_inference import tile_arg  # on the path set by `infer_drbnet_4kagent.py`
 
 
 class TestOptions(BaseOptions):
@@ -10,6 +11,8 @@ class TestOptions(BaseOptions):
         self.parser.add_argument('--save_images', action='store_true', help='save images')
         self.parser.add_argument('--net_mode', type=str, default='single', help='single | dual')
         self.parser.add_argument('--ckpt_path', type=str, default='./ckpts/', help='single | dual')
-        self.parser.add_argument('--tile', type=int, default=None, help='Tile size (e.g 720). None means testing on the original resolution image')
+        self.parser.add_argument('--tile', type=tile_arg, default=None, help='Tile size (e.g 720), "auto" to pick it from the GPU memory. None means testing on the original resolution image')
         self.parser.add_argument('--tile_overlap', type=int, default=32, help='Overlapping of different tiles')
+        self.parser.add_argument('--tile_batch', type=int, default=None, help='Number of tiles per forward pass, None for 1 with a fixed --tile, or as many as fit in --tile_memory_mb')
+        self.parser.add_argument('--tile_memory_mb', type=int, default=None, help='GPU memory budget of a forward pass, from which the tile size, at most --tile, and the tiles per pass are picked')
         self.isTrain = False
\ No newline at end of file
@@ -1,6 +1,8 @@
 import os
+import sys
 import argparse
 import torch
+from pathlib import Path
 
 from transformers import CLIPVisionModel, AutoTokenizer, CLIPImageProcessor
 from diffusers import AutoencoderKL, UNet2DConditionModel, UniPCMultistepScheduler
@@ -9,7 +11,9 @@ from diffusers.image_processor import VaeImageProcessor
 
 from modules import SCBNet
 from modules import TPBNet
-from utils import concat_imgs, import_model_class_from_model_name_or_path
+
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))
+from resident_models import resident_pool
 
 
 def parse_args(input_args=None):
@@ -29,6 +33,9 @@ def parse_args(input_args=None):
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--img_path", type=str)
     parser.add_argument("--img_path_dir", type=str)
+    # serving mode, in a warm worker: the Stable Diffusion base is kept resident across runs, shared by the plugins of all tasks, and the plugins in an LRU
+    parser.add_argument("--serve", action="store_true", default=False)
+    parser.add_argument("--plugin_cache_size", type=int, default=4, help="Number of task plugins kept resident in serving mode")
 
     if input_args is not None:
         args = parser.parse_args(input_args)
@@ -38,16 +45,40 @@ def parse_args(input_args=None):
     return args
 
 
+def load_base(args, device):
+    """Stable Diffusion UNet, VAE and scheduler, and the CLIP vision model, shared by the plugins of all tasks."""
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", revision=None).to(device)
+    unet = UNet2DConditionModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet", revision=None).to(device)
+    clip_v = CLIPVisionModel.from_pretrained(args.clip_path).to(device)
+    noise_scheduler = UniPCMultistepScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+    return vae, unet, clip_v, noise_scheduler
+
+
+def load_plugin(ckpt_dir, device):
+    """SCB and TPB nets of the task plugin in `ckpt_dir`."""
+    SCBNet_path = os.path.join(ckpt_dir, "scb")
+    TPBNet_path = os.path.join(ckpt_dir, "tpb.pt")
+    print('--------loading SCB from: ', SCBNet_path, '   , TPB from:  ', TPBNet_path, '----------------------')
+    scb_net = SCBNet.from_pretrained(SCBNet_path).to(device)
+    tpb_net = TPBNet().to(device)
+    try:
+        tpb_net.load_state_dict(torch.load(TPBNet_path)['model'], strict=True)
+    except:
+        tpb_net = torch.nn.DataParallel(tpb_net)
+        tpb_net.load_state_dict(torch.load(TPBNet_path)['model'], strict=True)
+
+    scb_net.eval()
+    tpb_net.eval()
+    return scb_net, tpb_net
+
+
 if __name__ == "__main__":
 
     args = parse_args()
 
     # step-1: settings
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    SCBNet_path = os.path.join(args.ckpt_dir, "scb") 
-    TPBNet_path = os.path.join(args.ckpt_dir, "tpb.pt")
-    print('--------loading SCB from: ', SCBNet_path, '   , TPB from:  ', TPBNet_path, '----------------------')
-    
+
     os.makedirs(args.ckpt_dir, exist_ok=True)
     os.makedirs(args.save_root, exist_ok=True)
     
@@ -56,28 +87,23 @@ if __name__ == "__main__":
     
     
     # Step-2: instantiate models and schedulers
-    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", revision=None).to(device)
-    unet = UNet2DConditionModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet", revision=None).to(device)
-    text_encoder_cls = import_model_class_from_model_name_or_path(args.pretrained_model_name_or_path, None)
-    text_encoder = text_encoder_cls.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder", revision=None).to(device)
-    tokenizer = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer", revision=None, use_fast=False,)
-    clip_v = CLIPVisionModel.from_pretrained(args.clip_path).to(device)
-    noise_scheduler = UniPCMultistepScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+    # the text encoder of SD is not loaded, the cross-attention being fed with the TPB prompt embeddings of the CLIP vision features
+    if args.serve:
+        base_key = (args.pretrained_model_name_or_path, args.clip_path, str(device))
+        vae, unet, clip_v, base_scheduler = resident_pool("diffplugin_base").get(base_key, lambda: load_base(args, device))
+        plugin_key = (os.path.realpath(args.ckpt_dir), str(device))
+        plugins = resident_pool("diffplugin_plugins", capacity=args.plugin_cache_size)
+        scb_net, tpb_net = plugins.get(plugin_key, lambda: load_plugin(args.ckpt_dir, device))
+        print(f'--------serving {subtask_name}: {len(plugins)} plugins resident, {plugins.n_hits} hits, {plugins.n_misses} misses----------------------')
+        # the scheduler keeps the state of a sampling run
+        noise_scheduler = UniPCMultistepScheduler.from_config(base_scheduler.config)
+    else:
+        vae, unet, clip_v, noise_scheduler = load_base(args, device)
+        scb_net, tpb_net = load_plugin(args.ckpt_dir, device)
 
     clip_image_processor = CLIPImageProcessor()
     vae_scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
     vae_image_processor = VaeImageProcessor(vae_scale_factor=vae_scale_factor, do_convert_rgb=True, do_normalize=True)
-    
-    scb_net = SCBNet.from_pretrained(SCBNet_path).to(device)
-    tpb_net = TPBNet().to(device) 
-    try:
-        tpb_net.load_state_dict(torch.load(TPBNet_path)['model'], strict=True)
-    except:
-        tpb_net = torch.nn.DataParallel(tpb_net)
-        tpb_net.load_state_dict(torch.load(TPBNet_path)['model'], strict=True)
- 
-    scb_net.eval()
-    tpb_net.eval()
 
 
     # Step-3: prepare data
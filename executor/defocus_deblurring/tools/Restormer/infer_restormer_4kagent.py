@@ -27,6 +27,10 @@ from skimage.metrics import structural_similarity
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))
+from tiled_inference import TiledInference, tile_arg
+from checkpoint_loading import load_checkpoint
+
 
 parser = argparse.ArgumentParser(description='Test Restormer on your own images')
 parser.add_argument('--input_dir', default='./demo/degraded/', type=str, help='Input image directory or file')
@@ -39,8 +43,10 @@ parser.add_argument('--task', required=True, type=str, choices=[
     'Gaussian_Gray_Denoising',
     'Gaussian_Color_Denoising'
 ])
-parser.add_argument('--tile', type=int, default=None, help='Tile size for large images (e.g. 720)')
+parser.add_argument('--tile', type=tile_arg, default=None, help='Tile size for large images (e.g. 720), "auto" to pick it from the GPU memory')
 parser.add_argument('--tile_overlap', type=int, default=32, help='Overlap between tiles')
+parser.add_argument('--tile_batch', type=int, default=None, help='Number of tiles per forward pass, None for 1 with a fixed --tile, or as many as fit in --tile_memory_mb')
+parser.add_argument('--tile_memory_mb', type=int, default=None, help='GPU memory budget of a forward pass, from which the tile size, at most --tile, and the tiles per pass are picked')
 parser.add_argument('--ckpt', type=str, default="")
 args = parser.parse_args()
 
@@ -122,7 +128,7 @@ model = load_arch['Restormer'](**parameters)
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 model.to(device)
 
-checkpoint = torch.load(weights)
+checkpoint = load_checkpoint(weights)
 model.load_state_dict(checkpoint['params'])
 model.eval()
 
@@ -151,26 +157,11 @@ with torch.no_grad():
         if args.tile is None:
             restored = model(input_)
         else:
-            b, c, h, w = input_.shape
-            tile = min(args.tile, h, w)
-            assert tile % 8 == 0, "Tile size must be a multiple of 8"
-            stride = tile - args.tile_overlap
-
-            h_idx_list = list(range(0, h - tile, stride)) + [h - tile]
-            w_idx_list = list(range(0, w - tile, stride)) + [w - tile]
-
-            E = torch.zeros(b, c, h, w).type_as(input_)
-            W_map = torch.zeros_like(E)
-
-            for h_idx in h_idx_list:
-                for w_idx in w_idx_list:
-                    patch = input_[..., h_idx:h_idx + tile, w_idx:w_idx + tile]
-                    out_patch = model(patch)
-                    out_mask = torch.ones_like(out_patch)
-                    E[..., h_idx:h_idx + tile, w_idx:w_idx + tile].add_(out_patch)
-                    W_map[..., h_idx:h_idx + tile, w_idx:w_idx + tile].add_(out_mask)
-
-            restored = E.div_(W_map)
+            tiler = TiledInference(
+                model, tile=args.tile, overlap=args.tile_overlap, multiple=img_multiple_of,
+                batch_size=args.tile_batch, memory_budget_mb=args.tile_memory_mb,
+            )
+            restored = tiler(input_)
 
         # Crop & Convert
         restored = restored[:, :, :height, :width]
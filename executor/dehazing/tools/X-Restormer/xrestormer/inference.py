@@ -27,12 +27,17 @@ from basicsr.utils.dist_util import get_dist_info, init_dist, master_only
 
 import sys
 import os
+from pathlib import Path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import xrestormer.archs
 import xrestormer.data
 import xrestormer.models
 
+sys.path.append(str(Path(__file__).absolute().parents[4] / "tool_utils"))
+from checkpoint_loading import install as install_safetensors_loading
+install_safetensors_loading()
+
 
 
 def custom_parse_options(root_path, is_train=True):
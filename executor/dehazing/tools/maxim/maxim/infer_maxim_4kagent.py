@@ -17,17 +17,25 @@
 import collections
 import importlib
 import io
+import json
 import os
+import sys
+from pathlib import Path
 
 from absl import app
 from absl import flags
 import flax
+import jax
 import jax.numpy as jnp
 import ml_collections
 import numpy as np
 from PIL import Image
 import tensorflow as tf
 
+sys.path.append(str(Path(__file__).absolute().parents[4] / 'tool_utils'))
+from jax_compile_cache import (bucket_side, cache_entries, compile_counts,
+                               enable_compilation_cache)
+
 FLAGS = flags.FLAGS
 
 flags.DEFINE_enum(
@@ -41,6 +49,14 @@ flags.DEFINE_boolean('has_target', True, 'Whether has corresponding gt image.')
 flags.DEFINE_boolean('save_images', True, 'Dump predicted images.')
 flags.DEFINE_boolean('geometric_ensemble', False,
                      'Whether use ensemble infernce.')
+flags.DEFINE_string('jax_cache_dir', '',
+                    'Persistent compilation cache directory, empty disables it.')
+flags.DEFINE_boolean('shape_buckets', False,
+                     'Pad inputs to bucket shapes so that they share compiled '
+                     'executables.')
+flags.DEFINE_string('compile_stats_path', '',
+                    'JSON file to write the compilation cache hits and misses '
+                    'of the run to.')
 
 _MODEL_FILENAME = 'maxim'
 
@@ -308,6 +324,18 @@ def save_img(img, pth):
       (np.clip(img, 0., 1.) * 255.).astype(jnp.uint8))).save(pth, 'PNG')
 
 
+def bucket_padding_symmetric(image, min_side=256):
+  """Padding the image to the bucket shape of its size."""
+  height, width = image.shape[0], image.shape[1]
+  padh = bucket_side(height, min_side) - height
+  padw = bucket_side(width, min_side) - width
+  image = np.pad(
+      image, [(padh // 2, padh - padh // 2), (padw // 2, padw - padw // 2),
+              (0, 0)],
+      mode='reflect')
+  return image
+
+
 def make_shape_even(image):
   """Pad the image to have even shapes."""
   height, width = image.shape[0], image.shape[1]
@@ -342,6 +370,16 @@ def main(_):
   model_configs = ml_collections.ConfigDict(_MODEL_CONFIGS)
   model_configs.variant = _MODEL_VARIANT_DICT[FLAGS.task]
   model = model_mod.Model(**model_configs)
+  # compiled once per input shape, then read back from the persistent cache
+  apply_fn = jax.jit(model.apply)
+  frozen_params = flax.core.freeze(params)
+
+  counted = False
+  if FLAGS.jax_cache_dir:
+    counted = enable_compilation_cache(FLAGS.jax_cache_dir)
+    counts_before = compile_counts()
+    entries_before = cache_entries(FLAGS.jax_cache_dir)
+  shapes = set()
 
   psnr_all = []
 
@@ -360,16 +398,21 @@ def main(_):
     input_img = make_shape_even(input_img)
     height_even, width_even = input_img.shape[0], input_img.shape[1]
 
-    # padding images to be multiplies of 64
-    input_img = mod_padding_symmetric(input_img, factor=64)
+    if FLAGS.shape_buckets:
+      # padding images to bucket shapes, multiples of 64
+      input_img = bucket_padding_symmetric(input_img)
+    else:
+      # padding images to be multiplies of 64
+      input_img = mod_padding_symmetric(input_img, factor=64)
 
     if FLAGS.geometric_ensemble:
       input_img = augment_image(input_img, FLAGS.ensemble_times)
     else:
       input_img = np.expand_dims(input_img, axis=0)
+    shapes.add(tuple(input_img.shape))
 
     # handle multi-stage outputs, obtain the last scale output of last stage
-    preds = model.apply({'params': flax.core.freeze(params)}, input_img)
+    preds = apply_fn({'params': frozen_params}, input_img)
     if isinstance(preds, list):
       preds = preds[-1]
       if isinstance(preds, list):
@@ -409,6 +452,19 @@ def main(_):
     psnr = _process_file(i)
     psnr_all.append(psnr)
 
+  if FLAGS.compile_stats_path:
+    if not FLAGS.jax_cache_dir:
+      hits, misses = 0, len(shapes)
+    elif counted:
+      hits, misses = (compile_counts() - counts_before).tolist()
+    else:
+      # each new executable is a miss
+      misses = cache_entries(FLAGS.jax_cache_dir) - entries_before
+      hits = max(len(shapes) - misses, 0)
+    with open(FLAGS.compile_stats_path, 'w') as f:
+      json.dump({'hits': hits, 'misses': misses,
+                 'shapes': sorted(list(shape) for shape in shapes)}, f)
+
   psnr_all = np.asarray(psnr_all)
 
   print(f'average psnr = {np.sum(psnr_all)/num_images:.4f}')
@@ -4,6 +4,8 @@ import torch.nn.functional as F
 import torchvision.transforms.functional as TF
 from PIL import Image
 import os
+import sys
+from pathlib import Path
 from runpy import run_path
 from skimage import img_as_ubyte
 from collections import OrderedDict
@@ -12,22 +14,28 @@ from glob import glob
 import cv2
 import argparse
 
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))
+from tiled_inference import TiledInference, tile_arg
+from checkpoint_loading import load_checkpoint
+
 parser = argparse.ArgumentParser(description='Demo MPRNet')
 parser.add_argument('--input_dir', default='./samples/input/', type=str, help='Input images')
 parser.add_argument('--result_dir', default='./samples/output/', type=str, help='Directory for results')
 parser.add_argument('--task', required=True, type=str, help='Task to run', choices=['Deblurring', 'Denoising', 'Deraining'])
 parser.add_argument('--model_arch_file', type=str, default="./Deblurring/MPRNet.py")
 parser.add_argument('--ckpt', type=str, default="./Deblurring/pretrained_models/model_deblurring.pth")
-parser.add_argument('--tile', type=int, default=None, help='Tile size (e.g 720). None means testing on the original resolution image')
+parser.add_argument('--tile', type=tile_arg, default=None, help='Tile size (e.g 720), "auto" to pick it from the GPU memory. None means testing on the original resolution image')
 parser.add_argument('--tile_overlap', type=int, default=32, help='Overlapping of different tiles')
+parser.add_argument('--tile_batch', type=int, default=None, help='Number of tiles per forward pass, None for 1 with a fixed --tile, or as many as fit in --tile_memory_mb')
+parser.add_argument('--tile_memory_mb', type=int, default=None, help='GPU memory budget of a forward pass, from which the tile size, at most --tile, and the tiles per pass are picked')
 
 args = parser.parse_args()
 
 def save_img(filepath, img):
     cv2.imwrite(filepath,cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
 
-def load_checkpoint(model, weights):
-    checkpoint = torch.load(weights)
+def load_weights(model, weights):
+    checkpoint = load_checkpoint(weights)
     try:
         model.load_state_dict(checkpoint["state_dict"])
     except:
@@ -58,7 +66,7 @@ model = load_file['MPRNet']()
 model.cuda()
 
 weights = args.ckpt
-load_checkpoint(model, weights)
+load_weights(model, weights)
 model.eval()
 
 img_multiple_of = 8
@@ -81,27 +89,12 @@ for file_ in files:
             restored = model(input_)
             restored = restored[0]
         else:
-            # test the image tile by tile
-            b, c, h, w = input_.shape
-            tile = min(args.tile, h, w)
-            assert tile % 8 == 0, "tile size should be multiple of 8"
-            tile_overlap = args.tile_overlap
-
-            stride = tile - tile_overlap
-            h_idx_list = list(range(0, h-tile, stride)) + [h-tile]
-            w_idx_list = list(range(0, w-tile, stride)) + [w-tile]
-            E = torch.zeros(b, c, h, w).type_as(input_)
-            W = torch.zeros_like(E)
-
-            for h_idx in h_idx_list:
-                for w_idx in w_idx_list:
-                    in_patch = input_[..., h_idx:h_idx+tile, w_idx:w_idx+tile]
-                    out_patch = model(in_patch)[0]
-                    out_patch_mask = torch.ones_like(out_patch)
-
-                    E[..., h_idx:(h_idx+tile), w_idx:(w_idx+tile)].add_(out_patch)
-                    W[..., h_idx:(h_idx+tile), w_idx:(w_idx+tile)].add_(out_patch_mask)
-            restored = E.div_(W)
+            # test the image tile by tile, several tiles per forward pass; the last stage output is the restored image
+            tiler = TiledInference(
+                lambda patch: model(patch)[0], tile=args.tile, overlap=args.tile_overlap, multiple=img_multiple_of,
+                batch_size=args.tile_batch, memory_budget_mb=args.tile_memory_mb,
+            )
+            restored = tiler(input_)
     
     # restored = restored[0]
     restored = torch.clamp(restored, 0, 1)
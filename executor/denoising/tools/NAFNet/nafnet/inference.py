@@ -4,9 +4,11 @@
 # Modified from BasicSR (https://github.com/xinntao/BasicSR)
 # Copyright 2018-2020 BasicSR Authors
 # ------------------------------------------------------------------------
+import sys
 import torch
 import argparse
 from os import path as osp
+from pathlib import Path
 import yaml
 import random
 import logging
@@ -19,6 +21,10 @@ from basicsr.utils.options import dict2str, ordered_yaml
 from basicsr.utils import set_random_seed
 from basicsr.utils.dist_util import get_dist_info, init_dist, master_only
 
+sys.path.append(str(Path(__file__).absolute().parents[4] / "tool_utils"))
+from checkpoint_loading import install as install_safetensors_loading
+install_safetensors_loading()
+
 
 def custom_parse_options(root_path, is_train=True):
     parser = argparse.ArgumentParser()
@@ -6,12 +6,18 @@ import glob
 import numpy as np
 from collections import OrderedDict
 import os
+import sys
 import torch
 import requests
+from pathlib import Path
 
 from models.network_swinir import SwinIR as net
 from utils import util_calculate_psnr_ssim as util
 
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))
+from tiled_inference import TiledInference, tile_arg
+from checkpoint_loading import load_checkpoint
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -30,8 +36,10 @@ def main():
     parser.add_argument('--folder_gt', type=str, default=None, help='input ground-truth test image folder')
     # new: save_dir
     parser.add_argument('--save_dir', type=str, default=None, help='folder to save the output results')
-    parser.add_argument('--tile', type=int, default=None, help='Tile size, None for no tile during testing (testing as a whole)')
+    parser.add_argument('--tile', type=tile_arg, default=None, help='Tile size, "auto" to pick it from the GPU memory, None for no tile during testing (testing as a whole)')
     parser.add_argument('--tile_overlap', type=int, default=32, help='Overlapping of different tiles')
+    parser.add_argument('--tile_batch', type=int, default=None, help='Number of tiles per forward pass, None for 1 with a fixed --tile, or as many as fit in --tile_memory_mb')
+    parser.add_argument('--tile_memory_mb', type=int, default=None, help='GPU memory budget of a forward pass, from which the tile size, at most --tile, and the tiles per pass are picked')
     args = parser.parse_args()
 
     # new: check task
@@ -143,7 +151,7 @@ def define_model(args):
                     mlp_ratio=2, upsampler='', resi_connection='1conv')
         param_key_g = 'params'
 
-    pretrained_model = torch.load(args.model_path)
+    pretrained_model = load_checkpoint(args.model_path)
     model.load_state_dict(pretrained_model[param_key_g] if param_key_g in pretrained_model.keys() else pretrained_model, strict=True)
 
     return model
@@ -200,28 +208,12 @@ def test(img_lq, model, args, window_size):
         # test the image as a whole
         output = model(img_lq)
     else:
-        # test the image tile by tile
-        b, c, h, w = img_lq.size()
-        tile = min(args.tile, h, w)
-        assert tile % window_size == 0, "tile size should be a multiple of window_size"
-        tile_overlap = args.tile_overlap
-        sf = args.scale
-
-        stride = tile - tile_overlap
-        h_idx_list = list(range(0, h-tile, stride)) + [h-tile]
-        w_idx_list = list(range(0, w-tile, stride)) + [w-tile]
-        E = torch.zeros(b, c, h*sf, w*sf).type_as(img_lq)
-        W = torch.zeros_like(E)
-
-        for h_idx in h_idx_list:
-            for w_idx in w_idx_list:
-                in_patch = img_lq[..., h_idx:h_idx+tile, w_idx:w_idx+tile]
-                out_patch = model(in_patch)
-                out_patch_mask = torch.ones_like(out_patch)
-
-                E[..., h_idx*sf:(h_idx+tile)*sf, w_idx*sf:(w_idx+tile)*sf].add_(out_patch)
-                W[..., h_idx*sf:(h_idx+tile)*sf, w_idx*sf:(w_idx+tile)*sf].add_(out_patch_mask)
-        output = E.div_(W)
+        # test the image tile by tile, several tiles per forward pass
+        tiler = TiledInference(
+            model, scale=args.scale, tile=args.tile, overlap=args.tile_overlap, multiple=window_size,
+            batch_size=args.tile_batch, memory_budget_mb=args.tile_memory_mb,
+        )
+        output = tiler(img_lq)
 
     return output
 
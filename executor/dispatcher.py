@@ -0,0 +1,263 @@
+"""Runs tools on remote or local tool executors, i.e. `executor/tool_server.py` instances, so that one agent can use all the tool hosts of a cluster. `ToolDispatcher.run` has the interface of `ToolPool.run`.
+
+Each executor runs one tool at a time. Jobs go to idle executors in order. When the queue is empty and an executor is idle, a job running more than `straggler_factor` times the median duration of the finished jobs is started again on that executor, and the first output wins. The other run is not waited for: its executor stays busy, and gets no job from later calls of `run`, until it ends. An executor that cannot be reached or does not answer within `timeout` is dropped, and its job goes back to the queue, up to `max_attempts` tries. A tool that fails on an executor fails the job, like in `ToolPool`.
+
+Every job carries `settings`, the executor-wide settings of the agent (see `Executor.settings`), which the executor applies before running the tool, so that the tools run as they would on the agent's host.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import threading
+import statistics
+import subprocess
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+from .tool_pool import ToolJob, ToolJobResult
+
+
+class ToolExecutorLost(Exception):
+    pass
+
+
+class ToolDispatcher:
+    """
+    Args:
+        endpoints (list[str]): Base URLs of the tool executors, e.g. `["http://gpu-node-1:8600"]`.
+        timeout (float, optional): Seconds to wait for a tool before dropping its executor. Defaults to 1800.
+        straggler_factor (float, optional): See above, 0 disables duplicate runs. Defaults to 2.
+        max_attempts (int, optional): Maximum number of executors a job is sent to after losing executors. Defaults to 3.
+        settings (dict | None, optional): Executor-wide settings sent with every job, see `Executor.settings`. Defaults to None, i.e. those of the executors.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[str],
+        timeout: float = 1800.,
+        straggler_factor: float = 2.,
+        max_attempts: int = 3,
+        settings: Optional[dict] = None,
+    ):
+        assert endpoints, "At least one endpoint should be given."
+        self.endpoints = [endpoint.rstrip("/") for endpoint in endpoints]
+        self.timeout = timeout
+        self.straggler_factor = straggler_factor
+        self.max_attempts = max_attempts
+        self.settings = settings
+        self.lost: set[str] = set()
+        # runs left behind by `run` (duplicates of finished jobs) -> their executor, busy until they end
+        self._draining: dict[Future, str] = {}
+        self._draining_lock = threading.Lock()
+
+    def health(self, endpoint: str) -> bool:
+        try:
+            with urllib.request.urlopen(f"{endpoint}/health", timeout=10) as rsp:
+                return json.load(rsp)["ok"]
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def run(self, jobs: list[ToolJob]) -> list[ToolJobResult]:
+        """Runs all jobs and returns their results in the order of `jobs`. Outputs are written to `job.output_dir / "output.png"`."""
+        # executors lost in a previous run get another chance
+        for endpoint in list(self.lost):
+            if self.health(endpoint):
+                self.lost.discard(endpoint)
+
+        results: dict[int, ToolJobResult] = {}
+        pending = list(range(len(jobs)))
+        attempts = {idx: 0 for idx in pending}
+        running: dict[Future, tuple[int, str, float]] = {}
+        durations: list[float] = []
+        with self._draining_lock:
+            draining_endpoints = set(self._draining.values())
+        idle = [endpoint for endpoint in self.endpoints if endpoint not in self.lost and endpoint not in draining_endpoints]
+
+        pool = ThreadPoolExecutor(max_workers=len(self.endpoints))
+
+        def submit(idx: int, endpoint: str) -> None:
+            attempts[idx] += 1
+            running[pool.submit(self._request, jobs[idx], endpoint)] = (idx, endpoint, time.time())
+
+        try:
+            while len(results) < len(jobs):
+                while pending and idle:
+                    submit(pending.pop(0), idle.pop(0))
+                if idle:
+                    for idx in self._stragglers(running, durations, results):
+                        if not idle:
+                            break
+                        submit(idx, idle.pop(0))
+                with self._draining_lock:
+                    draining = list(self._draining)
+                if not running and not draining:
+                    for idx in pending:
+                        results[idx] = ToolJobResult(jobs[idx], error="No tool executor left.")
+                    break
+
+                done, _ = wait(list(running) + draining, timeout=1., return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future not in running:
+                        self._release_draining(future, idle)
+                        continue
+                    idx, endpoint, start_time = running.pop(future)
+                    try:
+                        output_bytes = future.result()
+                    except ToolExecutorLost as e:
+                        self.lost.add(endpoint)
+                        print(f"[Dispatcher] lost {endpoint}: {e}")
+                        if idx not in results and not self._is_running(idx, running) and idx not in pending:
+                            if attempts[idx] < self.max_attempts:
+                                pending.insert(0, idx)
+                            else:
+                                results[idx] = ToolJobResult(jobs[idx], error=f"Lost {attempts[idx]} tool executors: {e}")
+                        continue
+                    except Exception as e:
+                        idle.append(endpoint)
+                        if idx not in results and not self._is_running(idx, running):
+                            results[idx] = ToolJobResult(jobs[idx], error=str(e))
+                        continue
+                    idle.append(endpoint)
+                    if idx in results:
+                        continue
+                    durations.append(time.time() - start_time)
+                    results[idx] = ToolJobResult(jobs[idx], output_path=self._write_output(jobs[idx], output_bytes))
+        finally:
+            # duplicates of finished jobs are not waited for, but keep their executors busy
+            with self._draining_lock:
+                for future, (_, endpoint, _) in running.items():
+                    self._draining[future] = endpoint
+            pool.shutdown(wait=False, cancel_futures=True)
+        return [results[idx] for idx in range(len(jobs))]
+
+    def _release_draining(self, future: Future, idle: list[str]) -> None:
+        """Makes the executor of the ended run `future`, left behind by a previous `run`, idle again, unless it was lost or another `run` took it back already."""
+        with self._draining_lock:
+            endpoint = self._draining.pop(future, None)
+        if endpoint is None:
+            return
+        if future.cancelled() or isinstance(future.exception(), ToolExecutorLost):
+            self.lost.add(endpoint)
+        else:
+            idle.append(endpoint)
+
+    def wait_draining(self, timeout: Optional[float] = None) -> bool:
+        """Waits for the runs left behind by `run` to end. Returns whether they all did within `timeout` seconds."""
+        with self._draining_lock:
+            draining = list(self._draining)
+        _, not_done = wait(draining, timeout=timeout)
+        for future in draining:
+            if future.done():
+                self._release_draining(future, [])
+        return not not_done
+
+    def _stragglers(self, running: dict, durations: list[float], results: dict) -> list[int]:
+        if self.straggler_factor <= 0 or not durations:
+            return []
+        limit = self.straggler_factor * statistics.median(durations)
+        now = time.time()
+        n_runs: dict[int, int] = {}
+        for idx, _, _ in running.values():
+            n_runs[idx] = n_runs.get(idx, 0) + 1
+        return [
+            idx for idx, _, start_time in running.values()
+            if idx not in results and n_runs[idx] == 1 and now - start_time > limit
+        ]
+
+    @staticmethod
+    def _is_running(idx: int, running: dict) -> bool:
+        return any(running_idx == idx for running_idx, _, _ in running.values())
+
+    def _request(self, job: ToolJob, endpoint: str) -> bytes:
+        input_path = sorted(job.input_dir.glob('*'))[0]
+        query = urlencode({"subtask": job.tool.subtask, "tool": job.tool.tool_name})
+        headers = {"Content-Type": "application/octet-stream", "X-Input-Suffix": input_path.suffix}
+        if self.settings is not None:
+            headers["X-Executor-Settings"] = json.dumps(self.settings)
+        req = urllib.request.Request(
+            f"{endpoint}/run?{query}",
+            data=input_path.read_bytes(),
+            headers=headers,
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as rsp:
+                return rsp.read()
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"{job.tool.tool_name} failed on {endpoint}:\n{e.read().decode(errors='replace')}")
+        except (urllib.error.URLError, OSError) as e:
+            raise ToolExecutorLost(e)
+
+    @staticmethod
+    def _write_output(job: ToolJob, output_bytes: bytes) -> Path:
+        output_path = job.output_dir / "output.png"
+        tmp_path = job.output_dir.parent / ".output.png"
+        tmp_path.write_bytes(output_bytes)
+        os.replace(tmp_path, output_path)
+        return output_path
+
+
+class LocalToolCluster:
+    """Local stand-in for a cluster of tool hosts: starts `n_executors` tool servers on this host.
+
+    Args:
+        n_executors (int): Number of tool servers.
+        run_gpu_ids (list[int | None] | None, optional): GPU ID of each server, cycled. Defaults to None, i.e. the default GPU.
+        start_timeout (float, optional): Seconds to wait for a server to answer health checks. Defaults to 300.
+    """
+
+    def __init__(self, n_executors: int, run_gpu_ids: Optional[list[Optional[int]]] = None, start_timeout: float = 300.):
+        project_root = Path(__file__).resolve().parents[1]
+        run_gpu_ids = run_gpu_ids or [None]
+        self.processes: list[subprocess.Popen] = []
+        self.endpoints: list[str] = []
+        atexit.register(self.shutdown)
+        for i in range(n_executors):
+            port = _free_port()
+            cmd = [sys.executable, "-m", "executor.tool_server", "--host", "127.0.0.1", "--port", str(port)]
+            run_gpu_id = run_gpu_ids[i % len(run_gpu_ids)]
+            if run_gpu_id is not None:
+                cmd += ["--run_gpu_id", str(run_gpu_id)]
+            self.processes.append(subprocess.Popen(cmd, cwd=project_root))
+            self.endpoints.append(f"http://127.0.0.1:{port}")
+
+        dispatcher = ToolDispatcher(self.endpoints)
+        deadline = time.time() + start_timeout
+        for process, endpoint in zip(self.processes, self.endpoints):
+            while not dispatcher.health(endpoint):
+                if process.poll() is not None:
+                    self.shutdown()
+                    raise RuntimeError(f"Tool server {endpoint} exited with code {process.returncode}.")
+                if time.time() > deadline:
+                    self.shutdown()
+                    raise TimeoutError(f"Tool server {endpoint} did not start in {start_timeout}s.")
+                time.sleep(0.5)
+
+    def shutdown(self) -> None:
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        self.processes.clear()
+
+    def __enter__(self) -> "LocalToolCluster":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
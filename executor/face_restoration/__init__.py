@@ -12,6 +12,8 @@ project_root = Path(__file__).resolve().parents[2]
 
 class CodeFormer(Tool):
     """Towards Robust Blind Face Restoration with Codebook Lookup Transformer [NeurIPS 2022](https://arxiv.org/abs/2206.11253)"""
+    batchable = True
+
     def __init__(self):
         super().__init__(
             tool_name="codeformer",
@@ -33,6 +35,8 @@ class CodeFormer(Tool):
 
 class GFPGAN(Tool):
     """GFPGAN: High-Performance Face Restoration with Global and Local Perception [CVPR 2021](https://arxiv.org/abs/2105.05233)"""
+    batchable = True
+
     def __init__(self):
         super().__init__(
             tool_name="gfpgan",
@@ -58,9 +62,15 @@ class GFPGAN(Tool):
         cur_output_path.replace(self.output_dir / 'output.png')
         cur_output_path.parent.rmdir()
 
+    def _batch_output_path(self, input_stem: str) -> Path:
+        """GFPGAN names the faces of an input `{stem}_{idx:02d}.png`, an aligned input being a single face."""
+        return self.output_dir / 'restored_faces' / f'{input_stem}_00.png'
+
 
 class DifFace(Tool):
     """DIF-Face: De-Identification and Face Restoration for Visual Privacy Protection [CVPR 2021](https://arxiv.org/abs/2105.05233)"""
+    batchable = True
+
     def __init__(self):
         super().__init__(
             tool_name="difface",
@@ -89,6 +99,9 @@ class DifFace(Tool):
         cur_output_path.replace(self.output_dir / 'output.png')
         cur_output_path.parent.rmdir()
 
+    def _batch_output_path(self, input_stem: str) -> Path:
+        return self.output_dir / 'restored_faces' / f'{input_stem}.png'
+
 
 subtask = 'face_restoration'
 face_restoration_toolbox = [
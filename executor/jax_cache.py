@@ -0,0 +1,67 @@
+"""Persistent compilation cache of the JAX tools (MAXIM). The scripts write the XLA executables they compile to the cache directory and read them back in later runs, of the same or another subtask, and in other processes (see `executor/tool_utils/jax_compile_cache.py`); the executor bounds its size and gathers the hits and misses the runs report.
+
+Least recently used executables (by mtime) are evicted once the total size exceeds the limit, when the cache is opened.
+"""
+
+import os
+import json
+import threading
+from pathlib import Path
+from typing import Optional
+
+
+class JaxCompilationCache:
+    """
+    Args:
+        cache_dir (Path): Directory of the executables, may be shared by several processes.
+        max_size_gb (float, optional): Size limit of the directory. Defaults to 10.
+    """
+
+    def __init__(self, cache_dir: Path, max_size_gb: float = 10.):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_size_gb * 1024 ** 3)
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+        self._evict()
+
+    def record(self, stats_path: Path) -> Optional[dict]:
+        """Adds the hits and misses of a run, written by the script to `stats_path`. Returns them, or None if the script wrote none."""
+        try:
+            with open(stats_path) as f:
+                run_stats = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        with self._lock:
+            self.n_hits += run_stats["hits"]
+            self.n_misses += run_stats["misses"]
+        return run_stats
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.n_hits, "misses": self.n_misses, "size": self._size()}
+
+    def _entries(self) -> list[tuple[Path, os.stat_result]]:
+        """The executables with their stats; other processes sharing the directory may remove some meanwhile."""
+        entries = []
+        for path in self.cache_dir.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.is_file():
+                entries.append((path, stat))
+        return entries
+
+    def _size(self) -> int:
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        size = sum(stat.st_size for _, stat in entries)
+        for path, stat in entries:
+            if size <= self.max_bytes:
+                break
+            size -= stat.st_size
+            path.unlink(missing_ok=True)
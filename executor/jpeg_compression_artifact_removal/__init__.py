@@ -1,39 +1,40 @@
 import os
 from shutil import rmtree
 
-from ..tool import Tool
+from ..tool import Tool, MultiOutputTool
 from ..multitask_tools import *
 
 
 __all__ = ['jpeg_compression_artifact_removal_toolbox']
 
 
-class FBCNN(Tool):
-    """[Towards Flexible Blind JPEG Artifacts Removal (ICCV 2021)](https://openaccess.thecvf.com/content/ICCV2021/papers/Jiang_Towards_Flexible_Blind_JPEG_Artifacts_Removal_ICCV_2021_paper.pdf). There are seven outputs corresponding to different quality factors, one predicted and others pre-defined."""    
+class FBCNN(MultiOutputTool):
+    """[Towards Flexible Blind JPEG Artifacts Removal (ICCV 2021)](https://openaccess.thecvf.com/content/ICCV2021/papers/Jiang_Towards_Flexible_Blind_JPEG_Artifacts_Removal_ICCV_2021_paper.pdf). There is one output per quality factor, predicted ("blind") or pre-defined, exposed as the tools `fbcnn_{qf}` (see `variants`). The outputs are written by one run of the script, which loads the model once and runs the QF-independent part of the network once per image.
 
-    def __init__(self, qf: str|int):
-        """qf can be "blind", 5, or 90"""        
+    Args:
+        qfs (tuple[str | int, ...], optional): Quality factors of the outputs, "blind" or integers. Defaults to ("blind", 5, 90).
+    """
+
+    def __init__(self, qfs: tuple[str | int, ...] = ("blind", 5, 90)):
         super().__init__(
-            tool_name=f"fbcnn_{qf}",
+            tool_name="fbcnn",
             subtask="jpeg_compression_artifact_removal",
+            output_names=[str(qf) for qf in qfs],
             work_dir="FBCNN",
             script_rel_path="infer_fbcnn_4kagent.py"
         )
-        self.qf = qf
 
     def _get_cmd_opts(self) -> list[str]:
         return [
             "--input_dir", self.input_dir,
             "--weight_dir", 'FBCNN/model_zoo',
             "--output_dir", self.output_dir,
-            "--qf", self.qf
+            "--qf", *self.output_names
         ]
 
 
 subtask = 'jpeg_compression_artifact_removal'
 jpeg_compression_artifact_removal_toolbox = [
-    FBCNN(qf="blind"),
-    FBCNN(qf=5),
-    FBCNN(qf=90),
+    *FBCNN(qfs=("blind", 5, 90)).variants,
     SwinIR(subtask=subtask, pretrained_on='40'),
 ]
@@ -1,24 +1,30 @@
 # Modified from https://github.com/jiaxi-jiang/FBCNN/blob/main/main_test_fbcnn_color_real.py
 
 import os
+import sys
 import argparse
 import requests
 import torch
 import numpy as np
+from pathlib import Path
 from utils import utils_image as util
 
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))
+from checkpoint_loading import load_checkpoint
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', type=str)
     parser.add_argument('--weight_dir', type=str)
     parser.add_argument('--output_dir', type=str)
-    parser.add_argument('--qf', type=str)  # "blind", 5, or 90
+    # "blind", 5, or 90; the output of each QF is written to `{output_dir}/{qf}`, the QF-independent part of the network running once
+    parser.add_argument('--qf', type=str, nargs='+')
     args = parser.parse_args()
 
     input_dir = args.input_dir
     weight_dir = args.weight_dir
     output_dir = args.output_dir
-    qf = args.qf
+    qfs = args.qf
 
     n_channels = 3
     model_name = 'fbcnn_color.pth'
@@ -39,30 +45,35 @@ def main():
 
     from models.network_fbcnn import FBCNN as net
     model = net(in_nc=n_channels, out_nc=n_channels, nc=nc, nb=nb, act_mode='R')
-    model.load_state_dict(torch.load(model_path), strict=True)
+    model.load_state_dict(load_checkpoint(model_path), strict=True)
     model.eval()
     for _, param in model.named_parameters():
         param.requires_grad = False
     model = model.to(device)
 
     image_paths = util.get_image_paths(input_dir)
-    os.makedirs(output_dir, exist_ok=True)
+    qf_output_dirs = {qf: os.path.join(output_dir, qf) for qf in qfs}
+    for qf_output_dir in qf_output_dirs.values():
+        os.makedirs(qf_output_dir, exist_ok=True)
 
     for img_path in image_paths:
         img = util.imread_uint(img_path, n_channels=n_channels)
         img_tensor = util.uint2tensor4(img).to(device)
 
-        if qf == 'blind':
-            restored_img, pred_qf = model(img_tensor)
-        else:
-            qf_input = torch.tensor([[1 - int(qf) / 100.0]], device=device)
-            restored_img, pred_qf = model(img_tensor, qf_input)
+        with torch.no_grad():
+            features, pred_qf = model.encode(img_tensor)
+            for qf in qfs:
+                if qf == 'blind':
+                    restored_img = model.decode(features, pred_qf)
+                else:
+                    qf_input = torch.tensor([[1 - int(qf) / 100.0]], device=device)
+                    restored_img = model.decode(features, qf_input)
 
-        restored_img = util.tensor2single(restored_img)
-        restored_img = util.single2uint(restored_img)
+                restored_img = util.tensor2single(restored_img)
+                restored_img = util.single2uint(restored_img)
 
-        output_filename = os.path.join(output_dir, os.path.basename(img_path))
-        util.imsave(restored_img, output_filename)
+                output_filename = os.path.join(qf_output_dirs[qf], os.path.basename(img_path))
+                util.imsave(restored_img, output_filename)
 
 if __name__ == '__main__':
     main()
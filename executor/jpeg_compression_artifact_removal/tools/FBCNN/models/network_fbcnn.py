@@ -283,8 +283,8 @@ class FBCNN(nn.Module):
         self.to_beta_1 =  sequential(torch.nn.Linear(512, nc[0]),nn.Tanh())
 
 
-    def forward(self, x, qf_input=None):
-
+    def encode(self, x):
+        """QF-independent part of `forward`, to be run once for several `decode`s with different QFs. Returns the features to decode and the predicted QF."""
         h, w = x.size()[-2:]
         paddingBottom = int(np.ceil(h / 8) * 8 - h)
         paddingRight = int(np.ceil(w / 8) * 8 - w)
@@ -297,7 +297,15 @@ class FBCNN(nn.Module):
         x = self.m_body_encoder(x4)
         qf = self.qf_pred(x)
         x = self.m_body_decoder(x)
-        qf_embedding = self.qf_embed(qf_input) if qf_input is not None else self.qf_embed(qf)
+
+        x = x + x4
+        x = self.m_up3[0](x)
+        return (x, x1, x2, x3, h, w), qf
+
+    def decode(self, features, qf_input):
+        """QF-conditioned part of `forward` on the features of `encode`, for the QF `qf_input` (1 - quality factor / 100, e.g. the predicted QF)."""
+        x, x1, x2, x3, h, w = features
+        qf_embedding = self.qf_embed(qf_input)
         gamma_3 = self.to_gamma_3(qf_embedding)
         beta_3 = self.to_beta_3(qf_embedding)
 
@@ -307,9 +315,6 @@ class FBCNN(nn.Module):
         gamma_1 = self.to_gamma_1(qf_embedding)
         beta_1 = self.to_beta_1(qf_embedding)
 
-
-        x = x + x4
-        x = self.m_up3[0](x)
         for i in range(self.nb):
             x = self.m_up3[i+1](x, gamma_3,beta_3)
 
@@ -327,7 +332,11 @@ class FBCNN(nn.Module):
         x = x + x1
         x = self.m_tail(x)
         x = x[..., :h, :w]
+        return x
 
+    def forward(self, x, qf_input=None):
+        features, qf = self.encode(x)
+        x = self.decode(features, qf_input if qf_input is not None else qf)
         return x, qf
 
 if __name__ == "__main__":
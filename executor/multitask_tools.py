@@ -6,6 +6,8 @@ import yaml
 from typing import Union, Optional
 
 from .tool import Tool
+from .jax_cache import JaxCompilationCache
+from .output_cache import content_hash, file_fingerprint
 
 
 project_root = Path(__file__).resolve().parents[1]
@@ -56,6 +58,28 @@ class BasicSRModel(Tool):
         """Subclasses may override this to modify ckpt paths like `pretrain_network_g`."""
         pass
 
+    def _cache_signature(self) -> dict[str, str]:
+        """The options live in the configuration file written by `_preprocess`, so the template and the checkpoint are fingerprinted instead."""
+        signature = super()._cache_signature()
+        cfg_path = Path().resolve() / 'executor' / self.subtask / 'configs' / f'{self.tool_name}.yml'
+        signature["cfg"] = content_hash(cfg_path)
+        with open(cfg_path, 'r') as f:
+            cfg = yaml.safe_load(f)
+        self._update_pretrained_ckpt(cfg)
+        ckpt_path = Path(cfg['path'].get('pretrain_network_g') or "")
+        if ckpt_path.is_file():
+            signature["ckpt"] = file_fingerprint(ckpt_path)
+        return signature
+
+    def checkpoint_paths(self) -> list[Path]:
+        """The checkpoint of the configuration file, as updated by `_update_pretrained_ckpt`. The script loads it through BasicSR, which reads its safetensors copy when up to date (see `executor/tool_utils/checkpoint_loading.py`)."""
+        cfg_path = Path().resolve() / 'executor' / self.subtask / 'configs' / f'{self.tool_name}.yml'
+        with open(cfg_path, 'r') as f:
+            cfg = yaml.safe_load(f)
+        self._update_pretrained_ckpt(cfg)
+        ckpt_path = Path(cfg['path'].get('pretrain_network_g') or "")
+        return [ckpt_path] if ckpt_path.is_file() else []
+
     def _get_cmd_opts(self) -> list[str]:
         """Requires parameter `new_cfg_path: Path`."""
         return [
@@ -189,7 +213,7 @@ class SwinIR(Tool):
                 '--tile', '1024',
                 '--tile_overlap', '64'
             ]
-        return opts
+        return opts + self._tile_opts()
 
 
 class SwinIR_2x(Tool):
@@ -237,7 +261,7 @@ class SwinIR_2x(Tool):
                 '--tile', '1024',
                 '--tile_overlap', '64'
             ]
-        return opts
+        return opts + self._tile_opts()
 
 
 class Restormer(Tool):
@@ -272,6 +296,7 @@ class Restormer(Tool):
             "--tile", "1024",
             "--tile_overlap", "64",
             "--ckpt", str(project_root / f"pretrained_ckpts/Restormer/{self.opt_task.lower()}.pth"),
+            *self._tile_opts(),
         ]
 
     def _postprocess(self):
@@ -314,7 +339,8 @@ class MPRNet(Tool):
             "--model_arch_file", str(project_root / f"executor/denoising/tools/MPRNet/{self.opt_task}/MPRNet.py"),
             "--ckpt", str(project_root / f"pretrained_ckpts/MPRNet/model_{self.opt_task.lower()}.pth"),
             "--tile", "1024",
-            "--tile_overlap", "64"
+            "--tile_overlap", "64",
+            *self._tile_opts(),
         ]
 
 
@@ -325,6 +351,11 @@ class MAXIM(Tool):
         subtask (str): Subtask that can be handled by MAXIM, one of `denoising`, `motion_deblurring`, `deraining`, and `dehazing`.
     """
 
+    # shared by the MAXIM tools of all subtasks; when set (see `Executor.enable_jax_compilation_cache`), the compiled model is persisted and reused across runs
+    jax_cache: Optional[JaxCompilationCache] = None
+    # whether inputs are padded to bucket shapes, so that images of nearby sizes reuse the same compiled model (see `Executor.set_maxim_options`)
+    shape_buckets: bool = False
+
     def __init__(self, subtask: str):
         super().__init__(
             tool_name="maxim",
@@ -359,11 +390,23 @@ class MAXIM(Tool):
             "--ckpt_path", str(project_root / f"pretrained_ckpts/MAXIM/{self.opt_ckpt_name}"),
             "--input_dir", self.input_dir,
             "--output_dir", self.output_dir,
-            "--has_target=False"
+            "--has_target=False",
+            f"--shape_buckets={MAXIM.shape_buckets}",
+        ]
+
+    def _get_runtime_opts(self) -> list[str]:
+        """Requires parameter `rqd_input_dir: Path`. The script writes the compilation cache hits and misses of the run next to its input."""
+        if MAXIM.jax_cache is None:
+            return []
+        return [
+            "--jax_cache_dir", str(MAXIM.jax_cache.cache_dir),
+            "--compile_stats_path", str(self.rqd_input_dir / "compile_stats.json"),
         ]
 
     def _postprocess(self):
-        """Requires parameter `rqd_input_dir: Path`. Cleans up the temporary input directory `rqd_input_dir`."""
+        """Requires parameter `rqd_input_dir: Path`. Records the compilation cache hits and misses of the run, and cleans up the temporary input directory `rqd_input_dir`."""
+        if MAXIM.jax_cache is not None:
+            MAXIM.jax_cache.record(self.rqd_input_dir / "compile_stats.json")
         shutil.rmtree(self.rqd_input_dir)
 
 
@@ -400,6 +443,16 @@ class AutoDIR(Tool):
 
 
 class DiffPlugin(Tool):
+    """[Diff-Plugin: Revitalizing Details for Diffusion-based Low-level Tasks (CVPR 2024)](https://arxiv.org/abs/2403.00644) for brightening, defocus deblurring, deraining, and dehazing, one task plugin each on a shared Stable Diffusion base. In warm workers, the script runs in serving mode: the base stays resident across invocations of all subtasks, and the last `plugin_cache_size` plugins used are kept.
+
+    Args:
+        subtask (str): Subtask that can be handled by Diff-Plugin, one of `brightening`, `defocus_deblurring`, `deraining`, and `dehazing`.
+    """
+
+    # shared by the Diff-Plugin tools of all subtasks (see `Executor.set_diffplugin_options`)
+    num_inference_steps: int = 20
+    plugin_cache_size: int = 4
+
     def __init__(self, subtask: str):
         super().__init__(
             tool_name="diffplugin",
@@ -423,12 +476,17 @@ class DiffPlugin(Tool):
         return [
             "--pretrained_model_name_or_path", "CompVis/stable-diffusion-v1-4",
             "--clip_path", "openai/clip-vit-large-patch14",
-            "--num_inference_steps", "20",
+            "--num_inference_steps", str(DiffPlugin.num_inference_steps),
             "--img_path_dir", self.input_dir,
             "--save_root", self.output_dir,
             "--ckpt_dir", ckpt_dir,
         ]
 
+    def _get_runtime_opts(self) -> list[str]:
+        if Tool.worker_pool is None:
+            return []
+        return ["--serve", "--plugin_cache_size", str(DiffPlugin.plugin_cache_size)]
+
 
 class LaKDNet(Tool):
     def __init__(self, subtask):
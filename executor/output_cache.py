@@ -0,0 +1,123 @@
+"""Content-addressed cache of tool outputs. An output is keyed on the bytes of the input image and the signature of the tool (name, subtask, options and fingerprints of the script and checkpoints, see `Tool._cache_signature`), so identical inputs reuse the output regardless of where they sit in the image tree, across runs, rollbacks and jobs sharing the cache directory.
+
+Layout of the cache directory:
+```
+{cache_dir}
+├── objects
+│   └── {key[:2]}
+│       └── {key}.png
+└── tmp
+```
+Least recently used objects (by mtime, refreshed on every hit) are evicted once the total size exceeds the limit. Outputs are stored and materialized as copies, cloned on file systems supporting it (e.g. Btrfs, XFS): scripts that write their output in place, or later read it as input, never reach the stored objects.
+"""
+
+import os
+import sys
+import json
+import uuid
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from typing import Optional
+
+from utils.file_hash import content_hash, file_fingerprint
+
+
+class ToolOutputCache:
+    """On-disk, size-bounded LRU store of tool outputs.
+
+    Args:
+        cache_dir (Path): Directory of the store, may be shared by several processes.
+        max_size_gb (float, optional): Size limit of the store. Defaults to 50.
+    """
+
+    def __init__(self, cache_dir: Path, max_size_gb: float = 50.):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / "objects"
+        self.tmp_dir = self.cache_dir / "tmp"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_size_gb * 1024 ** 3)
+        self._lock = threading.Lock()
+        self._size = sum(p.stat().st_size for p in self.objects_dir.glob("*/*.png"))
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def key(self, input_path: Path, signature: dict[str, str]) -> str:
+        h = hashlib.sha256(content_hash(input_path).encode())
+        h.update(json.dumps(signature, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _object_path(self, key: str) -> Path:
+        return self.objects_dir / key[:2] / f"{key}.png"
+
+    def materialize(self, key: str, output_path: Path) -> bool:
+        """Copies the cached output to `output_path`. Returns whether `key` is cached."""
+        obj_path = self._object_path(key)
+        try:
+            _clone_or_copy(obj_path, output_path)
+            os.utime(obj_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.n_misses += 1
+            return False
+        with self._lock:
+            self.n_hits += 1
+        return True
+
+    def put(self, key: str, output_path: Path) -> None:
+        """Stores a copy of `output_path`. A copy rather than a link, so that later in-place edits of the output do not leak into the store."""
+        obj_path = self._object_path(key)
+        if obj_path.exists():
+            return
+        obj_path.parent.mkdir(exist_ok=True)
+        tmp_path = self.tmp_dir / f"{uuid.uuid4().hex}.png"
+        _clone_or_copy(output_path, tmp_path)
+        os.replace(tmp_path, obj_path)
+        with self._lock:
+            self._size += obj_path.stat().st_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Removes least recently used objects until the store is below 90% of its limit. Sizes are re-read from disk since other processes may share the store."""
+        entries = []
+        for p in self.objects_dir.glob("*/*.png"):
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, p))
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, size, p in entries:
+            if self._size <= target:
+                break
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.n_hits, "misses": self.n_misses, "size": self._size}
+
+
+# ioctl of Linux cloning a file into another, sharing their blocks until either is written
+_FICLONE = 0x40049409
+
+
+def _clone_or_copy(src: Path, dst: Path) -> None:
+    """Copies `src` to `dst`, a copy-on-write clone where the file system supports it. A hard link would not do: writing into either file would change both."""
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        if sys.platform.startswith("linux"):
+            import fcntl
+            try:
+                fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+                return
+            except OSError:
+                pass
+        shutil.copyfileobj(f_src, f_dst, 1 << 20)
@@ -112,7 +112,8 @@ class DRCT(Tool):
             "--output", self.output_dir,
             "--model_path", str(project_root / "pretrained_ckpts/DRCT/DRCT-L_X4.pth"),
             "--scale", "4",
-            "--tile", "512"
+            "--tile", "512",
+            *self._tile_opts(),
         ]
         
     def _update_pretrained_ckpt(self, cfg: dict):
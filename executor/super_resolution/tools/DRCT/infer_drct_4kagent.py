@@ -1,20 +1,27 @@
 import argparse
 import os
+import sys
 import glob
 import cv2
 import numpy as np
 import torch
+from pathlib import Path
 
 from drct.archs.DRCT_arch import DRCT
 
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))
+from tiled_inference import TiledInference, tile_arg
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_path', type=str, default="/work/u1657859/DRCT/experiments/train_DRCT-L_SRx4_finetune_from_ImageNet_pretrain/models/DRCT-L.pth")
     parser.add_argument('--input', type=str, default='datasets/Set14/LRbicx4', help='Input folder with LR images')
     parser.add_argument('--output', type=str, default='results/DRCT-L', help='Output folder for SR images')
     parser.add_argument('--scale', type=int, default=4, help='Upscale factor')
-    parser.add_argument('--tile', type=int, default=512, help='Tile size for memory-efficient testing')
+    parser.add_argument('--tile', type=tile_arg, default=512, help='Tile size for memory-efficient testing, "auto" to pick it from the GPU memory')
     parser.add_argument('--tile_overlap', type=int, default=32, help='Overlap size for tile inference')
+    parser.add_argument('--tile_batch', type=int, default=None, help='Number of tiles per forward pass, None for 1 with a fixed --tile, or as many as fit in --tile_memory_mb')
+    parser.add_argument('--tile_memory_mb', type=int, default=None, help='GPU memory budget of a forward pass, from which the tile size, at most --tile, and the tiles per pass are picked')
     return parser.parse_args()
 
 def load_model(model_path, device):
@@ -45,24 +52,12 @@ def test(img_lq, model, args, window_size):
     if args.tile is None:
         return model(img_lq)
     
-    # tiled inference
-    b, c, h, w = img_lq.size()
-    tile = min(args.tile, h, w)
-    stride = tile - args.tile_overlap
-    sf = args.scale
-    assert tile % window_size == 0, "Tile size should be a multiple of window size"
-
-    E = torch.zeros(b, c, h * sf, w * sf).to(img_lq)
-    W = torch.zeros_like(E)
-
-    for y in list(range(0, h - tile, stride)) + [h - tile]:
-        for x in list(range(0, w - tile, stride)) + [w - tile]:
-            patch = img_lq[..., y:y+tile, x:x+tile]
-            out_patch = model(patch)
-            E[..., y*sf:(y+tile)*sf, x*sf:(x+tile)*sf] += out_patch
-            W[..., y*sf:(y+tile)*sf, x*sf:(x+tile)*sf] += 1
-
-    return E / W
+    # tiled inference, several tiles per forward pass
+    tiler = TiledInference(
+        model, scale=args.scale, tile=args.tile, overlap=args.tile_overlap, multiple=window_size,
+        batch_size=args.tile_batch, memory_budget_mb=args.tile_memory_mb,
+    )
+    return tiler(img_lq)
 
 def save_image(tensor, path):
     output = tensor.squeeze().float().cpu().clamp_(0, 1).numpy()
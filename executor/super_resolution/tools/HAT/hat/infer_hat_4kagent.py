@@ -12,6 +12,7 @@ from collections import OrderedDict
 # Register models and data
 import sys
 import os
+from pathlib import Path
 sys.path.insert(0, os.path.abspath(os.path.join(__file__, '..', '..')))
 
 import hat.archs
@@ -25,6 +26,10 @@ from basicsr.utils import get_env_info, get_root_logger, get_time_str, make_exp_
 from basicsr.utils.options import dict2str, parse_options, ordered_yaml, _postprocess_yml_value
 from basicsr.utils.dist_util import get_dist_info, init_dist
 
+sys.path.append(str(Path(__file__).absolute().parents[4] / "tool_utils"))
+from checkpoint_loading import install as install_safetensors_loading
+install_safetensors_loading()
+
 
 def custom_parse_options(root_path, is_train=True):
     """Custom YAML + CLI parsing for BasicSR."""
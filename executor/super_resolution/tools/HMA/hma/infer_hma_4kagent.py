@@ -11,6 +11,7 @@ from collections import OrderedDict
 
 import sys
 import os
+from pathlib import Path
 sys.path.insert(0, os.path.abspath(os.path.join(__file__, '..', '..')))
 
 import hma.archs
@@ -26,6 +27,10 @@ from basicsr.utils.options import dict2str, parse_options, ordered_yaml, _postpr
 
 from basicsr.utils.dist_util import get_dist_info, init_dist
 
+sys.path.append(str(Path(__file__).absolute().parents[4] / "tool_utils"))
+from checkpoint_loading import install as install_safetensors_loading
+install_safetensors_loading()
+
 
 def custom_parse_options(root_path, is_train=True):
     parser = argparse.ArgumentParser()
@@ -1,9 +1,27 @@
 import os
-import subprocess
 import time
+import atexit
+import shutil
+import tempfile
+import threading
 from pathlib import Path
 from typing import Optional
 
+from .worker import WorkerPool
+from .output_cache import ToolOutputCache, content_hash, file_fingerprint
+from .cost_model import ToolStatsStore, run_measured
+from utils.image_handle import image_store
+
+
+def _n_pixels(input_paths: list[Path]) -> int:
+    from PIL import Image
+
+    n_pixels = 0
+    for input_path in input_paths:
+        with Image.open(input_path) as img:
+            n_pixels += img.width * img.height
+    return n_pixels
+
 
 class Tool:
     """Abstract class for a tool.
@@ -15,6 +33,19 @@ class Tool:
         script_rel_path (Path | str | None, optional): Path relative to the working directory of the script to run. Defaults to None.
     """
 
+    # shared by all tools; when set (see `Executor.enable_warm_workers`), scripts run in warm workers instead of cold subprocesses
+    worker_pool: Optional[WorkerPool] = None
+    # shared by all tools; when set (see `Executor.enable_output_cache`), outputs are looked up before invoking the tool
+    output_cache: Optional[ToolOutputCache] = None
+    # shared by all tools; when set (see `Executor.enable_stats`), the cost of every invocation is recorded
+    stats_store: Optional[ToolStatsStore] = None
+    # shared by all tools; when set (see `Executor.set_png_compression`), warm workers write output PNGs at this level
+    png_compression: Optional[int] = None
+    # shared by all tools; when set (see `Executor.set_tile_memory_budget`), tiled tools pick their tile size and tiles per pass from this GPU memory budget
+    tile_memory_mb: Optional[int] = None
+    # whether the script loops over its input directory, so that `run_batch` can run it on several inputs at once
+    batchable: bool = False
+
     def __init__(
         self,
         tool_name: str,
@@ -24,6 +55,8 @@ class Tool:
     ):
         self.tool_name = tool_name
         self.subtask = subtask
+        # invocations keep their state on the tool, so runs of the same tool on several images take turns
+        self._call_lock = threading.Lock()
         self.work_dir: Optional[Path] = None
         self.script_path: Optional[Path] = None
         if work_dir is not None:
@@ -32,6 +65,10 @@ class Tool:
             self.script_path = self.work_dir / script_rel_path
 
     def __call__(self, input_dir: Path, output_dir: Path, silent: bool = False, run_gpu_id: Optional[int] = None, *args) -> None:
+        with self._call_lock:
+            self._call(input_dir, output_dir, silent, run_gpu_id, *args)
+
+    def _call(self, input_dir: Path, output_dir: Path, silent: bool, run_gpu_id: Optional[int], *args) -> None:
         if not silent:
             print('-' * 100)
             print(f"Subtask\t: {self.subtask}")
@@ -44,14 +81,71 @@ class Tool:
         self.run_gpu_id = run_gpu_id
 
         self._precheck()
-        self._invoke(*args)
-        self._postcheck()
+        cache_key = None
+        if Tool.output_cache is not None and not args:
+            cache_key = Tool.output_cache.key(list(input_dir.glob('*'))[0], self._cache_signature())
+        if cache_key is not None and Tool.output_cache.materialize(cache_key, output_dir / 'output.png'):
+            cached = True
+        else:
+            cached = False
+            self._usage = {}
+            self._invoke(*args)
+            self._postcheck()
+            if cache_key is not None:
+                Tool.output_cache.put(cache_key, output_dir / 'output.png')
 
         end_time = time.time()
+        if Tool.stats_store is not None and not cached:
+            self._record_stats(end_time - start_time)
         if not silent:
-            print(f"Output\t: {list(output_dir.glob('*'))[0]}")
+            print(f"Output\t: {list(output_dir.glob('*'))[0]}{' (cached)' if cached else ''}")
             print(f"Time\t: {round(end_time - start_time, 3)}s")
 
+    def run_batch(self, input_dir: Path, output_dir: Path, silent: bool = False, run_gpu_id: Optional[int] = None) -> dict[str, Path]:
+        """Runs the tool once on all the images of `input_dir`, which should have distinct stems, instead of once per image. Only for `batchable` tools. The outputs are not looked up in the output cache. Returns the output of each input, `output_dir / f"{input stem}.png"`, by input stem."""
+        assert self.batchable, f"{self.tool_name} cannot run on a batch of inputs."
+        with self._call_lock:
+            input_paths = sorted(input_dir.glob('*'))
+            if not silent:
+                print('-' * 100)
+                print(f"Subtask\t: {self.subtask}")
+                print(f"Tool\t: {self.tool_name}")
+                print(f"Input\t: {len(input_paths)} images in {input_dir}")
+
+            start_time = time.time()
+            self.input_dir = input_dir
+            self.output_dir = output_dir
+            self.run_gpu_id = run_gpu_id
+
+            assert input_paths, "The input directory should not be empty."
+            assert len({path.stem for path in input_paths}) == len(input_paths), "The inputs should have distinct stems."
+            assert os.listdir(self.output_dir) == [], "The output directory should be empty."
+            self._usage = {}
+            self._preprocess()
+            self._run_script()
+            outputs = {}
+            for input_path in input_paths:
+                output_path = self._batch_output_path(input_path.stem)
+                assert output_path.is_file(), f"{self.tool_name} gave no output for {input_path.name}."
+                outputs[input_path.stem] = output_dir / f"{input_path.stem}.png"
+                if output_path != outputs[input_path.stem]:
+                    output_path.replace(outputs[input_path.stem])
+            for sub_dir in output_dir.iterdir():
+                if sub_dir.is_dir() and not any(sub_dir.iterdir()):
+                    sub_dir.rmdir()
+
+            end_time = time.time()
+            if Tool.stats_store is not None:
+                self._record_stats(end_time - start_time, input_paths)
+            if not silent:
+                print(f"Output\t: {len(outputs)} images in {output_dir}")
+                print(f"Time\t: {round(end_time - start_time, 3)}s")
+            return outputs
+
+    def _batch_output_path(self, input_stem: str) -> Path:
+        """Where the script writes the output of the input named `input_stem` in a batch run."""
+        return self.output_dir / f"{input_stem}.png"
+
     def _precheck(self) -> None:
         assert len(os.listdir(self.input_dir)) == 1, "The input directory should contain the input only."
         assert os.listdir(self.output_dir) == [], "The output directory should be empty."
@@ -62,51 +156,104 @@ class Tool:
         if output[0].name != 'output.png':
             output[0].replace(self.output_dir / 'output.png')
 
+    def _record_stats(self, wall_s: float, input_paths: Optional[list[Path]] = None) -> None:
+        """Records the cost of the run on `input_paths` (the input of `input_dir` if None), the pixels of a batch being summed."""
+        Tool.stats_store.record(
+            self.tool_name, self.subtask, _n_pixels(input_paths or list(self.input_dir.glob('*'))[:1]), wall_s,
+            cpu_s=self._usage.get("cpu_s"), peak_rss_mb=self._usage.get("peak_rss_mb"),
+        )
+
+    def _cache_signature(self) -> dict[str, str]:
+        """Everything besides the input image that determines the output: the configuration of the tool, its command options without the input and output directories, and fingerprints of the script and of the files the options point to (e.g. checkpoints). Subclasses whose options are only known after `_preprocess` should extend it."""
+        signature = {"class": type(self).__qualname__, "tool_name": self.tool_name, "subtask": self.subtask}
+        if self.script_path is not None and self.script_path.is_file():
+            signature["script"] = content_hash(self.script_path)
+            # modules of `executor/tool_utils` imported by the script
+            script_text = self.script_path.read_text(errors="ignore")
+            for util_path in sorted((Path(__file__).resolve().parent / "tool_utils").glob("*.py")):
+                if util_path.stem in script_text:
+                    signature[f"tool_utils.{util_path.stem}"] = content_hash(util_path)
+
+        runtime_attrs = {"input_dir", "output_dir", "run_gpu_id", "work_dir", "script_path"}
+        for name, value in sorted(vars(self).items()):
+            if name not in runtime_attrs and isinstance(value, (str, int, float, bool)):
+                signature[f"attr.{name}"] = str(value)
+
+        for i, (opt, opt_path) in enumerate(self._static_cmd_opts()):
+            signature[f"opt{i}"] = f"file:{file_fingerprint(opt_path)}" if opt_path.is_file() else str(opt)
+        return signature
+
+    def _static_cmd_opts(self) -> list[tuple[str, Path]]:
+        """The command options without the input and output directories, each with the path it would be relative to the working directory."""
+        input_dir, output_dir = getattr(self, "input_dir", None), getattr(self, "output_dir", None)
+        self.input_dir, self.output_dir = Path("<input>"), Path("<output>")
+        try:
+            opts = self._get_cmd_opts()
+        except Exception:
+            opts = []
+        finally:
+            self.input_dir, self.output_dir = input_dir, output_dir
+        opt_paths = []
+        for opt in opts:
+            opt_path = Path(str(opt))
+            if self.work_dir is not None and not opt_path.is_absolute():
+                opt_path = self.work_dir / opt_path
+            opt_paths.append((str(opt), opt_path))
+        return opt_paths
+
+    def checkpoint_paths(self) -> list[Path]:
+        """The checkpoint files (`.pth`, `.pt`) the command options point to, see `executor/convert_checkpoints.py`."""
+        return [opt_path for _, opt_path in self._static_cmd_opts() if opt_path.suffix in {".pth", ".pt"} and opt_path.is_file()]
+
     def _invoke(self, *args) -> None:
         self._preprocess()
-        
+        self._run_script()
+        self._postprocess()
+
+    def _run_script(self) -> None:
+        if Tool.worker_pool is not None:
+            # the worker maps the input instead of decoding it when the pipeline has decoded it already
+            image_specs = [spec for spec in map(image_store.raw_spec, self.input_dir.glob('*')) if spec is not None]
+            self._usage = Tool.worker_pool.run(
+                env_name=self._get_env_name(),
+                run_gpu_id=self.run_gpu_id,
+                script_path=self.script_path,
+                opts=self._get_cmd_opts() + self._get_runtime_opts(),
+                cwd=self.work_dir,
+                images=image_specs,
+                output_dir=self.output_dir,
+                png_compression=Tool.png_compression,
+            )
+        else:
+            self._usage = run_measured(self._get_cmd(), cwd=self.work_dir)
+            # Debug
+            # subprocess.run(self._get_cmd(), cwd=self.work_dir, shell=True, check=True)
+
+    def _get_env_name(self) -> str:
+        """Name of the environment under `/venv` to run the tool in."""
         # tools need specific conda environment
+        if self.tool_name == "ridcp":
+            return "4kagent_dehaze"
+        if self.tool_name in {
+            "osediff", "osediff_2x", "osediff_16x", 
+            "pisasr", "pisasr_2x", "pisasr_16x", "pisasr_psnr", "pisasr_2x_psnr"
+        }:
+            return "4kagent_sr"
         if self.tool_name in {
             "fourierdiff", 
             "autodir", "diffplugin", 
             "maxim", 
             'nafnet', 'nafnet_2x',
-            "EVSSM", 'ridcp', "AdaRevD", "FFTformer", "MLWNet", "UFPDeblur", "Turtle",
-            "osediff", "osediff_2x", "osediff_16x", 
-            "pisasr", "pisasr_2x", "pisasr_16x", "pisasr_psnr", "pisasr_2x_psnr"
+            "EVSSM", "AdaRevD", "FFTformer", "MLWNet", "UFPDeblur", "Turtle",
         }:
-            cmd = self._get_cmd_with_envs()
-        else:
-            cmd = self._get_cmd()
-
-        subprocess.run(cmd, cwd=self.work_dir, shell=True, check=True,
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        # Debug
-        # subprocess.run(cmd, cwd=self.work_dir, shell=True, check=True)
-        self._postprocess()
+            return "4kagent_spec_tools"
+        return "4kagent"
 
     def _get_cmd(self) -> str:
-        opts = self._get_cmd_opts()
-        if self.run_gpu_id is not None:
-            cmd = f"CUDA_VISIBLE_DEVICES={self.run_gpu_id} /venv/4kagent/bin/python '{self.script_path}'"
-        else:
-            cmd = f"/venv/4kagent/bin/python '{self.script_path}'"
-        for opt in opts:
-            cmd += f" '{opt}'"
-        return cmd
-    
-    def _get_cmd_with_envs(self) -> str:
-        opts = self._get_cmd_opts()
+        opts = self._get_cmd_opts() + self._get_runtime_opts()
 
-        if self.tool_name == "ridcp":
-            env_name = "4kagent_dehaze"
-        elif self.tool_name in ["osediff", "osediff_2x", "osediff_16x", "pisasr", "pisasr_2x", "pisasr_16x", "pisasr_psnr", "pisasr_2x_psnr"]:
-            env_name = "4kagent_sr"
-        else:
-            env_name = "4kagent_spec_tools"
-        
         # Patch for environment execution without conda in PATH
-        python_executable = f"/venv/{env_name}/bin/python"
+        python_executable = f"/venv/{self._get_env_name()}/bin/python"
 
         if self.run_gpu_id is not None:
             cmd = f"CUDA_VISIBLE_DEVICES={self.run_gpu_id} {python_executable} '{self.script_path}'"
@@ -120,8 +267,128 @@ class Tool:
     def _get_cmd_opts(self, *args) -> list[str]:
         raise NotImplementedError
 
+    def _tile_opts(self) -> list[str]:
+        """Options of the scripts tiling with `executor/tool_utils/tiled_inference.py`, besides `--tile` and `--tile_overlap`."""
+        if Tool.tile_memory_mb is None:
+            return []
+        return ["--tile_memory_mb", str(Tool.tile_memory_mb)]
+
+    def _get_runtime_opts(self) -> list[str]:
+        """Command options that do not change the output, e.g. how the script keeps its models between runs, hence left out of `_cache_signature`."""
+        return []
+
     def _preprocess(self) -> None:
         pass
 
     def _postprocess(self) -> None:
         pass
+
+
+class MultiOutputTool(Tool):
+    """Abstract class for a tool whose script writes several named outputs in one run, e.g. one per setting of a model sharing most of the computation, each into `{output_dir}/{output name}`. Each output is exposed as a tool of its own (see `variants`), registered in a toolbox in place of the multi-output tool: the first variant invoked on an image runs the script for all the outputs, and the other variants take theirs from that run instead of running the script again.
+
+    Args:
+        tool_name (str): Tool name, the variant of output `name` being named `f"{tool_name}_{name}"`.
+        subtask (str): Subtask name, serving as the name of the directory for the subtask.
+        output_names (list[str]): Names of the outputs.
+        work_dir (str | None, optional): Basename of working directory. Defaults to None.
+        script_rel_path (Path | str | None, optional): Path relative to the working directory of the script to run. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        tool_name: str,
+        subtask: str,
+        output_names: list[str],
+        work_dir: Optional[Path] = None,
+        script_rel_path: Optional[Path | str] = None
+    ):
+        super().__init__(tool_name, subtask, work_dir, script_rel_path)
+        self.output_names = list(output_names)
+        self._variants = [ToolVariant(self, name) for name in self.output_names]
+        # outputs of the last run not taken by their variants yet: (content hash of the input, directory of the run, names of the outputs left)
+        self._pending: Optional[tuple[str, Path, set[str]]] = None
+        atexit.register(self._drop_pending)
+
+    @property
+    def variants(self) -> list["ToolVariant"]:
+        return list(self._variants)
+
+    def take_output(self, name: str, input_dir: Path, output_dir: Path, run_gpu_id: Optional[int]) -> None:
+        """Moves the output `name` on the image of `input_dir` into `output_dir`, from the outputs left by the last run if it was on the same image, otherwise from a new run, whose cost is recorded for all the variants (see `_record_variant_stats`)."""
+        input_digest = content_hash(next(input_dir.glob('*')))
+        with self._call_lock:
+            if self._pending is None or self._pending[0] != input_digest or name not in self._pending[2]:
+                self._drop_pending()
+                run_dir = Path(tempfile.mkdtemp(prefix=f"{self.tool_name}-"))
+                self.input_dir, self.output_dir, self.run_gpu_id = input_dir, run_dir, run_gpu_id
+                start_time = time.time()
+                try:
+                    self._usage = {}
+                    self._preprocess()
+                    self._run_script()
+                    self._postprocess()
+                except BaseException:
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                    raise
+                self._pending = (input_digest, run_dir, set(self.output_names))
+                if Tool.stats_store is not None:
+                    self._record_variant_stats(time.time() - start_time)
+
+            _, run_dir, names_left = self._pending
+            outputs = [file for file in (run_dir / name).glob('*') if file.suffix in ['.png', '.jpg', '.jpeg', '.bmp', '.tiff']]
+            assert len(outputs) == 1, f"{self.tool_name} should give one image as output {name}, got {len(outputs)}."
+            outputs[0].replace(output_dir / outputs[0].name)
+            names_left.discard(name)
+            if not names_left:
+                self._drop_pending()
+
+    def _record_variant_stats(self, wall_s: float) -> None:
+        """Records the run of the script once for each variant, with an equal share of its wall and CPU time, so that the predicted costs of the variants in a toolbox add up to the cost of one run. The variants themselves record nothing: the time of a variant served from a run, or waiting for one, is not the cost of the tool."""
+        n_pixels = _n_pixels(list(self.input_dir.glob('*'))[:1])
+        share = 1 / len(self._variants)
+        cpu_s = self._usage.get("cpu_s")
+        for variant in self._variants:
+            Tool.stats_store.record(
+                variant.tool_name, self.subtask, n_pixels, wall_s * share,
+                cpu_s=None if cpu_s is None else cpu_s * share, peak_rss_mb=self._usage.get("peak_rss_mb"),
+            )
+
+    def cache_signature(self) -> dict[str, str]:
+        """`_cache_signature`, computed while no run of the tool is in progress, as it sets the directories of the tool."""
+        with self._call_lock:
+            return self._cache_signature()
+
+    def _drop_pending(self) -> None:
+        if self._pending is not None:
+            shutil.rmtree(self._pending[1], ignore_errors=True)
+            self._pending = None
+
+
+class ToolVariant(Tool):
+    """The output `output_name` of the multi-output tool `parent`, invoked like any tool.
+
+    Args:
+        parent (MultiOutputTool): Tool running the script.
+        output_name (str): Name of the output.
+    """
+
+    def __init__(self, parent: MultiOutputTool, output_name: str):
+        super().__init__(f"{parent.tool_name}_{output_name}", parent.subtask)
+        self.parent = parent
+        self.output_name = output_name
+        # the script of the parent, e.g. for the resource class of `ToolPool`
+        self.work_dir, self.script_path = parent.work_dir, parent.script_path
+
+    def _cache_signature(self) -> dict[str, str]:
+        return {**self.parent.cache_signature(), "output": self.output_name}
+
+    def _invoke(self, *args) -> None:
+        self.parent.take_output(self.output_name, self.input_dir, self.output_dir, self.run_gpu_id)
+
+    def _record_stats(self, wall_s: float, input_paths: Optional[list[Path]] = None) -> None:
+        # recorded by the parent, see `MultiOutputTool._record_variant_stats`
+        pass
+
+    def _get_env_name(self) -> str:
+        return self.parent._get_env_name()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import threading
+import traceback
+from pathlib import Path
+from typing import Optional
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from .tool import Tool
+
+
+@dataclass
+class ToolJob:
+    """A tool to run on the image in `input_dir`, writing to `output_dir`."""
+    tool: Tool
+    input_dir: Path
+    output_dir: Path
+    run_gpu_id: Optional[int] = None
+
+
+@dataclass
+class ToolJobResult:
+    job: ToolJob
+    output_path: Optional[Path] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class ToolPool:
+    """Runs tools concurrently with a bounded number of workers and a concurrency limit per resource class. A failing tool is reported in its result instead of aborting the others.
+
+    The resource class of a job is `cpu` for tools run in-process (without a script), otherwise `cuda:{run_gpu_id}` (or `cuda` if no GPU is specified).
+
+    Args:
+        max_workers (int): Maximum number of tools run at the same time.
+        resource_limits (dict[str, int] | None, optional): Concurrency limit per resource class, e.g. `{"cuda:0": 2, "cpu": 4}`. Classes not listed are limited by `max_workers` only. Defaults to None.
+    """
+
+    def __init__(self, max_workers: int, resource_limits: Optional[dict[str, int]] = None):
+        assert max_workers >= 1, "`max_workers` should be positive."
+        self.max_workers = max_workers
+        self.resource_limits = resource_limits or {}
+        self._semaphores: dict[str, threading.Semaphore] = {}
+        self._semaphores_lock = threading.Lock()
+
+    @staticmethod
+    def resource_class(job: ToolJob) -> str:
+        if job.tool.script_path is None:
+            return "cpu"
+        return "cuda" if job.run_gpu_id is None else f"cuda:{job.run_gpu_id}"
+
+    def run(self, jobs: list[ToolJob]) -> list[ToolJobResult]:
+        """Runs all jobs and returns their results in the order of `jobs`."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(self._run_job, jobs))
+
+    def _semaphore(self, resource_class: str) -> threading.Semaphore:
+        with self._semaphores_lock:
+            if resource_class not in self._semaphores:
+                limit = self.resource_limits.get(resource_class, self.max_workers)
+                self._semaphores[resource_class] = threading.Semaphore(max(1, limit))
+            return self._semaphores[resource_class]
+
+    def _run_job(self, job: ToolJob) -> ToolJobResult:
+        # tools may write next to their input (e.g. MAXIM) and check that the input directory holds the input only, so each job gets a private copy of the input directory
+        private_input_dir = job.output_dir.parent / ".input"
+        with self._semaphore(self.resource_class(job)):
+            try:
+                private_input_dir.mkdir()
+                for src in job.input_dir.iterdir():
+                    _link_or_copy(src, private_input_dir / src.name)
+                job.tool(
+                    input_dir=private_input_dir,
+                    output_dir=job.output_dir,
+                    silent=True,
+                    run_gpu_id=job.run_gpu_id
+                )
+                outputs = sorted(job.output_dir.glob('*'))
+                assert outputs, f"{job.tool.tool_name} produced no output."
+                return ToolJobResult(job, output_path=outputs[0])
+            except Exception:
+                return ToolJobResult(job, error=traceback.format_exc())
+            finally:
+                shutil.rmtree(private_input_dir, ignore_errors=True)
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
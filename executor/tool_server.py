@@ -0,0 +1,103 @@
+"""HTTP front end of the toolboxes, so that a `ToolDispatcher` can run tools on this host. Run from the project root:
+```
+python -m executor.tool_server --port 8600 --run_gpu_id 0
+```
+Protocol:
+- `GET /health` returns `{"ok": true, "busy": <bool>}`.
+- `POST /run?subtask={tool.subtask}&tool={tool.tool_name}` with the input image as body returns the output image (PNG), or the traceback with status 500 if the tool fails. The optional header `X-Executor-Settings` holds the executor-wide settings of the agent (see `Executor.settings`), applied before running the tool.
+
+Tools run one at a time; health checks are answered while a tool runs.
+"""
+
+import json
+import shutil
+import tempfile
+import threading
+import traceback
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import executor
+from .tool import Tool
+
+
+def find_tool(subtask: str, tool_name: str) -> Tool:
+    for toolbox in executor.toolbox_router.values():
+        for tool in toolbox:
+            if tool.subtask == subtask and tool.tool_name == tool_name:
+                return tool
+    raise KeyError(f"No tool {tool_name} for {subtask}.")
+
+
+class ToolServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, run_gpu_id: Optional[int] = None, host: str = "0.0.0.0"):
+        super().__init__((host, port), _ToolRequestHandler)
+        self.run_gpu_id = run_gpu_id
+        self.tool_lock = threading.Lock()
+
+    def run_tool(self, subtask: str, tool_name: str, input_bytes: bytes, input_suffix: str, settings: Optional[dict] = None) -> bytes:
+        tool = find_tool(subtask, tool_name)
+        with self.tool_lock, tempfile.TemporaryDirectory(prefix="imagent_tool_server_") as tmp_dir:
+            if settings is not None:
+                executor.apply_settings(settings)
+            input_dir = Path(tmp_dir) / "input"
+            output_dir = Path(tmp_dir) / "output"
+            input_dir.mkdir()
+            output_dir.mkdir()
+            (input_dir / f"input{input_suffix}").write_bytes(input_bytes)
+            tool(input_dir=input_dir, output_dir=output_dir, silent=True, run_gpu_id=self.run_gpu_id)
+            return (output_dir / "output.png").read_bytes()
+
+
+class _ToolRequestHandler(BaseHTTPRequestHandler):
+    server: ToolServer
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self.send_error(404)
+            return
+        busy = self.server.tool_lock.locked()
+        self._reply(200, json.dumps({"ok": True, "busy": busy}).encode(), "application/json")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/run":
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        input_bytes = self.rfile.read(int(self.headers["Content-Length"]))
+        settings = self.headers.get("X-Executor-Settings")
+        try:
+            output_bytes = self.server.run_tool(
+                query["subtask"][0], query["tool"][0], input_bytes, self.headers.get("X-Input-Suffix", ".png"),
+                settings=None if settings is None else json.loads(settings))
+        except Exception:
+            self._reply(500, traceback.format_exc().encode(), "text/plain")
+            return
+        self._reply(200, output_bytes, "image/png")
+
+    def _reply(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tool server")
+    parser.add_argument("--port", type=int, required=True, help="Port to listen on")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--run_gpu_id", type=int, default=None, help="GPU ID to run the tools")
+    args = parser.parse_args()
+    with ToolServer(args.port, run_gpu_id=args.run_gpu_id, host=args.host) as server:
+        server.serve_forever()
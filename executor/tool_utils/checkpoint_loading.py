@@ -0,0 +1,162 @@
+"""Checkpoint loading of the `*_4kagent.py` scripts from the safetensors copies of the `.pth` files in `pretrained_ckpts/`, written by `python -m executor.convert_checkpoints`. A copy is memory-mapped rather than unpickled, which saves most of the load time of a cold start; `.pth` files without an up-to-date copy, or environments without `safetensors`, fall back to `torch.load`.
+
+The copy of `{name}.pth` is `{name}.pth.safetensors`, next to it. Its header keeps the nesting of the checkpoint (e.g. `{"params": state_dict}`) and its non-tensor values, and the size and mtime of the `.pth` it was converted from: a copy whose `.pth` changed since is ignored. Like `tiled_inference`, the module is imported from its directory:
+```
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))  # executor/tool_utils
+from checkpoint_loading import load_checkpoint
+
+state_dict = load_checkpoint(args.model_path)  # instead of torch.load(args.model_path)
+```
+Scripts that leave the loading to a library call `install()` instead.
+"""
+
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional
+
+import torch
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+except ImportError:
+    safe_open = save_file = None
+
+
+SUFFIX = ".safetensors"
+# header keys of the copies
+LAYOUT_KEY = "imagent.layout"
+SOURCE_KEY = "imagent.source"
+
+# whether `install` routed `torch.load` through the copies
+_installed = False
+
+
+class NotConvertibleError(ValueError):
+    """The checkpoint holds values other than tensors, containers and JSON scalars (e.g. pickled modules or namespaces)."""
+
+
+def safetensors_path(path: str | os.PathLike) -> Path:
+    """Path of the safetensors copy of the checkpoint `path`."""
+    return Path(f"{path}{SUFFIX}")
+
+
+def source_stamp(path: str | os.PathLike) -> dict[str, int]:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def fresh_copy(path: str | os.PathLike) -> Optional[Path]:
+    """The safetensors copy of the checkpoint `path` if it exists and was converted from the current `path`, else None."""
+    copy_path = safetensors_path(path)
+    if safe_open is None or not copy_path.is_file():
+        return None
+    try:
+        with safe_open(str(copy_path), framework="pt") as f:
+            source = json.loads((f.metadata() or {}).get(SOURCE_KEY, "null"))
+    except Exception:
+        return None
+    if source is None or {k: source.get(k) for k in ("size", "mtime_ns")} != source_stamp(path):
+        return None
+    return copy_path
+
+
+def load_checkpoint(path: str | os.PathLike, map_location: Any = None) -> Any:
+    """`torch.load(path, map_location)`, from the memory-mapped safetensors copy of `path` when it is up to date. Tensors of a copy are on `map_location` if a device, else on the CPU."""
+    if _installed:
+        # `torch.load` reads the copies, through the checkpoint cache of warm workers wrapping it
+        return torch.load(path, map_location=map_location)
+    copy_path = fresh_copy(path) if isinstance(map_location, (type(None), str, torch.device)) else None
+    if copy_path is None:
+        return torch.load(path, map_location=map_location)
+    return _load_copy(copy_path, map_location)
+
+
+def _load_copy(copy_path: Path, map_location: Any) -> Any:
+    device = torch.device("cpu" if map_location is None else map_location)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    with safe_open(str(copy_path), framework="pt", device=str(device)) as f:
+        layout = json.loads(f.metadata()[LAYOUT_KEY])
+        tensors = {key: f.get_tensor(key) for key in f.keys()}
+    return _unflatten(layout, tensors)
+
+
+def install() -> None:
+    """Routes `torch.load` of the checkpoint files with an up-to-date safetensors copy to the copy, for the rest of the process.
+
+    For the scripts that leave the loading to a library: e.g. BasicSR's `load_network` then reads the safetensors copy of `pretrain_network_g` when up to date, without changes to BasicSR or to the option files. Such a script calls it once, before building its model:
+    ```
+    sys.path.append(str(Path(__file__).absolute().parents[4] / "tool_utils"))  # executor/tool_utils
+    from checkpoint_loading import install as install_safetensors_loading
+    install_safetensors_loading()
+    ```
+    Warm workers install it before their checkpoint cache, which then wraps it.
+    """
+    global _installed
+    if _installed:
+        return
+    load = torch.load
+
+    def safetensors_load(f, map_location=None, *args, **kwargs):
+        # safetensors hold weights only, whatever `weights_only`
+        if not args and set(kwargs) <= {"weights_only"} and isinstance(map_location, (type(None), str, torch.device)) \
+                and isinstance(f, (str, os.PathLike)) and os.path.isfile(f):
+            copy_path = fresh_copy(f)
+            if copy_path is not None:
+                return _load_copy(copy_path, map_location)
+        return load(f, map_location, *args, **kwargs)
+
+    torch.load = safetensors_load
+    _installed = True
+
+
+def convert(path: str | os.PathLike) -> Path:
+    """Writes the safetensors copy of the checkpoint `path` and returns its path. Raises `NotConvertibleError` if the checkpoint holds values that safetensors cannot."""
+    assert save_file is not None, "safetensors is not installed."
+    stamp = source_stamp(path)
+    checkpoint = torch.load(path, map_location="cpu")
+    tensors: dict[str, torch.Tensor] = {}
+    layout = _flatten(checkpoint, "", tensors, set())
+    copy_path = safetensors_path(path)
+    tmp_path = copy_path.with_name(f".{copy_path.name}.{os.getpid()}.tmp")
+    save_file(tensors, str(tmp_path), metadata={LAYOUT_KEY: json.dumps(layout), SOURCE_KEY: json.dumps(stamp)})
+    os.replace(tmp_path, copy_path)
+    return copy_path
+
+
+def _flatten(obj: Any, prefix: str, tensors: dict[str, torch.Tensor], storages: set[int]) -> Any:
+    """JSON layout of `obj`, its tensors being moved to `tensors` under their path in `obj`."""
+    if isinstance(obj, torch.Tensor):
+        tensor = obj.detach().contiguous()
+        # safetensors refuses tensors sharing memory, e.g. tied weights
+        if tensor.untyped_storage().data_ptr() in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.untyped_storage().data_ptr())
+        tensors[prefix] = tensor
+        return {"tensor": prefix}
+    if isinstance(obj, dict):
+        if not all(isinstance(k, str) for k in obj):
+            raise NotConvertibleError(f"Non-string keys at {prefix or '/'}.")
+        return {"dict": [[k, _flatten(v, f"{prefix}/{k}" if prefix else k, tensors, storages)] for k, v in obj.items()]}
+    if isinstance(obj, (list, tuple)):
+        items = [_flatten(v, f"{prefix}/{i}", tensors, storages) for i, v in enumerate(obj)]
+        return {"tuple" if isinstance(obj, tuple) else "list": items}
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return {"value": obj}
+    raise NotConvertibleError(f"{type(obj).__name__} at {prefix or '/'}.")
+
+
+def _unflatten(layout: dict, tensors: dict[str, torch.Tensor]) -> Any:
+    (kind, value), = layout.items()
+    if kind == "tensor":
+        return tensors[value]
+    if kind == "dict":
+        # an OrderedDict, like the state dicts saved by torch
+        return OrderedDict((k, _unflatten(v, tensors)) for k, v in value)
+    if kind in ("list", "tuple"):
+        items = [_unflatten(v, tensors) for v in value]
+        return tuple(items) if kind == "tuple" else items
+    return value
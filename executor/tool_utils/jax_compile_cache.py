@@ -0,0 +1,88 @@
+"""Persistent compilation cache and shape buckets of the JAX `*_4kagent.py` scripts (MAXIM), so that the XLA executables compiled for an input shape are reused across images, subtasks and processes instead of being compiled on every run.
+
+JAX compiles a jitted function once per input shape; the executables are written to the cache directory managed by the executor (see `Executor.enable_jax_compilation_cache`) and read back by later runs of any subtask with the same model variant. Inputs are padded to a few bucket shapes so that images of nearby sizes share executables. Like `tiled_inference`, the module is imported from its directory:
+```
+sys.path.append(str(Path(__file__).absolute().parents[4] / "tool_utils"))  # executor/tool_utils
+from jax_compile_cache import enable_compilation_cache, bucket_side, compile_counts
+
+enable_compilation_cache(cache_dir)
+counts_before = compile_counts()
+...
+hits, misses = compile_counts() - counts_before
+```
+"""
+
+import os
+from typing import Optional
+
+import numpy as np
+
+
+# smallest bucket side; bucket sides are the powers of 2 and 1.5 times the powers of 2 from it, all multiples of 64
+MIN_BUCKET_SIDE = 256
+
+_cache_dir: Optional[str] = None
+# cache hits and misses of the process, counted from the JAX monitoring events
+_counts = {"hits": 0, "misses": 0}
+_listening = False
+
+
+def bucket_side(side: int, min_side: int = MIN_BUCKET_SIDE) -> int:
+    """The smallest bucket side not below `side`, at most 1.5 times `side` beyond `min_side`."""
+    bucket = min_side
+    while bucket < side:
+        # 2^k -> 1.5 * 2^k -> 2^(k+1)
+        bucket = bucket * 3 // 2 if bucket & (bucket - 1) == 0 else bucket * 4 // 3
+    return bucket
+
+
+def enable_compilation_cache(cache_dir: str) -> bool:
+    """Persists the executables compiled by JAX in `cache_dir` for the rest of the process, and counts the cache hits and misses (see `compile_counts`). Returns whether this JAX version could count them."""
+    global _cache_dir
+    import jax
+
+    if _cache_dir != cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            jax.config.update("jax_compilation_cache_dir", cache_dir)
+        except AttributeError:
+            # JAX < 0.4.5
+            from jax.experimental.compilation_cache import compilation_cache
+
+            compilation_cache.initialize_cache(cache_dir)
+        _cache_dir = cache_dir
+    return _listen()
+
+
+def _listen() -> bool:
+    global _listening
+    if _listening:
+        return True
+    monitoring = getattr(__import__("jax"), "monitoring", None)
+    if monitoring is None or not hasattr(monitoring, "register_event_listener"):
+        return False
+
+    def on_event(event: str, **kwargs) -> None:
+        if not event.startswith("/jax/compilation_cache/"):
+            return
+        if event.endswith("/cache_hits") or event.endswith("/cache_hits_original"):
+            _counts["hits"] += 1
+        elif event.endswith("/cache_misses"):
+            _counts["misses"] += 1
+
+    monitoring.register_event_listener(on_event)
+    _listening = True
+    return True
+
+
+def compile_counts() -> np.ndarray:
+    """Persistent cache hits and misses of the process so far, as an array `[hits, misses]` to take differences of."""
+    return np.array([_counts["hits"], _counts["misses"]])
+
+
+def cache_entries(cache_dir: str) -> int:
+    """Number of executables in `cache_dir`, to count the misses by difference where JAX has no monitoring events."""
+    try:
+        return sum(1 for name in os.listdir(cache_dir) if not name.startswith("."))
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,144 @@
+"""Models kept resident across the runs of the `*_4kagent.py` scripts in a warm worker (see `executor/worker.py`), e.g. a base model shared by the tools of several subtasks, which then only load what differs between them.
+
+The worker drops the modules of a tool directory when it runs a script from another one, but not this module, which lives out of the tool directories; in a cold subprocess, the models live as long as the run. Like `tiled_inference`, the module is imported from its directory:
+```
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))  # executor/tool_utils
+from resident_models import resident_pool
+
+base = resident_pool("diffplugin_base").get((model_path, str(device)), lambda: load_base(model_path, device))
+plugin = resident_pool("diffplugin_plugins", capacity=4).get((ckpt_dir, str(device)), lambda: load_plugin(ckpt_dir, device))
+```
+A model is sized by the tensors of the torch modules in it (see `model_nbytes`). Warm workers cap the total size of the models of all pools with `set_memory_budget`, the least recently used models of any pool being dropped beyond it, and drop them all with `release_all` when a script runs out of GPU memory.
+"""
+
+import itertools
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+# order of use of the models of all pools
+_clock = itertools.count()
+# cap of the total size of the models of all pools, see `set_memory_budget`
+_max_bytes: Optional[int] = None
+
+
+class ResidentModels:
+    """LRU of models by key.
+
+    Args:
+        capacity (int | None, optional): Maximum number of models, the least recently used ones being dropped beyond it. Defaults to None, i.e. no limit.
+    """
+
+    def __init__(self, capacity: Optional[int] = None):
+        self.capacity = capacity
+        # key -> (model, its size in bytes, its last use)
+        self._models: OrderedDict[Hashable, tuple[object, int, int]] = OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, key: Hashable, load: Callable[[], T]) -> T:
+        """The model of `key`, `load()`ed if not resident."""
+        if key in self._models:
+            self._models.move_to_end(key)
+            model, n_bytes, _ = self._models[key]
+            self._models[key] = (model, n_bytes, next(_clock))
+            self.n_hits += 1
+            return model
+        self.n_misses += 1
+        # make room before loading, so that the dropped models can be freed meanwhile
+        self._evict(1)
+        model = load()
+        self._models[key] = (model, model_nbytes(model), next(_clock))
+        _enforce_budget(keep=self._models[key])
+        return model
+
+    @property
+    def n_bytes(self) -> int:
+        return sum(n_bytes for _, n_bytes, _ in self._models.values())
+
+    def resize(self, capacity: Optional[int]) -> None:
+        self.capacity = capacity
+        self._evict(0)
+
+    def clear(self) -> None:
+        self._models.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def _evict(self, n_new: int) -> None:
+        if self.capacity is None:
+            return
+        while self._models and len(self._models) + n_new > self.capacity:
+            self._models.popitem(last=False)
+
+
+_pools: dict[str, ResidentModels] = {}
+
+
+def model_nbytes(model: object) -> int:
+    """Size of the tensors of the torch modules in `model`, which may also be a tuple, list or dict of models, shared tensors being counted once. Other objects (e.g. schedulers) count as 0."""
+    try:
+        import torch
+    except ImportError:
+        return 0
+    tensors = {}
+
+    def visit(obj: object) -> None:
+        if isinstance(obj, torch.nn.Module):
+            for tensor in itertools.chain(obj.parameters(), obj.buffers()):
+                tensors[tensor.data_ptr()] = tensor.element_size() * tensor.nelement()
+        elif isinstance(obj, dict):
+            for value in obj.values():
+                visit(value)
+        elif isinstance(obj, (list, tuple)):
+            for value in obj:
+                visit(value)
+
+    visit(model)
+    return sum(tensors.values())
+
+
+def resident_bytes() -> int:
+    """Total size of the models of all pools."""
+    return sum(pool.n_bytes for pool in _pools.values())
+
+
+def set_memory_budget(max_bytes: Optional[int]) -> None:
+    """Caps the total size of the models of all pools at `max_bytes`, None lifting the cap."""
+    global _max_bytes
+    _max_bytes = max_bytes
+    _enforce_budget()
+
+
+def release_all() -> None:
+    """Drops the models of all pools, e.g. after running out of GPU memory. The pools keep their capacity."""
+    for pool in _pools.values():
+        pool.clear()
+
+
+def _enforce_budget(keep: Optional[tuple] = None) -> None:
+    """Drops the least recently used models of all pools, but the entry `keep`, until their total size fits the budget."""
+    if _max_bytes is None:
+        return
+    while resident_bytes() > _max_bytes:
+        entries = [(entry[2], pool, key) for pool in _pools.values() for key, entry in pool._models.items() if entry is not keep]
+        if not entries:
+            return
+        _, pool, key = min(entries, key=lambda x: x[0])
+        del pool._models[key]
+
+
+def resident_pool(name: str, capacity: Optional[int] = None) -> ResidentModels:
+    """The pool of resident models `name` of the process, created on first use. `capacity`, if given, sets its maximum number of models."""
+    pool = _pools.get(name)
+    if pool is None:
+        pool = _pools[name] = ResidentModels(capacity)
+    elif capacity is not None and capacity != pool.capacity:
+        pool.resize(capacity)
+    return pool
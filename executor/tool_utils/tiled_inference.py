@@ -0,0 +1,164 @@
+"""Tiled inference shared by the `*_4kagent.py` scripts of CNN and transformer tools, in place of their own tile loops.
+
+Tiles of the same size are blended with Gaussian or feathered weights so that tile seams do not show, and stitched one row of tiles at a time: the accumulators span a band of about two rows of tiles rather than the whole output. A fixed tile runs one per forward pass unless told otherwise; given a GPU memory budget (`--tile_memory_mb`, see `Executor.set_tile_memory_budget`), the tile size, at most the fixed one, and the number of tiles per pass are picked from it.
+
+The scripts run in the environments of their tools, so this module only imports torch and the standard library, and is imported from its directory:
+```
+sys.path.append(str(Path(__file__).absolute().parents[3] / "tool_utils"))  # executor/tool_utils
+from tiled_inference import TiledInference
+
+tiler = TiledInference(model, scale=4, tile=args.tile, overlap=args.tile_overlap, multiple=window_size)
+output = tiler(img_lq)  # 1 x C x H*4 x W*4, on the CPU
+```
+"""
+
+import math
+from typing import Callable, Iterator, Optional
+
+import torch
+
+
+# tile size when neither given nor measurable (CPU runs)
+DEFAULT_TILE = 512
+MAX_AUTO_TILE = 2048
+# tiles per forward pass picked from a memory budget at most
+MAX_AUTO_BATCH = 8
+# side of the tile run to measure the memory of a forward pass
+PROBE_TILE = 128
+# share of the free GPU memory used when no budget is given
+FREE_MEMORY_SHARE = 0.7
+
+
+def tile_arg(value: str) -> int:
+    """Type of the `--tile` option of the scripts: a tile side, or "auto" (0) to pick it from the memory budget."""
+    return 0 if value == "auto" else int(value)
+
+
+class TiledInference:
+    """
+    Args:
+        forward (Callable[[torch.Tensor], torch.Tensor]): Model, or function of an N x C x h x w batch of tiles returning the N x C' x h*scale x w*scale outputs.
+        scale (int, optional): Upscale factor of `forward`. Defaults to 1.
+        tile (int | None, optional): Tile side in input pixels, the max one if `memory_budget_mb` is given. Defaults to None, i.e. picked from the memory budget on GPU, `DEFAULT_TILE` on CPU.
+        overlap (int, optional): Overlap of neighbouring tiles in input pixels. Defaults to 32.
+        multiple (int, optional): The tile side is rounded down to a multiple of it, e.g. the window size. Defaults to 8.
+        batch_size (int | None, optional): Tiles per forward pass. Defaults to None, i.e. as many as fit in the memory budget (at most `MAX_AUTO_BATCH`) when the tile side is picked from it, else 1.
+        memory_budget_mb (int | None, optional): GPU memory for a forward pass, from which the tile side and `batch_size` are picked. Defaults to None, i.e. `FREE_MEMORY_SHARE` of the free memory if `tile` is None, no budget otherwise.
+        blend (str, optional): Weights of the tile outputs, "gaussian", "feather" (linear ramps over the overlap) or "uniform" (plain average). Defaults to "gaussian".
+    """
+
+    def __init__(
+        self,
+        forward: Callable[[torch.Tensor], torch.Tensor],
+        scale: int = 1,
+        tile: Optional[int] = None,
+        overlap: int = 32,
+        multiple: int = 8,
+        batch_size: Optional[int] = None,
+        memory_budget_mb: Optional[int] = None,
+        blend: str = "gaussian",
+    ):
+        assert blend in {"gaussian", "feather", "uniform"}, f"Unknown blend {blend}."
+        self.forward = forward
+        self.scale = scale
+        self.tile = tile or None
+        self.overlap = overlap
+        self.multiple = max(1, multiple)
+        self.batch_size = None if batch_size is None else max(1, batch_size)
+        self.memory_budget_mb = memory_budget_mb
+        self.blend = blend
+
+    def __call__(self, img: torch.Tensor, out_device: str | torch.device = "cpu") -> torch.Tensor:
+        """Output of `forward` on the 1 x C x H x W image `img`, as a float tensor on `out_device`."""
+        output = None
+        for y0, y1, band in self.bands(img):
+            if output is None:
+                _, c, _, w = band.shape
+                output = torch.empty(1, c, img.shape[2] * self.scale, w, dtype=torch.float32, device=out_device)
+            output[:, :, y0:y1] = band.to(out_device)
+        return output
+
+    @torch.no_grad()
+    def bands(self, img: torch.Tensor) -> Iterator[tuple[int, int, torch.Tensor]]:
+        """Output of `forward` on the 1 x C x H x W image `img`, top to bottom in full-width bands: yields `(y0, y1, band)` with `band` the float rows `y0:y1` of the output, on the device of `img`."""
+        _, _, h, w = img.shape
+        tile, batch_size = self._plan(img)
+        if tile >= max(h, w):
+            yield 0, h * self.scale, self.forward(img).float()
+            return
+        tile = min(tile, h, w) // self.multiple * self.multiple
+        stride = max(tile - self.overlap, 1)
+        ys = list(range(0, h - tile, stride)) + [h - tile]
+        xs = list(range(0, w - tile, stride)) + [w - tile]
+        sf = self.scale
+        weight = None
+        # accumulators of the output rows acc_y0: of the current row of tiles and the part of the previous one it overlaps
+        acc_y0, acc_e, acc_w = 0, None, None
+
+        for row, y in enumerate(ys):
+            out_tiles = []
+            for i in range(0, len(xs), batch_size):
+                batch = torch.cat([img[..., y:y + tile, x:x + tile] for x in xs[i:i + batch_size]])
+                out_tiles += list(self.forward(batch).float())
+            if weight is None:
+                c = out_tiles[0].shape[0]
+                weight = self._weight(tile * sf, img.device)
+                acc_e = torch.zeros(1, c, 0, w * sf, device=img.device)
+                acc_w = torch.zeros(1, 1, 0, w * sf, device=img.device)
+            # extend the accumulators down to the bottom of this row of tiles
+            n_new_rows = (y + tile) * sf - (acc_y0 + acc_e.shape[2])
+            if n_new_rows > 0:
+                acc_e = torch.cat([acc_e, acc_e.new_zeros(1, acc_e.shape[1], n_new_rows, w * sf)], dim=2)
+                acc_w = torch.cat([acc_w, acc_w.new_zeros(1, 1, n_new_rows, w * sf)], dim=2)
+            top = y * sf - acc_y0
+            for x, out_tile in zip(xs, out_tiles):
+                acc_e[0, :, top:top + tile * sf, x * sf:(x + tile) * sf].add_(out_tile * weight)
+                acc_w[0, :, top:top + tile * sf, x * sf:(x + tile) * sf].add_(weight)
+            del out_tiles
+
+            # rows above the next row of tiles are final
+            done_y1 = ys[row + 1] * sf if row + 1 < len(ys) else h * sf
+            n_done = done_y1 - acc_y0
+            if n_done > 0:
+                yield acc_y0, done_y1, acc_e[:, :, :n_done] / acc_w[:, :, :n_done]
+                acc_e, acc_w = acc_e[:, :, n_done:].clone(), acc_w[:, :, n_done:].clone()
+                acc_y0 = done_y1
+
+    def _plan(self, img: torch.Tensor) -> tuple[int, int]:
+        """Tile side and tiles per forward pass: `tile` one at a time (or `batch_size` at a time) without a memory budget, else the largest tiles, at most `tile`, of which at least one (or `batch_size`) fit in the budget, as many as fit per pass."""
+        if img.device.type != "cuda":
+            return self.tile or DEFAULT_TILE, self.batch_size or 1
+        if self.tile is not None and self.memory_budget_mb is None:
+            return self.tile, self.batch_size or 1
+        probe = min(PROBE_TILE // self.multiple * self.multiple or self.multiple, img.shape[2], img.shape[3])
+        torch.cuda.synchronize(img.device)
+        torch.cuda.reset_peak_memory_stats(img.device)
+        base = torch.cuda.memory_allocated(img.device)
+        with torch.no_grad():
+            self.forward(img[..., :probe, :probe])
+        peak = max(torch.cuda.max_memory_allocated(img.device) - base, 1)
+        if self.memory_budget_mb is not None:
+            budget = self.memory_budget_mb * 1024 ** 2
+        else:
+            budget = torch.cuda.mem_get_info(img.device)[0] * FREE_MEMORY_SHARE
+        # memory of a forward pass taken as linear in the number of pixels
+        pixel_bytes = peak / probe ** 2
+        tile = int(math.sqrt(budget / pixel_bytes / (self.batch_size or 1)))
+        tile = max(min(tile, self.tile or MAX_AUTO_TILE) // self.multiple * self.multiple, self.multiple)
+        if self.batch_size is not None:
+            return tile, self.batch_size
+        return tile, int(min(max(budget // (pixel_bytes * tile ** 2), 1), MAX_AUTO_BATCH))
+
+    def _weight(self, size: int, device: torch.device) -> torch.Tensor:
+        """size x size weights of a tile output, positive everywhere so that every output pixel has a weight."""
+        if self.blend == "uniform":
+            return torch.ones(size, size, device=device)
+        coords = torch.arange(size, dtype=torch.float32, device=device) + 0.5
+        if self.blend == "gaussian":
+            sigma = size / 4
+            ramp = torch.exp(-((coords - size / 2) ** 2) / (2 * sigma ** 2))
+        else:
+            feather = max(self.overlap * self.scale, 1)
+            ramp = torch.clamp(torch.minimum(coords, size - coords) / feather, max=1.)
+        ramp = ramp.clamp(min=1e-3)
+        return ramp[:, None] * ramp[None, :]
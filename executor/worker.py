@@ -0,0 +1,389 @@
+"""Warm tool workers. Instead of starting a cold `/venv/{env}/bin/python` for every tool invocation, one long-lived worker per (environment, GPU) runs the `*_4kagent.py` scripts in-process, so that torch and the tool packages are imported once, and the checkpoints loaded by `torch.load` stay resident in an LRU cache with a memory cap. Checkpoints with an up-to-date safetensors copy (see `executor/convert_checkpoints.py`) are memory-mapped from it rather than unpickled.
+
+Scripts calling `cv2.imread` on an input already decoded by the pipeline get it from its memory-mapped raw file (see `utils/image_handle.py`) instead of decoding the PNG again, and PNGs written to the output directory get the compression level of the request, if any (see `Executor.set_png_compression`).
+
+The client side (`WorkerPool`) is imported by the executor. The server side is this very file run as a script by the python of the target environment, hence only the standard library is imported at module level.
+"""
+
+import os
+import sys
+import copy
+import time
+import atexit
+import secrets
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from typing import Callable, Optional
+from collections import OrderedDict
+from multiprocessing.connection import Client, Listener
+
+
+DEFAULT_MAX_CACHE_MB = 8192
+
+
+class WorkerPool:
+    """Spawns and talks to warm workers, one per (environment, GPU id).
+
+    Args:
+        max_cache_mb (int, optional): Memory cap of the checkpoint LRU cache and of the resident models (see `executor/tool_utils/resident_models.py`) in each worker. Defaults to 8192.
+        start_timeout (float, optional): Seconds to wait for a worker to listen. Defaults to 120.
+    """
+
+    def __init__(self, max_cache_mb: int = DEFAULT_MAX_CACHE_MB, start_timeout: float = 120.):
+        self.max_cache_mb = max_cache_mb
+        self.start_timeout = start_timeout
+        self._workers: dict[tuple[str, Optional[int]], "_WorkerHandle"] = {}
+        self._lock = threading.Lock()
+        atexit.register(self.shutdown)
+
+    def run(
+        self, env_name: str, run_gpu_id: Optional[int], script_path: Path, opts: list, cwd: Path,
+        images: Optional[list[dict]] = None, output_dir: Optional[Path] = None, png_compression: Optional[int] = None,
+    ) -> dict[str, float]:
+        """Runs `script_path` with `opts` as `sys.argv[1:]` in the warm worker of `env_name`. `images` are the `ImageStore.raw_spec`s of the inputs mapped by the worker; PNGs written under `output_dir` get the compression level `png_compression` if given. Raises `subprocess.CalledProcessError` if the script fails, like `subprocess.run(..., check=True)` does. Returns the CPU time of the run and the peak RSS of the worker."""
+        with self._lock:
+            key = (env_name, run_gpu_id)
+            worker = self._workers.get(key)
+            if worker is None or not worker.alive:
+                worker = _WorkerHandle(env_name, run_gpu_id, self.max_cache_mb, self.start_timeout)
+                self._workers[key] = worker
+        return worker.request(str(script_path), [str(opt) for opt in opts], str(cwd), {
+            "images": images or [],
+            "output_dir": None if output_dir is None else os.path.realpath(output_dir),
+            "png_compression": png_compression,
+        })
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for worker in self._workers.values():
+                worker.close()
+            self._workers.clear()
+
+
+class _WorkerHandle:
+    def __init__(self, env_name: str, run_gpu_id: Optional[int], max_cache_mb: int, start_timeout: float):
+        self.env_name = env_name
+        self.address = os.path.join(tempfile.mkdtemp(prefix=f"imagent_worker_{env_name}_"), "worker.sock")
+        self.authkey = secrets.token_bytes(16)
+        self._lock = threading.Lock()
+
+        env = os.environ.copy()
+        env["IMAGENT_WORKER_AUTHKEY"] = self.authkey.hex()
+        if run_gpu_id is not None:
+            env["CUDA_VISIBLE_DEVICES"] = str(run_gpu_id)
+        self.process = subprocess.Popen(
+            [f"/venv/{env_name}/bin/python", __file__,
+             "--address", self.address, "--max_cache_mb", str(max_cache_mb)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        deadline = time.time() + start_timeout
+        while not os.path.exists(self.address):
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Worker of environment {env_name} exited with code {self.process.returncode}.")
+            if time.time() > deadline:
+                self.process.kill()
+                raise TimeoutError(f"Worker of environment {env_name} did not start in {start_timeout}s.")
+            time.sleep(0.1)
+        self.conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def request(self, script_path: str, argv: list[str], cwd: str, io_opts: dict) -> dict[str, float]:
+        with self._lock:
+            try:
+                self.conn.send({"script": script_path, "argv": argv, "cwd": cwd, **io_opts})
+                rsp = self.conn.recv()
+            except (EOFError, OSError) as e:
+                raise subprocess.CalledProcessError(
+                    -1, [script_path] + argv, output=f"Worker of environment {self.env_name} died: {e}")
+        if not rsp["ok"]:
+            raise subprocess.CalledProcessError(1, [script_path] + argv, output=rsp["error"])
+        return rsp["usage"]
+
+    def close(self) -> None:
+        if self.alive:
+            try:
+                self.conn.send(None)
+                self.process.wait(timeout=10)
+            except Exception:
+                self.process.kill()
+        try:
+            self.conn.close()
+            os.remove(self.address)
+            os.rmdir(os.path.dirname(self.address))
+        except OSError:
+            pass
+
+
+# ---------------------------------------------------------------------------
+# worker side
+# ---------------------------------------------------------------------------
+
+class _CheckpointCache:
+    """LRU cache of `torch.load` results keyed on (path, mtime, map_location), capped by the total size of the tensors in them, those of modules included.
+
+    Every load returns a copy of the cached checkpoint, so that scripts can edit what they get: containers are copied at every level (callers often pop keys like `params_ema`) and modules or other objects are deep-copied (e.g. `.half()` or `.cuda()` in place). Tensors in containers are shared with the cache, as scripts only read them into their models.
+    """
+
+    def __init__(self, max_bytes: int, reserved_bytes: Callable[[], int] = lambda: 0):
+        self.max_bytes = max_bytes
+        # bytes of the cap taken by others, i.e. the resident models (see `executor/tool_utils/resident_models.py`)
+        self.reserved_bytes = reserved_bytes
+        self._entries: OrderedDict[tuple, tuple[object, int]] = OrderedDict()
+        self._n_bytes = 0
+
+    def install(self) -> None:
+        import torch
+
+        original_load = torch.load
+
+        def cached_load(f, map_location=None, *args, **kwargs):
+            if args or not isinstance(f, (str, os.PathLike)) or not os.path.isfile(f):
+                return original_load(f, map_location, *args, **kwargs)
+            key = (os.path.realpath(f), os.path.getmtime(f), repr(map_location), repr(sorted(kwargs.items())))
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._copy(self._entries[key][0], torch)
+            obj = original_load(f, map_location, **kwargs)
+            if self._put(key, obj, self._sizeof(obj, torch)):
+                return self._copy(obj, torch)
+            return obj
+
+        torch.load = cached_load
+
+    def _put(self, key: tuple, obj: object, n_bytes: int) -> bool:
+        """Caches `obj` unless it is larger than what the cap leaves. Returns whether it was cached."""
+        if n_bytes > self.max_bytes - self.reserved_bytes():
+            return False
+        self._entries[key] = (obj, n_bytes)
+        self._n_bytes += n_bytes
+        self.trim()
+        return True
+
+    def trim(self) -> None:
+        """Drops the least recently used checkpoints until they fit in what the cap leaves."""
+        max_bytes = self.max_bytes - self.reserved_bytes()
+        while self._entries and self._n_bytes > max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self._n_bytes -= evicted_bytes
+
+    def _sizeof(self, obj: object, torch) -> int:
+        if isinstance(obj, torch.Tensor):
+            return obj.element_size() * obj.nelement()
+        if isinstance(obj, torch.nn.Module):
+            return sum(self._sizeof(v, torch) for v in obj.state_dict().values())
+        if isinstance(obj, dict):
+            return sum(self._sizeof(v, torch) for v in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return sum(self._sizeof(v, torch) for v in obj)
+        return 0
+
+    def _copy(self, obj: object, torch) -> object:
+        if isinstance(obj, (torch.Tensor, str, bytes, int, float, bool, type(None))):
+            return obj
+        if isinstance(obj, dict) and type(obj) in (dict, OrderedDict):
+            copied = type(obj)((k, self._copy(v, torch)) for k, v in obj.items())
+            # state dicts carry the versions of their modules
+            if hasattr(obj, "_metadata"):
+                copied._metadata = copy.deepcopy(obj._metadata)
+            return copied
+        if type(obj) in (list, tuple):
+            return type(obj)(self._copy(v, torch) for v in obj)
+        return copy.deepcopy(obj)
+
+
+class _SpooledImageReader:
+    """Serves `cv2.imread(path)` with the default flags from the raw file of `path` listed by the client, as long as the PNG is the one the raw file was decoded from. Anything else goes to the original `cv2.imread`."""
+
+    def __init__(self):
+        self.images: dict[str, dict] = {}
+
+    def install(self) -> None:
+        import cv2
+        import numpy as np
+
+        original_imread = cv2.imread
+
+        def spooled_imread(filename, flags=cv2.IMREAD_COLOR):
+            spec = self.images.get(os.path.realpath(filename)) if isinstance(filename, (str, os.PathLike)) else None
+            if spec is not None and flags == cv2.IMREAD_COLOR:
+                try:
+                    st = os.stat(filename)
+                    if [st.st_mtime_ns, st.st_size] == spec["stat"]:
+                        # scripts may write into the image they read
+                        return np.array(np.load(spec["raw_path"], mmap_mode="r"))
+                except (OSError, ValueError):
+                    pass  # evicted by the client meanwhile
+            return original_imread(filename, flags)
+
+        cv2.imread = spooled_imread
+
+
+class _PNGCompression:
+    """Imposes `level` on the PNGs written by `cv2.imwrite` and `PIL.Image.Image.save` under `output_dir`. OpenCV's default (level 1 with run-length encoding) is its fastest setting, so level 1 drops the compression asked by the script rather than setting it."""
+
+    def __init__(self):
+        self.output_dir: Optional[str] = None
+        self.level: Optional[int] = None
+
+    def applies(self, filename) -> bool:
+        if self.level is None or self.output_dir is None or not isinstance(filename, (str, os.PathLike)):
+            return False
+        path = os.path.realpath(filename)
+        return path.lower().endswith(".png") and path.startswith(self.output_dir + os.sep)
+
+    def install(self) -> None:
+        try:
+            import cv2
+        except ImportError:
+            pass
+        else:
+            original_imwrite = cv2.imwrite
+
+            def imwrite(filename, img, params=None):
+                if self.applies(filename):
+                    kept = []
+                    for key, value in zip(list(params or [])[::2], list(params or [])[1::2]):
+                        if key != cv2.IMWRITE_PNG_COMPRESSION:
+                            kept += [key, value]
+                    params = kept
+                    if self.level != 1:
+                        params += [cv2.IMWRITE_PNG_COMPRESSION, self.level]
+                return original_imwrite(filename, img, params) if params else original_imwrite(filename, img)
+
+            cv2.imwrite = imwrite
+
+        try:
+            from PIL import Image
+        except ImportError:
+            pass
+        else:
+            original_save = Image.Image.save
+
+            def save(img, fp, format=None, **params):
+                if self.applies(fp) and (format is None or format.upper() == "PNG"):
+                    params.pop("optimize", None)  # forces level 9
+                    params["compress_level"] = self.level
+                return original_save(img, fp, format, **params)
+
+            Image.Image.save = save
+
+
+def _purge_tool_modules(tool_dir: str) -> None:
+    """Tools vendor packages with the same name (e.g. several versions of `basicsr`), so modules imported from the previous tool's directory are dropped before running a script from another one. Site packages such as torch stay imported."""
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, "__file__", None)
+        if module_file and os.path.realpath(module_file).startswith(tool_dir + os.sep):
+            del sys.modules[name]
+
+
+def _is_out_of_memory(e: BaseException, torch) -> bool:
+    oom_error = getattr(torch.cuda, "OutOfMemoryError", None)
+    return (oom_error is not None and isinstance(e, oom_error)) or "out of memory" in str(e)
+
+
+def _run_script(script: str, argv: list[str], cwd: str) -> None:
+    import runpy
+
+    script_dir = os.path.dirname(script)
+    sys.argv = [script] + argv
+    sys.path[0] = script_dir
+    os.chdir(cwd)
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise
+
+
+def _serve(address: str, max_cache_mb: int) -> None:
+    import gc
+    import resource
+    import traceback
+
+    checkpoint_cache = None
+    try:
+        import torch
+    except ImportError:
+        torch = None
+    else:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "tool_utils"))
+        from checkpoint_loading import install as install_safetensors_loading
+        # the module the scripts import, from the same directory
+        import resident_models
+        sys.path.pop()
+        # checkpoints with an up-to-date safetensors copy are memory-mapped instead of unpickled, under the checkpoint cache
+        install_safetensors_loading()
+        # the resident models count against the cap, and push the checkpoints out of the cache
+        resident_models.set_memory_budget(max_cache_mb * 1024 ** 2)
+        checkpoint_cache = _CheckpointCache(max_cache_mb * 1024 ** 2, reserved_bytes=resident_models.resident_bytes)
+        checkpoint_cache.install()
+    image_reader = _SpooledImageReader()
+    try:
+        image_reader.install()
+    except ImportError:
+        pass
+    png_compression = _PNGCompression()
+    png_compression.install()
+
+    authkey = bytes.fromhex(os.environ.pop("IMAGENT_WORKER_AUTHKEY"))
+    base_sys_path = list(sys.path)
+    last_cwd: Optional[str] = None
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        with listener.accept() as conn:
+            while True:
+                try:
+                    req = conn.recv()
+                except EOFError:
+                    break
+                if req is None:
+                    break
+
+                cwd = os.path.realpath(req["cwd"])
+                if last_cwd is not None and cwd != last_cwd:
+                    _purge_tool_modules(last_cwd)
+                last_cwd = cwd
+                sys.path[:] = base_sys_path
+                image_reader.images = {spec["path"]: spec for spec in req.get("images", [])}
+                png_compression.output_dir, png_compression.level = req.get("output_dir"), req.get("png_compression")
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                try:
+                    _run_script(req["script"], req["argv"], cwd)
+                    rsp = {"ok": True, "error": None}
+                except BaseException as e:
+                    rsp = {"ok": False, "error": traceback.format_exc()}
+                    if torch is not None and _is_out_of_memory(e, torch):
+                        # the next scripts get the GPU memory of the resident models back
+                        resident_models.release_all()
+                finally:
+                    image_reader.images = {}
+                    png_compression.level = None
+                    if checkpoint_cache is not None:
+                        checkpoint_cache.trim()
+                    gc.collect()
+                    if torch is not None and torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                usage_after = resource.getrusage(resource.RUSAGE_SELF)
+                rsp["usage"] = {
+                    "cpu_s": usage_after.ru_utime + usage_after.ru_stime - usage.ru_utime - usage.ru_stime,
+                    "peak_rss_mb": usage_after.ru_maxrss / 1024,
+                }
+                conn.send(rsp)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Warm tool worker")
+    parser.add_argument("--address", type=str, required=True, help="Path of the unix socket to listen on")
+    parser.add_argument("--max_cache_mb", type=int, default=DEFAULT_MAX_CACHE_MB, help="Memory cap of the checkpoint cache")
+    args = parser.parse_args()
+    # the script is run as `python executor/worker.py`, keep the executor package out of the tools' import path
+    sys.path.pop(0)
+    sys.path.insert(0, "")
+    _serve(args.address, args.max_cache_mb)
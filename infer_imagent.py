@@ -5,6 +5,8 @@ import argparse
 from pathlib import Path
 
 from pipeline.imagent_pipeline import Imagent
+from pipeline.imagent_session import ImagentSession
+from pipeline.runners import BatchRunner, PipelinedRunner
 from utils.custom_types import *
 
 
@@ -14,6 +16,8 @@ def parse_args():
     parser.add_argument("--output_dir", type=str, default="./outputs/LQ_results", help="Path to the output directory")
     parser.add_argument("--profile_name", type=str, default="", help="Profile Name for the Imagent")
     parser.add_argument("--tool_run_gpu_id", type=int, default=0, help="GPU ID to run tools the toolbox")
+    parser.add_argument("--batch", action="store_true", help="Plan all images with one load of the perception VLM before executing the plans")
+    parser.add_argument("--pipeline", action="store_true", help="Overlap the perception, tools and reflection of consecutive images")
     return parser.parse_args()
 
 
@@ -34,6 +38,9 @@ def main():
         print(f"No images found in {input_dir}")
         return
 
+    session = ImagentSession(profile_name=profile_name, with_retrieval=True, silent=False)
+
+    pending = []
     for image_path in images:
         print(f"\n[Checking]: {image_path.name}")
 
@@ -43,22 +50,48 @@ def main():
         if result_png_candidates:
             print(f"[Skip] Already processed: {image_path.name}")
             continue
+        pending.append(image_path)
 
+    if args.pipeline:
+        failed = PipelinedRunner(
+            session,
+            output_dir,
+            with_reflection=True,
+            silent=False,
+            tool_run_gpu_id=tool_run_gpu_id,
+        ).run(pending)
+        if failed:
+            print(f"[Failed] {', '.join(p.name for p in failed)}")
+        return
+
+    if args.batch:
+        BatchRunner(
+            session,
+            output_dir,
+            with_reflection=True,
+            silent=False,
+            tool_run_gpu_id=tool_run_gpu_id,
+        ).run(pending)
+        return
+
+    for image_path in pending:
+        image_output_dir = output_dir / image_path.stem
         image_output_dir.mkdir(parents=True, exist_ok=True)
 
-        print(f"[Processing] {image_path.name}")
         print(f"[Processing] {image_path.name}")
         agent = Imagent(
             input_path=image_path,
             output_dir=image_output_dir,
-            with_retrieval=True,
             with_reflection=True,
             silent=False,
             tool_run_gpu_id=tool_run_gpu_id,
-            profile_name=profile_name
+            session=session,
         )
 
-        agent.run()
+        agent.prepare()
+        # frees the GPU for the tools, as an unshared session does
+        session.release_perception_agent()
+        agent.execute()
         gc.collect()
         torch.cuda.empty_cache()
 
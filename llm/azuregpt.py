@@ -42,11 +42,7 @@ class AzureGPT(BaseLLM):
         self.completion_tokens = 0
 
         self.system_message = system_message
-        if self.system_message is not None:
-            self._log("_Note: These user-assistant interactions are independent "
-                      "and the system message is always attached in each turn for GPT._")
-            self._log("**System message for GPT**")
-            self._log(self.system_message)
+        self.log_system_message()
         
         self.endpoint = os.getenv("ENDPOINT_URL", self.endpoint)
         self.deployment = os.getenv("DEPLOYMENT_NAME", self.model)  
@@ -57,6 +53,13 @@ class AzureGPT(BaseLLM):
             api_version=self.api_version,
         )
 
+    def log_system_message(self) -> None:
+        if self.system_message is not None:
+            self._log("_Note: These user-assistant interactions are independent "
+                      "and the system message is always attached in each turn for GPT._")
+            self._log("**System message for GPT**")
+            self._log(self.system_message)
+
     def query(self,
               img_path_lst: Optional[list[Path]] = None,
               prompt: str = "",
@@ -67,6 +67,10 @@ class BaseLLM:
     def _post_process(self):
         pass
 
+    def log_system_message(self) -> None:
+        """Logs the system message, if any. Called on construction, and again by owners that redirect `logger` to a new log."""
+        pass
+
     def _log_chat(self,
                   prompt: str,
                   img_base64_lst: list[str],
@@ -40,6 +40,9 @@ class GPT4(BaseLLM):
         self.completion_tokens = 0
 
         self.system_message = system_message
+        self.log_system_message()
+
+    def log_system_message(self) -> None:
         if self.system_message is not None:
             self._log("_Note: These user-assistant interactions are independent "
                       "and the system message is always attached in each turn for GPT._")
@@ -54,8 +54,7 @@ class LlamaVisionAgent(BaseLLM):
         self.seed = seed
         assert self.perception_agent_system_message is not None, "System message must be provided."
 
-        self._log("**System message for Perception VLM Agent**")
-        self._log(self.perception_agent_system_message)
+        self.log_system_message()
 
         self.degradation_to_task = {
             "noise": "denoising",
@@ -67,6 +66,10 @@ class LlamaVisionAgent(BaseLLM):
             "jpeg compression artifact": "jpeg compression artifact removal",
         }
 
+    def log_system_message(self) -> None:
+        self._log("**System message for Perception VLM Agent**")
+        self._log(self.perception_agent_system_message)
+
     @torch.no_grad()
     def load_agent(self):
         model = MllamaForConditionalGeneration.from_pretrained(
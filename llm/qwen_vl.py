@@ -109,8 +109,7 @@ class PerceptionVLMAgent(BaseLLM):
         self.perception_agent_system_message = system_message
         self.seed = seed
 
-        self._log("**System message for Perception VLM Agent**")
-        self._log(self.perception_agent_system_message)
+        self.log_system_message()
 
         self.degradation_to_task = {
             "noise": "denoising",
@@ -122,6 +121,10 @@ class PerceptionVLMAgent(BaseLLM):
             "jpeg compression artifact": "jpeg compression artifact removal",
         }
 
+    def log_system_message(self) -> None:
+        self._log("**System message for Perception VLM Agent**")
+        self._log(self.perception_agent_system_message)
+
     @torch.no_grad()
     def load_verifier(self):
         model = Qwen2_5_VLForConditionalGeneration.from_pretrained(MODEL_ID)
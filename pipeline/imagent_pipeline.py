@@ -5,33 +5,47 @@ import json
 import shutil
 import random
 import logging
-from time import localtime, strftime
+import traceback
+from time import localtime, strftime, time
 from pathlib import Path
 from typing import Union, Optional
+from dataclasses import dataclass, field
 
 import torch
+import numpy as np
 from PIL import Image
 
 from . import prompts
-from executor import executor, Tool
-from llm import GPT4, AzureGPT, DepictQA, PerceptionVLMAgent, LlamaVisionAgent
+from executor import Tool, ToolJob, ToolPool, ToolDispatcher
+from executor.output_cache import content_hash
 
 from utils.img_tree import ImgTree
+from utils.image_handle import ImageHandle, image_store
 from utils.logger import get_logger
 from utils.misc import sorted_glob
 from utils.custom_types import *
 from utils.restore_profile import *
 from utils.expert_IQA_eval import compute_iqa, compute_iqa_metric_score, compute_iqa_metric_score_batch
-from utils.expert_face_score import compute_face_scores
+from utils.face_align import project_landmarks, refine_landmarks, paste_faces
 from utils.color_fix import (
-    adain_color_fix,
-    wavelet_color_fix,
-    cv2_to_pil,
-    pil_to_cv2,
+    adain_color_fix_array,
+    wavelet_color_fix_array,
 )
-from facexlib.utils.face_restoration_helper import FaceRestoreHelper
-from utils.scorer import calculate_cos_dist, calculate_niqe
-from .profile_loader import load_profile_config
+from utils.scorer import calculate_niqe
+from .imagent_session import ImagentSession
+
+
+@dataclass
+class SubtaskStep:
+    """Outputs of the tools of a subtask, passed from `Imagent.run_subtask_tools` to `Imagent.reflect_on_subtask`."""
+    subtask: Subtask
+    input_img: ImageHandle  # decoded input, for the proxy and the color fix
+    candidates: list[Path] = field(default_factory=list)
+    best_tool_name: Optional[ToolName] = None  # set without reflection
+
+
+# max side of the thumbnails kept for the pruned candidates, see `RetentionPolicy`
+THUMBNAIL_MAX_SIDE = 256
 
 
 TOOL_DESCRIPTIONS = {
@@ -69,6 +83,7 @@ class Imagent:
         reflect_by (str, optional): The method of reflection on results of tools, "depictqa" or "gpt4v". Defaults to "depictqa".
         with_rollback (bool, optional): Whether to roll back when failing in one subtask. Defaults to True.
         silent (bool, optional): Whether to suppress the console output. Defaults to False.
+        session (ImagentSession | None, optional): Loaded components shared with other runs, see `ImagentSession`. `profile_name`, `llm_config_path`, `with_retrieval` and `schedule_experience_path` are taken from the session if given. Defaults to None, i.e. a private session.
     """
 
     def __init__(
@@ -84,7 +99,21 @@ class Imagent:
         tool_run_gpu_id: Optional[int] = None,
         perception_agent_run_gpu_id: Optional[int] = None,
         profile_name: Optional[str] = None,
+        session: Optional[ImagentSession] = None,
     ) -> None:
+        if session is None:
+            session = ImagentSession(
+                profile_name=profile_name,
+                llm_config_path=llm_config_path,
+                with_retrieval=with_retrieval,
+                schedule_experience_path=schedule_experience_path,
+                silent=silent,
+            )
+            self._owns_session = True
+        else:
+            with_retrieval = session.schedule_experience is not None
+            self._owns_session = False
+        self.session = session
         # paths
         self._prepare_dir(input_path, output_dir)
         # state
@@ -95,10 +124,9 @@ class Imagent:
             with_reflection,
             # with_rollback,
             tool_run_gpu_id,
-            profile_name
         )
         # components
-        self._create_components(llm_config_path, schedule_experience_path, silent)
+        self._create_components(silent)
         # constants
         self._set_constants()
         
@@ -114,6 +142,14 @@ class Imagent:
             ]},
             "execution_path": {"subtasks": [], "tools": []},
             "n_invocations": 0,
+            # runs on the downscaled proxies of `_prune_by_proxy`, not counted in `n_invocations`
+            "n_proxy_invocations": 0,
+            "tool_failures": [
+                # {"subtask": ..., "tool": ..., "input": ..., "error": ..., "proxy": ...}
+            ],
+            "skipped_subtasks": [
+                # {"subtask": ..., "input": ...}, subtasks whose tools all failed, see `_on_all_tools_failed`
+            ],
             "tree": {
                 "img_path": str(self.img_tree_dir / "0-img" / "input.png"),
                 "best_descendant": None,
@@ -126,6 +162,7 @@ class Imagent:
                     #             "severity": ...,
                     #             "img_path": ...,
                     #             "best_descendant": ...,
+                    #             "pruned": ...,  # image deleted by the retention policy
                     #             "children": {...}
                     #         },
                     #         ...
@@ -135,8 +172,18 @@ class Imagent:
             },
         }
         self.cur_node = self.work_mem["tree"]
+        # img_path -> node of work_mem["tree"]
+        self._work_mem_nodes: dict[str, dict] = {self.cur_node["img_path"]: self.cur_node}
+        # (img_path, subtask) whose tools all failed, see `_on_all_tools_failed`
+        self._all_tools_failed: set[tuple[str, Subtask]] = set()
         self.image_description = ""
         self.face_list = []
+        # landmarks of the faces of `face_list` and shape of the image they were detected on
+        self.face_landmarks: list[np.ndarray] = []
+        self.face_src_shape: Optional[tuple[int, ...]] = None
+        self._execute_start: Optional[float] = None
+        # content hash -> tool outputs with this content, hard-linked to each other
+        self._outputs_by_hash: dict[str, list[Path]] = {}
         
 
     def _config(
@@ -145,11 +192,10 @@ class Imagent:
         with_reflection: bool,
         # with_rollback: bool,
         tool_run_gpu_id: Optional[int],
-        profile_name: Optional[str] = None,
     ) -> None:
         # extract profile
-        self.profile_name = profile_name or "FastGen4K_P"
-        self.profile = load_profile_config(self.profile_name)
+        self.profile_name = self.session.profile_name
+        self.profile = self.session.profile
         
         # evaluator
         self.evaluate_degradation_by = self.profile.get("PerceptionAgent", "llama_vision")
@@ -169,6 +215,8 @@ class Imagent:
         
         # face restoration
         self.face_restoration = self.profile.get("FaceRestore", False)
+        # locate the faces of the upscaled image from those of the input instead of detecting them on the whole image
+        self.face_reuse_detections = self.profile.get("FaceReuseDetections", False)
         # old photo restoration
         self.old_photo_restoration = self.profile.get("OldPhotoRestoration", False)
         # other degradation
@@ -189,14 +237,23 @@ class Imagent:
         
         self.fast_4k = self.profile.get("Fast4K", False)
         self.fast4k_side_thres = self.profile.get("Fast4kSideThres", 1024)
+
+        # per-image latency budget of the plan, enforced with the tool cost model
+        self.latency_budget = self.profile.get("LatencyBudgetSeconds", None)
+
+        # coarse-to-fine pruning of the toolbox on a downscaled proxy
+        self.proxy_top_k = self.profile.get("ProxyTopK", None)
+        self.proxy_max_side = self.profile.get("ProxyMaxSide", 512)
+
+        # what is kept of the candidates that lose the reflection: everything, a thumbnail, or nothing
+        self.retention = self.profile.get("RetentionPolicy", "all")
+        assert self.retention in {"all", "thumbnails", "best_path"}, f"Invalid retention policy: {self.retention}."
         
         self.project_root = Path(__file__).resolve().parent.parent # 4kagent dir path
         
         
     def _create_components(
         self,
-        llm_config_path: Path,
-        schedule_experience_path: Optional[Path],
         silent: bool,
     ) -> None:
         # logging setup
@@ -216,63 +273,30 @@ class Imagent:
             silent=silent,
         )
 
-        # perception agent
-        print(f"[Evaluation VLM] model: {self.evaluate_degradation_by}")
-        if self.evaluate_degradation_by in {"vlmagent", "depictqa"}:
-            self.perception_agent = PerceptionVLMAgent(
-                seed=self.perception_agent_seed,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.updated_perception_system_message,
-            )
-        elif self.evaluate_degradation_by == "llama_vision":
-            self.perception_agent = LlamaVisionAgent(
-                seed=self.perception_agent_seed,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.updated_perception_system_message,
-            )
-        
-        # language models
-        self.gpt4 = GPT4(
-            config_path=llm_config_path,
-            logger=self.qa_logger,
-            silent=silent,
-            system_message=prompts.system_message,
-        )
-        # self.gpt4 = AzureGPT(
-        #     config_path=llm_config_path,
-        #     logger=self.qa_logger,
-        #     silent=silent,
-        #     system_message=prompts.system_message,
-        # )
-        
-        self.depictqa = None
-        if self.evaluate_degradation_by == "depictqa" or self.reflect_by == "depictqa":
-            self.depictqa = DepictQA(logger=self.qa_logger, silent=silent)
-
-        # face restore
-        self.face_helper = FaceRestoreHelper(
-            upscale_factor=1,
-            face_size=512,
-            crop_ratio=(1, 1),
-            det_model='retinaface_resnet50',
-            save_ext='png',
-            use_parse=True,
-            model_rootpath=str(self.project_root / "executor/face_restoration/tools/GFPGAN/gfpgan/weights") # Checkpoints will be downloaded automatically
-        )
-        
-        # experience
-        if self.with_retrieval:
-            assert schedule_experience_path is not None, "Experience should be provided."
-            with open(schedule_experience_path, "r") as f:
-                self.schedule_experience: str = json.load(f)["distilled"]
-
-        # executor
-        self.executor = executor
+        # loaded components, shared by the runs of the session
+        self.session.bind_logger(self.qa_logger)
+        self.gpt4 = self.session.gpt4
+        self.depictqa = self.session.depictqa
+        self.reflection_scorer = self.session.reflection_scorer
+        self.face_scorer = self.session.face_scorer
+        self.schedule_experience = self.session.schedule_experience
+        self.executor = self.session.executor
+        self.tool_pool = self.session.tool_pool
+        self.serial_tool_pool = self.session.serial_tool_pool
+        self.tool_dispatcher = self.session.tool_dispatcher
         
         #
         random.seed(0)
+        # private generator, runners may interleave the steps of several images
+        self._rng = random.Random(0)
+        
+    @property
+    def perception_agent(self):
+        return self.session.perception_agent
+
+    @property
+    def face_helper(self):
+        return self.session.face_helper
         
         
     def _set_constants(self) -> None:
@@ -298,6 +322,12 @@ class Imagent:
     
 
     def run(self, plan: Optional[list[Subtask]] = None, cache: Optional[Path] = None) -> None:
+        self.prepare(plan)
+        self.execute(cache)
+
+    def prepare(self, plan: Optional[list[Subtask]] = None) -> None:
+        """Everything before the execution of the plan: old photo restoration and the initial plan (`plan` if given, otherwise the user-defined or proposed one)."""
+        self.session.bind_logger(self.qa_logger)
         self.workflow_logger.info(f"Đang chạy Imagent với cấu hình: {self.profile_name}")
         self.workflow_logger.info(f"Phục hồi khuôn mặt: {self.face_restoration}")
         self.workflow_logger.info(f"Làm sáng ảnh: {self.brightening}")
@@ -316,6 +346,8 @@ class Imagent:
                 run_gpu_id=self.tool_run_gpu_id
             )
             self.cur_node["img_path"] = str(opr_output_dir / "output.png")
+            self._work_mem_nodes[self.cur_node["img_path"]] = self.cur_node
+            self.img_tree.add(opr_output_dir / "output.png")
             self.executor._executed_subtask_cnt = 0
 
         if plan is not None:
@@ -325,45 +357,38 @@ class Imagent:
             self.workflow_logger.info(f"Kế hoạch: {self.plan}")
         else:
             self.propose()
-        
+        self._fixed_plan = plan is not None
+
+    def execute(self, cache: Optional[Path] = None) -> None:
+        """Executes the plan set by `prepare` and records the result."""
+        self.session.bind_logger(self.qa_logger)
+        self._execute_start = time()
         while self.plan:
-            success = self.execute_subtask(cache)
-            if plan is None and self.with_rollback and not success:
-                self.roll_back()
-                self.reschedule()
-        
-        ### parallel computing
-        ### TODO: we need to implement self.execute_subtask_distributed function
-        # proposed_full_plan = self.plan.copy()
-        # sr_subtasks = {"super-resolution", "super-resolution_2x"}
-        # sr_index = next((i for i, subtask in enumerate(proposed_full_plan) if subtask in sr_subtasks), -1)
-        # if sr_index == 0:
-        #     while self.plan:
-        #         success = self.execute_subtask(cache)
-        #         if plan is None and self.with_rollback and not success:
-        #             self.roll_back()
-        #             self.reschedule()
-        # elif sr_index > 0:
-        #     for _ in range(sr_index):
-        #         success = self.execute_subtask_distributed(cache)
-        #         if not success and self.with_rollback:
-        #             self.roll_back()
-        #             self.reschedule()
-        #     while self.plan:
-        #         success = self.execute_subtask(cache)
-        #         if self.plan is None and self.with_rollback and not success:
-        #             self.roll_back()
-        #             self.reschedule()
-        # else:
-        #     while self.plan:
-        #         success = self.execute_subtask_distributed(cache)
-        #         if self.plan is None and self.with_rollback and not success:
-        #             self.roll_back()
-        #             self.reschedule()
+            if self.distributable():
+                success = self.execute_subtask_distributed(cache)
+            else:
+                success = self.execute_subtask(cache)
+            if not success:
+                self.recover_from_failure()
         
+        self.finish()
+
+    def finish(self) -> None:
+        """Records the result of the executed plan: the execution path, the summary and `result.png`. Called by `execute` once the plan is done, or by runners executing the plan themselves."""
         self._record_res()
         
 
+    def recover_from_failure(self) -> None:
+        """Rolls back and reschedules after a failed subtask, unless the plan was given to `prepare` or rollback is disabled."""
+        if self._fixed_plan or not self.with_rollback:
+            return
+        self.roll_back()
+        # the VLMs read the file of the node rolled back to
+        image_store.flush(self.cur_node["img_path"])
+        with self.session.perception_lock:
+            self.reschedule()
+
+
     def propose(self) -> None:
         """Sets the initial plan."""
         agenda = []
@@ -385,7 +410,7 @@ class Imagent:
             for task in explicit_tasks:
                 assert task in self.degra_subtask_dict.values(), f"Invalid task: {task}"
                 if task == "super-resolution":
-                    img_shape = cv2.imread(self.cur_node["img_path"]).shape[:2]
+                    img_shape = image_store.open(self.cur_node["img_path"]).shape[:2]
                     target_factor = self.get_target_factor(img_shape)
                     self.workflow_logger.info(f"Hệ số phóng đại mục tiêu: {target_factor}")
                     if target_factor > 1:
@@ -409,6 +434,8 @@ class Imagent:
 
         if self.face_restoration or 'face restoration' in agenda:
             self.face_list = self.extract_face(self.cur_node["img_path"], self.faces_dir)
+            self.face_landmarks = [landmark.copy() for landmark in self.face_helper.all_landmarks_5]
+            self.face_src_shape = image_store.open(self.cur_node["img_path"]).shape
             self.face_helper.clean_all()
             agenda = [task for task in agenda if task != 'face restoration']
 
@@ -421,16 +448,23 @@ class Imagent:
         self.workflow_logger.info(f"Plan: {plan}")
         self.plan = plan
 
-        if hasattr(self, 'perception_agent'):
-            del self.perception_agent
-        gc.collect()
-        torch.cuda.empty_cache()
+        # a shared session keeps the perception VLM for the next images, the owner of the session releases it
+        if self._owns_session:
+            self.session.release_perception_agent()
 
 
-    def extract_face(self, input_path: Union[Path, str], res_path) -> None:
+    def extract_face(
+        self, input_path: Union[Path, str], res_path: Path, landmarks: Optional[list[np.ndarray]] = None
+    ) -> list[str]:
+        """Detects and aligns the faces of the image, and writes them to `res_path / face_{idx:03d} / face.png`. With `landmarks`, the faces are aligned on them and not detected."""
         in_path = str(input_path.resolve()) if isinstance(input_path, Path) else input_path
-        self.face_helper.read_image(in_path)
-        self.face_helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+        if landmarks is None:
+            self.face_helper.read_image(image_store.read(in_path))
+            self.face_helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+        else:
+            # only read by the alignment, no need for a copy
+            self.face_helper.input_img = image_store.open(in_path).array
+            self.face_helper.all_landmarks_5 = landmarks
         self.face_helper.align_warp_face()
 
         face_paths = []
@@ -490,7 +524,7 @@ class Imagent:
 
     def extract_agenda(self, evaluation: Union[list[tuple[Degradation, Level]], list[Degradation]]) -> list[Subtask]:
         agenda = []
-        img_shape = cv2.imread(self.cur_node["img_path"]).shape[:2]
+        img_shape = image_store.open(self.cur_node["img_path"]).shape[:2]
 
         # Determine the target upscaling factor (allowed values: 1, 2, 4, 8, 16; where 1 means no SR task).
         target_factor = self.get_target_factor(img_shape)
@@ -510,14 +544,14 @@ class Imagent:
             agenda = [self.degra_subtask_dict[deg] for deg in evaluation]
             if target_factor > 1:
                 agenda.extend(_append_sr_tasks(target_factor))
-            random.shuffle(agenda)
+            self._rng.shuffle(agenda)
         else:
             for degradation, severity in evaluation:
                 if self.levels.index(severity) >= 2:  # "medium" or higher
                     agenda.append(self.degra_subtask_dict[degradation])
             if target_factor > 1:
                 agenda.extend(_append_sr_tasks(target_factor))
-            random.shuffle(agenda)
+            self._rng.shuffle(agenda)
         
         return agenda
 
@@ -783,8 +817,8 @@ class Imagent:
         return schedule["order"]
 
 
-    def tool_selection(self, subtask: Subtask, toolbox: list[Tool], max_side: int) -> list[Tool]:
-        """Select appropriate tools from toolbox based on profile, subtask, and resolution."""
+    def tool_selection(self, subtask: Subtask, toolbox: list[Tool], max_side: int, n_pixels: Optional[int] = None) -> list[Tool]:
+        """Select appropriate tools from toolbox based on profile, subtask, and resolution (and the latency budget, if any)."""
 
         def get_baseline_tools(subtask: str) -> list[str]:
             baseline_mapping = {
@@ -825,12 +859,63 @@ class Imagent:
         else:
             updated_toolbox = toolbox
 
+        if self.latency_budget is not None:
+            return self._fit_toolbox_to_budget(subtask, updated_toolbox, n_pixels or max_side ** 2)
+
         # Fast mode filtering
         if "Fast" in self.profile_name and "super-resolution" in subtask and max_side >= self.fast4k_side_thres:
             self.workflow_logger.info("Chế độ nhanh: chỉ giữ lại các tool xử lý nhanh (cho super-resolution)")
             updated_toolbox = [tool for tool in updated_toolbox if tool.tool_name != 'diffbir']
 
         return updated_toolbox
+
+
+    def _fit_toolbox_to_budget(self, subtask: Subtask, toolbox: list[Tool], n_pixels: int) -> list[Tool]:
+        """Drops the slowest tools, as predicted by the cost model of `executor.stats_store`, until the predicted time of this subtask fits its share of what is left of `LatencyBudgetSeconds`. The share is proportional to the predicted time of this subtask among the subtasks left in the plan. Tools that never ran are kept (and thus measured); at least one tool is kept."""
+        stats = self.executor.stats_store
+        if stats is None:
+            return toolbox
+        if self._execute_start is None:
+            self._execute_start = time()
+        remaining = self.latency_budget - (time() - self._execute_start)
+
+        this_cost = self._predict_toolbox_seconds(toolbox, n_pixels)
+        later_cost, later_pixels = 0., n_pixels * self._pixel_factor(subtask)
+        for later_subtask in self.plan:
+            later_cost += self._predict_toolbox_seconds(self.executor.toolbox_router[later_subtask], later_pixels)
+            later_pixels *= self._pixel_factor(later_subtask)
+        allowance = remaining * this_cost / (this_cost + later_cost) if this_cost > 0 else remaining
+
+        costs = {tool.tool_name: stats.predict_seconds(tool.tool_name, n_pixels) for tool in toolbox}
+        kept = list(toolbox)
+        dropped = []
+        for tool in sorted((tool for tool in toolbox if costs[tool.tool_name] is not None),
+                           key=lambda tool: costs[tool.tool_name], reverse=True):
+            if len(kept) == 1 or self._predict_toolbox_seconds(kept, n_pixels) <= allowance:
+                break
+            kept.remove(tool)
+            dropped.append(tool.tool_name)
+        self.workflow_logger.info(
+            f"Latency budget: {allowance:.1f}s for {subtask} ({remaining:.1f}s left for the plan), "
+            f"predicted {self._predict_toolbox_seconds(kept, n_pixels):.1f}s"
+            + (f", dropping {dropped}." if dropped else "."))
+        return kept
+
+
+    def _predict_toolbox_seconds(self, toolbox: list[Tool], n_pixels: int) -> float:
+        """Predicted wall time of running `toolbox`, spread over the workers of the tool pool. Tools that never ran count as free."""
+        costs = [self.executor.stats_store.predict_seconds(tool.tool_name, n_pixels) for tool in toolbox]
+        n_workers = min(self.tool_pool.max_workers, len(toolbox)) if self.tool_pool is not None and toolbox else 1
+        return sum(cost for cost in costs if cost is not None) / n_workers
+
+
+    @staticmethod
+    def _pixel_factor(subtask: Subtask) -> int:
+        if subtask == "super-resolution":
+            return 16
+        if subtask == "super-resolution_2x":
+            return 4
+        return 1
                 
 
     def execute_subtask(self, cache: Optional[Path]) -> bool:
@@ -859,16 +944,46 @@ class Imagent:
         ```
         """
 
+        return self.reflect_on_subtask(self.run_subtask_tools(cache))
+
+
+    def execute_subtask_distributed(self, cache: Optional[Path]) -> bool:
+        """`execute_subtask` with the tools run on the tool executors of `self.tool_dispatcher` (see `executor/dispatcher.py`) rather than on this host. Outputs land in the same directory layout."""
+        return self.reflect_on_subtask(self.run_subtask_tools(cache, distributed=True))
+
+
+    def distributable(self) -> bool:
+        """Whether the top subtask should run on the tool executors: only before super-resolution, while images are small to transfer."""
+        if self.tool_dispatcher is None or not self.plan:
+            return False
+        done_subtasks, _ = self._get_execution_path(Path(self.cur_node["img_path"]))
+        return not any("super-resolution" in subtask for subtask in done_subtasks + self.plan[:1])
+
+
+    def run_subtask_tools(self, cache: Optional[Path], distributed: bool = False) -> SubtaskStep:
+        """First half of `execute_subtask`: pops the top subtask and invokes its tools, on the tool executors if `distributed`."""
         subtask = self.plan.pop(0)
         subtask_dir, degradation, toolbox = self._prepare_for_subtask(subtask)
-        res_degra_level_dict: dict[str, list[Path]] = {}
-        success = True
+        step = SubtaskStep(subtask=subtask, input_img=image_store.open(self.cur_node["img_path"]))
+        # the tools read the file, which may still be written in the background
+        image_store.flush(self.cur_node["img_path"])
 
         # obtain image size & toolbox
-        cur_img = cv2.imread(self.cur_node["img_path"])
-        img_shape = cur_img.shape[:2]
+        img_shape = step.input_img.shape[:2]
         max_side = max(img_shape)
-        updated_toolbox = self.tool_selection(subtask, toolbox, max_side)
+        updated_toolbox = self.tool_selection(subtask, toolbox, max_side, n_pixels=img_shape[0] * img_shape[1])
+
+        tool_pool = self.tool_dispatcher if distributed else self.tool_pool
+        if (self.proxy_top_k is not None and self.with_reflection and cache is None
+                and len(updated_toolbox) > self.proxy_top_k and max_side > self.proxy_max_side):
+            updated_toolbox = self._prune_by_proxy(
+                subtask, subtask_dir, step.input_img, updated_toolbox, tool_pool or self.serial_tool_pool)
+
+        if tool_pool is not None and self.with_reflection and cache is None:
+            for output_path in self._execute_toolbox_concurrently(subtask, subtask_dir, updated_toolbox, tool_pool):
+                self._record_tool_res(output_path)
+                step.candidates.append(output_path)
+            return step
 
         for tool in updated_toolbox:
             self.work_mem["n_invocations"] += 1
@@ -879,12 +994,16 @@ class Imagent:
 
             # invoke tool
             if cache is None:
-                tool(
-                    input_dir=Path(self.cur_node["img_path"]).parent,
-                    output_dir=output_dir,
-                    silent=True,
-                    run_gpu_id=self.tool_run_gpu_id
-                )
+                try:
+                    tool(
+                        input_dir=Path(self.cur_node["img_path"]).parent,
+                        output_dir=output_dir,
+                        silent=True,
+                        run_gpu_id=self.tool_run_gpu_id
+                    )
+                except Exception:
+                    self._record_tool_failure(subtask, tool.tool_name, traceback.format_exc(), output_dir)
+                    continue
             else:
                 dst_path = output_dir / "output.png"
                 rel_path = dst_path.relative_to(self.img_tree_dir)
@@ -892,39 +1011,48 @@ class Imagent:
                 dst_path.symlink_to(src_path)
             output_path = sorted_glob(output_dir)[0]
 
-            if self.with_reflection:
-                self._record_tool_res(output_path)
-                res_degra_level_dict.setdefault(self.reflect_by, []).append(output_path)
-            else:
-                best_tool_name = tool.tool_name
-                # best_img_path = output_path
-                res_degra_level = "none"
-                self._record_tool_res(output_path)
+            self._record_tool_res(output_path)
+            step.candidates.append(output_path)
+            if not self.with_reflection:
+                step.best_tool_name = tool.tool_name
                 break
+        return step
 
-        else:
-            best_img_path, best_img_score = self.evaluate_tool_result_onetime(res_degra_level_dict[self.reflect_by])
+
+    def reflect_on_subtask(self, step: SubtaskStep) -> bool:
+        """Second half of `execute_subtask`: picks the best output of the tools, restores faces after super-resolution, and moves `self.cur_node` to the best output. Returns success or not."""
+        subtask = step.subtask
+        success = True
+        if not step.candidates:
+            return self._on_all_tools_failed(subtask)
+
+        if step.best_tool_name is None:
+            best_img_path, best_img_score = self.evaluate_tool_result_onetime(step.candidates)
                 
             best_tool_name = self._get_name_stem(best_img_path.parents[1].name)
             self.workflow_logger.info(f"Tool tốt nhất: {best_tool_name} ({get_tool_desc('tool-'+best_tool_name)})")
                 
-            res_degra_level = self.reflect_by
             rollback_score = 0.12 if self.reflect_by == "hpsv2" else 0.5
                 
             if best_img_score < rollback_score:
                 success = False
             elif len(self.face_list) > 0 and subtask == 'super-resolution':
                 self.face_restore(best_img_path)
+        else:
+            best_tool_name = step.best_tool_name
+            best_img_path, best_img_score = step.candidates[-1], None
         
         # Global img color alignment on large size image
-        output_img = cv2.imread(str(best_img_path))
+        cur_img = step.input_img
+        output_img = image_store.open(best_img_path)
         if "super-resolution" in subtask:
             output_max_side = max(output_img.shape[:2])
             if output_max_side >= 1024:
                 self.workflow_logger.info("Đang cân bằng lại màu sắc tổng thể...")
-                color_fix_pil = adain_color_fix(cv2_to_pil(output_img), cv2_to_pil(cur_img))
-                color_fix_img = pil_to_cv2(color_fix_pil)
-                cv2.imwrite(str(best_img_path), color_fix_img)
+                # written band by band into the new image, as `_overwrite_img` would put it
+                color_fix_img = image_store.create(best_img_path, output_img.shape)
+                adain_color_fix_array(output_img.array, cur_img.array, out=color_fix_img.array)
+                image_store.commit(color_fix_img)
 
         self.cur_node["children"][subtask]["best_tool"] = best_tool_name
         self.cur_node = self.cur_node["children"][subtask]["tools"][best_tool_name]
@@ -935,6 +1063,9 @@ class Imagent:
                 "failed": f"{done_subtasks} + {self.plan}", "new": None
             })
 
+        if self.retention != "all" and step.best_tool_name is None:
+            self._prune_candidates([cand for cand in step.candidates if cand != best_img_path])
+
         self._dump_summary()
         self._render_img_tree()
         self.workflow_logger.info(
@@ -945,29 +1076,146 @@ class Imagent:
         return success
     
     
+    def _on_all_tools_failed(self, subtask: Subtask) -> bool:
+        """Handles a subtask whose tools all failed on the current image, which stays the current node. The first time, puts the subtask back on top of the plan and reports a failure, for `recover_from_failure` to roll back from this image as after a severe degradation. If the subtask already failed on this image, or no rollback can follow, skips it (see `work_mem["skipped_subtasks"]`) and goes on with the rest of the plan."""
+        subtask_dir = Path(self.cur_node["img_path"]).parents[1] / f"subtask-{subtask}"
+        shutil.rmtree(subtask_dir, ignore_errors=True)
+        key = (self.cur_node["img_path"], subtask)
+        retry = key not in self._all_tools_failed
+        self._all_tools_failed.add(key)
+        if retry and self.with_rollback and not self._fixed_plan and self.cur_node is not self.work_mem["tree"]:
+            self.workflow_logger.warning(
+                f"All tools failed on {subtask} for {self._img_nickname(self.cur_node['img_path'])}, rolling back.")
+            self.plan.insert(0, subtask)
+            self.cur_node["best_descendant"] = self.cur_node["img_path"]
+            done_subtasks, _ = self._get_execution_path(Path(self.cur_node['img_path']))
+            self.work_mem["plan"]["adjusted"].append({
+                "failed": f"{done_subtasks} + {self.plan}", "new": None
+            })
+            return False
+
+        self.workflow_logger.warning(
+            f"All tools failed on {subtask} for {self._img_nickname(self.cur_node['img_path'])}, skipping it.")
+        self.work_mem["skipped_subtasks"].append({"subtask": subtask, "input": self.cur_node["img_path"]})
+        self._dump_summary()
+        return True
+
+
+    def _prune_by_proxy(
+        self, subtask: Subtask, subtask_dir: Path, input_img: ImageHandle, toolbox: list[Tool], tool_pool: Union[ToolPool, ToolDispatcher]
+    ) -> list[Tool]:
+        """Runs `toolbox` on a copy of the current image downscaled to `proxy_max_side`, scores the outputs by reflection, and returns the `proxy_top_k` best tools (in toolbox order) to run at full resolution. The proxy run lives in `{work_dir}/proxies`, out of the image tree; its scores are logged and written to `{subtask_dir}/tmp/proxy_scores.txt`, next to the final scores."""
+        proxies_dir = self.work_dir / "proxies"
+        proxies_dir.mkdir(exist_ok=True)
+        proxy_dir = proxies_dir / f"{len(list(proxies_dir.iterdir())) + 1}-{subtask.replace(' ', '_')}"
+        proxy_input_dir = proxy_dir / "0-img"
+        proxy_input_dir.mkdir(parents=True)
+        h, w = input_img.shape[:2]
+        ratio = self.proxy_max_side / max(h, w)
+        proxy_img = cv2.resize(input_img.array, (max(1, round(w * ratio)), max(1, round(h * ratio))), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(str(proxy_input_dir / "input.png"), proxy_img)
+
+        candidates = self._execute_toolbox_concurrently(subtask, proxy_dir, toolbox, tool_pool, proxy_input_dir=proxy_input_dir)
+        if not candidates:
+            self.workflow_logger.warning(f"All tools failed on the proxy of {subtask}. Running them all at full resolution.")
+            return toolbox
+        scores = self._score_candidates(candidates)
+        tool_names = [self._get_name_stem(cand.parents[1].name) for cand in candidates]
+        ranked = sorted(zip(scores, tool_names), key=lambda x: x[0], reverse=True)
+        kept = {name for _, name in ranked[:self.proxy_top_k]}
+
+        (subtask_dir / "tmp").mkdir(exist_ok=True)
+        with open(subtask_dir / "tmp" / "proxy_scores.txt", "w", encoding="utf-8") as f:
+            for score, name in ranked:
+                f.write(f"image_{name}, Proxy: {score:.6f}, {'kept' if name in kept else 'pruned'}\n")
+        self.workflow_logger.info(
+            f"Proxy scores at {proxy_img.shape[1]}x{proxy_img.shape[0]}: "
+            + ", ".join(f"{name} {score:.4f}" for score, name in ranked)
+            + f". Running {sorted(kept)} at full resolution.")
+        return [tool for tool in toolbox if tool.tool_name in kept]
+
+
+    def _execute_toolbox_concurrently(
+        self, subtask: Subtask, subtask_dir: Path, toolbox: list[Tool], tool_pool: Union[ToolPool, ToolDispatcher],
+        proxy_input_dir: Optional[Path] = None,
+    ) -> list[Path]:
+        """Runs the tools of `toolbox` on the current image (or the proxy in `proxy_input_dir`, see `_prune_by_proxy`) with `tool_pool`, keeping the directory layout of the sequential loop in `execute_subtask`. Returns the outputs of the successful tools in the order of `toolbox`, possibly none; failures are logged and recorded in `work_mem["tool_failures"]`."""
+        input_dir = proxy_input_dir or Path(self.cur_node["img_path"]).parent
+        jobs = []
+        for tool in toolbox:
+            self.work_mem["n_proxy_invocations" if proxy_input_dir is not None else "n_invocations"] += 1
+            output_dir = subtask_dir / f"tool-{tool.tool_name}" / "0-img"
+            output_dir.mkdir(parents=True)
+            jobs.append(ToolJob(
+                tool=tool,
+                input_dir=input_dir,
+                output_dir=output_dir,
+                run_gpu_id=self.tool_run_gpu_id,
+            ))
+
+        output_paths = []
+        for res in tool_pool.run(jobs):
+            if res.ok:
+                output_paths.append(res.output_path)
+                continue
+            self._record_tool_failure(subtask, res.job.tool.tool_name, res.error, res.job.output_dir, proxy_input_dir)
+        return output_paths
+
+
+    def _record_tool_failure(
+        self, subtask: Subtask, tool_name: ToolName, error: str, output_dir: Path, proxy_input_dir: Optional[Path] = None
+    ) -> None:
+        """Logs the failure of `tool_name` on the current image, or on its proxy in `proxy_input_dir`, records it in `work_mem["tool_failures"]` and removes its directory."""
+        proxy = proxy_input_dir is not None
+        self.workflow_logger.warning(f"{tool_name} failed on {'the proxy of ' if proxy else ''}{subtask}:\n{error}")
+        self.work_mem["tool_failures"].append({
+            "subtask": subtask,
+            "tool": tool_name,
+            "input": str(sorted_glob(proxy_input_dir)[0]) if proxy else self.cur_node["img_path"],
+            "error": error.strip().splitlines()[-1],
+            "proxy": proxy,
+        })
+        # drop the directory so that the image tree only shows real candidates
+        shutil.rmtree(output_dir.parent, ignore_errors=True)
+
+
     def evaluate_tool_result_onetime(self, candidates: list[Path]) -> tuple[Path, float]:
         if not candidates:
             raise ValueError("`candidates` is empty.")
 
-        task_folder = candidates[0].parents[2] if len(candidates[0].parents) > 2 else candidates[0].parent
-        candidates_tmp_dir = os.path.join(str(task_folder), "tmp")
-        os.makedirs(candidates_tmp_dir, exist_ok=True)
+        if self.retention == "all":
+            # side by side with the scores, hard-linked rather than copied
+            task_folder = candidates[0].parents[2] if len(candidates[0].parents) > 2 else candidates[0].parent
+            candidates_tmp_dir = task_folder / "tmp"
+            candidates_tmp_dir.mkdir(exist_ok=True)
+            for i, cand in enumerate(candidates):
+                tool_name = self._get_name_stem(cand.parents[1].name) if len(cand.parents) > 1 else f"tool_{i:02d}"
+                image_store.flush(cand)
+                self._link(cand, candidates_tmp_dir / f"image_{tool_name}.png")
+
+        result = self._score_candidates(candidates)
+        best_idx, best_score = max(enumerate(result), key=lambda x: x[1])
+        best_image = candidates[best_idx]
 
-        candidate_paths = []
-        for i, cand in enumerate(candidates):
-            tool_name = self._get_name_stem(cand.parents[1].name) if len(cand.parents) > 1 else f"tool_{i:02d}"
-            new_filename = f"image_{tool_name}.png"
-            new_path = os.path.join(candidates_tmp_dir, new_filename)
-            shutil.copy(str(cand), new_path)
-            candidate_paths.append(str(cand))
+        return best_image, float(best_score)
 
-        if self.reflect_by == "hpsv2+metric":
-            metric_scores = [compute_iqa_metric_score(p) for p in candidate_paths]
-            # metric_scores = compute_iqa_metric_score_batch(candidate_paths)
 
-        import hpsv2
-        hps_scores = hpsv2.score(candidate_paths, self.image_description, hps_version="v2.1")
-        hps_scores = [float(s) for s in hps_scores]
+    def _score_candidates(self, candidates: list[Path]) -> list[float]:
+        """Reflection scores of `candidates`, also written to `tmp/` of their subtask directory."""
+        task_folder = candidates[0].parents[2] if len(candidates[0].parents) > 2 else candidates[0].parent
+        candidates_tmp_dir = os.path.join(str(task_folder), "tmp")
+        os.makedirs(candidates_tmp_dir, exist_ok=True)
+        # byte-identical candidates are scored once
+        for cand in candidates:
+            image_store.flush(cand)
+        hashes = [content_hash(cand) for cand in candidates]
+        unique_hashes = list(dict.fromkeys(hashes))
+        unique_candidates = [candidates[hashes.index(h)] for h in unique_hashes]
+        unique_hps_scores, unique_metric_scores = self.reflection_scorer.score(
+            [str(cand) for cand in unique_candidates], self.image_description)
+        hps_scores = [unique_hps_scores[unique_hashes.index(h)] for h in hashes]
+        metric_scores = None if unique_metric_scores is None else \
+            [unique_metric_scores[unique_hashes.index(h)] for h in hashes]
 
         if self.reflect_by == "hpsv2+metric":
             result = [h + m for h, m in zip(hps_scores, metric_scores)]
@@ -983,16 +1231,7 @@ class Imagent:
                 for cand, s in zip(candidates, result):
                     name = self._get_name_stem(cand.parents[1].name) if len(cand.parents) > 1 else "unknown"
                     f.write(f"image_{name}, {s:.6f}\n")
-
-        best_idx, best_score = max(enumerate(result), key=lambda x: x[1])
-        best_image = candidates[best_idx]
-        # Release memory
-        del hpsv2
-        del result
-        gc.collect()
-        torch.cuda.empty_cache()
-
-        return best_image, float(best_score)
+        return result
     
 
     def evaluate_tool_result_by_gpt4v(
@@ -1087,19 +1326,33 @@ class Imagent:
         # Copy the input image to the subtask directory
         ori_image_path = subtask_dir / "ori"
         ori_image_path.mkdir(parents=True, exist_ok=True)
-        shutil.copy(str(img_path), ori_image_path / "input.png")
+        image_store.flush(img_path)
+        self._link(Path(img_path), ori_image_path / "input.png")
         # Extract face from the input image
         step_face_path = subtask_dir / "0-img"
         step_face_path.mkdir(parents=True, exist_ok=True)
-        face_img_paths = self.extract_face(img_path, step_face_path)
+        landmarks = self._locate_faces(img_path) if self.face_reuse_detections else None
+        face_img_paths = self.extract_face(img_path, step_face_path, landmarks=landmarks)
         if len(face_img_paths) != len(self.face_list):
             return
-        # Evaluate the face image
+        # Restore all faces with each tool
+        tool_face_paths = {tool.tool_name: self._run_face_tool(tool, subtask_dir, face_img_paths) for tool in toolbox}
+        # Evaluate the face images, all candidates of all faces at once
+        candidates = [
+            [face_img_paths[i]] + [tool_face_paths[tool.tool_name][i] for tool in toolbox]
+            for i in range(len(face_img_paths))
+        ]
+        for face_candidates in candidates:
+            for out_face_path in face_candidates[1:]:
+                self.img_tree.add(Path(out_face_path))
+        scores = iter(self.face_scorer.score([
+            (face_candidate, self.face_list[i]) for i, face_candidates in enumerate(candidates) for face_candidate in face_candidates
+        ]))
         evaluate_results = []
         
         for i in range(len(face_img_paths)):
             face_evaluations = []
-            face_evaluation = self.evaluate_tool_result_face(face_img_paths[i], self.face_list[i])
+            face_evaluation = next(scores)
             self.workflow_logger.info(
                 f"Khuôn mặt {i:03d} "
                 f"{sub_task.capitalize()} result: "
@@ -1107,16 +1360,9 @@ class Imagent:
                 f"Score: {face_evaluation}.")
             face_evaluations.append({'path': face_img_paths[i], 'evaluation': face_evaluation})
             for tool in toolbox:
-                # prepare directory
-                tool_dir = subtask_dir / f"tool-face-{i}-{tool.tool_name}"
-                output_dir = tool_dir / "0-img"
-                output_dir.mkdir(parents=True)
-                # invoke tool
-                tool(input_dir=Path(face_img_paths[i]).parents[0],output_dir=output_dir,silent=True,)
-                
                 # Evaluate the result (weighted score, should be a dict with {'face_00': score, 'face_01': score, ...})
-                out_face_path = str(output_dir / 'output.png')
-                face_evaluation = self.evaluate_tool_result_face(out_face_path, self.face_list[i])
+                out_face_path = tool_face_paths[tool.tool_name][i]
+                face_evaluation = next(scores)
                 self.workflow_logger.info(
                     f"Face: {i:03d} "
                     f"{sub_task.capitalize()} result: "
@@ -1126,13 +1372,19 @@ class Imagent:
                 face_evaluations.append({'path': out_face_path, 'evaluation': face_evaluation})
             best_face_path = max(face_evaluations, key=lambda x: x['evaluation'])['path']
             evaluate_results.append(face_evaluations)
-            self.face_helper.add_restored_face(cv2.imread(str(best_face_path)))
+            self.face_helper.add_restored_face(image_store.read(best_face_path))
         
         # Merge the face images back to the original image
         self.face_helper.get_inverse_affine(None)
         # paste each restored face to the input image
-        restored_img = self.face_helper.paste_faces_to_input_image(upsample_img=None)
-        cv2.imwrite(str(img_path), restored_img)
+        if landmarks is not None:
+            # written band by band into the new image, as `_overwrite_img` would put it
+            restored_img = image_store.create(img_path, self.face_helper.input_img.shape)
+            paste_faces(self.face_helper, self.face_helper.input_img, out=restored_img.array)
+            image_store.commit(restored_img)
+        else:
+            restored_img = self.face_helper.paste_faces_to_input_image(upsample_img=None)
+            self._overwrite_img(img_path, restored_img)
         self.face_helper.clean_all()
 
         result_file = os.path.join(subtask_dir, "result_scores_faces.txt")
@@ -1145,12 +1397,50 @@ class Imagent:
         f.close()
         
 
+    def _run_face_tool(self, tool: Tool, subtask_dir: Path, face_img_paths: list[str]) -> list[str]:
+        """Restores the faces of `face_img_paths` with `tool`, into `{subtask_dir}/tool-face-{i}-{tool}/0-img/output.png` for face i. A batchable tool runs once on all the faces, other tools once per face. Returns the output paths."""
+        output_dirs = []
+        for i in range(len(face_img_paths)):
+            output_dir = subtask_dir / f"tool-face-{i}-{tool.tool_name}" / "0-img"
+            output_dir.mkdir(parents=True)
+            output_dirs.append(output_dir)
+
+        if tool.batchable and len(face_img_paths) > 1:
+            # the faces are all named face.png, the batch gets them under their index
+            batch_input_dir = subtask_dir / "faces"
+            if not batch_input_dir.exists():
+                batch_input_dir.mkdir()
+                for i, face_img_path in enumerate(face_img_paths):
+                    self._link(Path(face_img_path), batch_input_dir / f"face_{i:03d}.png")
+            batch_output_dir = subtask_dir / f"batch-{tool.tool_name}"
+            batch_output_dir.mkdir()
+            outputs = tool.run_batch(input_dir=batch_input_dir, output_dir=batch_output_dir, silent=True)
+            for i, output_dir in enumerate(output_dirs):
+                outputs[f"face_{i:03d}"].replace(output_dir / "output.png")
+            shutil.rmtree(batch_output_dir)
+        else:
+            for face_img_path, output_dir in zip(face_img_paths, output_dirs):
+                tool(input_dir=Path(face_img_path).parents[0], output_dir=output_dir, silent=True)
+        return [str(output_dir / "output.png") for output_dir in output_dirs]
+
+
+    def _locate_faces(self, img_path: Path) -> Optional[list[np.ndarray]]:
+        """Landmarks of the faces of `face_list` in `img_path`, an upscaled version of the image they were detected on: projected by the scale factor, then refined by detecting the faces in padded boxes around them. Returns None if the image is not a uniform scaling of the original, the faces are then detected on the whole image."""
+        if not self.face_landmarks or self.face_src_shape is None:
+            return None
+        img = image_store.open(img_path)
+        landmarks = project_landmarks(self.face_landmarks, self.face_src_shape, img.shape)
+        if landmarks is None:
+            self.workflow_logger.info("Kích thước ảnh không khớp, phát hiện lại khuôn mặt trên toàn ảnh.")
+            return None
+        landmarks, n_found = refine_landmarks(self.face_helper, img.array, landmarks)
+        self.workflow_logger.info(f"Đã định vị lại {n_found}/{len(landmarks)} khuôn mặt quanh vị trí dự kiến.")
+        return landmarks
+
+
     def evaluate_tool_result_face(self, restored_face: Path, ori_face: str) -> float:
-        identity_score = calculate_cos_dist(str(restored_face), ori_face)
-        nr_metric_score = compute_iqa_metric_score(str(restored_face))
-        face_iqa_score = compute_face_scores(str(restored_face))
-        Combined_score = face_iqa_score + nr_metric_score - ( identity_score / 1000 )
-        return Combined_score
+        """Combined score of a restored face, see `FaceScorer`, which `face_restore` uses to score all faces in batches."""
+        return self.face_scorer.score([(restored_face, ori_face)])[0]
 
 
     def roll_back(self) -> None:
@@ -1189,7 +1479,8 @@ class Imagent:
         done_subtasks, plan = set(done_subtasks), set(self.plan)
         assert done_subtasks & plan == set(), \
             f"Invalid plan: {done_subtasks} & {plan} != ∅."
-        assert done_subtasks | plan == set(self.work_mem["plan"]["initial"]), (
+        skipped = {entry["subtask"] for entry in self.work_mem["skipped_subtasks"]}
+        assert done_subtasks | plan | skipped == set(self.work_mem["plan"]["initial"]), (
             f"Invalid plan: {done_subtasks} | {plan} != "
             f"{self.work_mem['plan']['initial']}.")
         
@@ -1223,15 +1514,15 @@ class Imagent:
         this_subtask = self.degra_subtask_dict[self.cur_node["degradation"]]
         self.plan.insert(0, this_subtask)
 
-        parent_img_path = next(
-            Path(self.cur_node["img_path"]).parents[3].glob("0-img/*.png")
-        )
+        parent_img_path = self.img_tree.parent_img_path(Path(self.cur_node["img_path"]))
         self.cur_node = self._img_path_to_node(parent_img_path)
         self.workflow_logger.info(
             f"Back to {self._img_nickname(self.cur_node['img_path'])}.")
         
 
     def _img_path_to_node(self, img_path: Path) -> dict:
+        if str(img_path) in self._work_mem_nodes:
+            return self._work_mem_nodes[str(img_path)]
         subtasks, tools = self._get_execution_path(img_path)
         node = self.work_mem["tree"]
         for subtask, tool in zip(subtasks, tools):
@@ -1286,7 +1577,8 @@ class Imagent:
 
         # record update
         done_subtasks, _ = self._get_execution_path(Path(self.cur_node['img_path']))
-        assert set(done_subtasks+self.plan) == set(self.work_mem["plan"]["initial"]), \
+        skipped = [entry["subtask"] for entry in self.work_mem["skipped_subtasks"]]
+        assert set(done_subtasks+self.plan+skipped) == set(self.work_mem["plan"]["initial"]), \
             (f"Invalid adjusted plan: {done_subtasks} ∪ {self.plan} "
              f"!= {self.work_mem['plan']['initial']}.")
         self.work_mem["plan"]["adjusted"][-1]["new"] = f"{done_subtasks} + {self.plan}"
@@ -1306,8 +1598,8 @@ class Imagent:
         subtask_dir.mkdir()
 
         degradation = self.subtask_degra_dict[subtask]
-        toolbox = self.executor.toolbox_router[subtask]
-        random.shuffle(toolbox)
+        toolbox = self.executor.toolbox_router[subtask].copy()
+        self._rng.shuffle(toolbox)
 
         return subtask_dir, degradation, toolbox
     
@@ -1323,8 +1615,8 @@ class Imagent:
         subtask_dir.mkdir()
 
         # degradation = self.subtask_degra_dict[subtask]
-        toolbox = self.executor.toolbox_router[subtask]
-        random.shuffle(toolbox)
+        toolbox = self.executor.toolbox_router[subtask].copy()
+        self._rng.shuffle(toolbox)
 
         return subtask_dir, toolbox
     
@@ -1347,8 +1639,58 @@ class Imagent:
             "degradation": degradation,
             "img_path": str(img_path),
             "best_descendant": None,
+            "pruned": False,
             "children": {},
         }
+        self._work_mem_nodes[str(img_path)] = cur_children[subtask]["tools"][tool_name]
+        self.img_tree.add(img_path)
+        self._dedupe_output(img_path)
+
+
+    def _dedupe_output(self, img_path: Path) -> None:
+        """Hard-links `img_path` to an earlier tool output with the same content, if any. Images are rewritten by renaming over them (see `_overwrite_img`), which breaks the link rather than changing both."""
+        if img_path.is_symlink():
+            return  # cached outputs of `execute(cache)`
+        digest = content_hash(img_path)
+        same_outputs = self._outputs_by_hash.setdefault(digest, [])
+        # outputs rewritten since, e.g. by the color fix, no longer match
+        same_outputs[:] = [path for path in same_outputs if content_hash(path) == digest]
+        if same_outputs and not os.path.samefile(same_outputs[0], img_path):
+            self._link(same_outputs[0], img_path)
+            self.workflow_logger.info(
+                f"{self._img_nickname(img_path)} is identical to {self._img_nickname(same_outputs[0])}, hard-linked.")
+        same_outputs.append(img_path)
+
+
+    def _prune_candidates(self, candidates: list[Path]) -> None:
+        """Deletes the images of `candidates`, which lost the reflection of their subtask, leaving a thumbnail if the retention policy is "thumbnails". Rollback only revisits the best output of each subtask (see `roll_back`), so these nodes stay in the image tree and the summary without their images."""
+        for cand in candidates:
+            thumbnail_path = None
+            if self.retention == "thumbnails":
+                img = image_store.open(cand).array
+                h, w = img.shape[:2]
+                ratio = min(1., THUMBNAIL_MAX_SIDE / max(h, w))
+                thumbnail_path = cand.with_name("thumbnail.png")
+                cv2.imwrite(str(thumbnail_path), cv2.resize(
+                    img, (max(1, round(w * ratio)), max(1, round(h * ratio))), interpolation=cv2.INTER_AREA))
+            image_store.discard(cand)
+            for same_outputs in self._outputs_by_hash.values():
+                if cand in same_outputs:
+                    same_outputs.remove(cand)
+            cand.unlink()
+            self.img_tree.prune(cand, thumbnail_path)
+            self._work_mem_nodes[str(cand)]["pruned"] = True
+
+
+    @staticmethod
+    def _link(src: Path, dst: Path) -> None:
+        """Hard-links `src` to `dst`, replacing `dst` atomically, or copies it across file systems."""
+        tmp_path = dst.with_name(f".tmp-{dst.name}")
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copy(src, tmp_path)
+        os.replace(tmp_path, dst)
         
 
     def _record_res(self) -> None:
@@ -1359,12 +1701,21 @@ class Imagent:
         self.work_mem["execution_path"]["subtasks"] = subtasks
         self.work_mem["execution_path"]["tools"] = tools
         self._dump_summary()
-        shutil.copy(self.res_path, self.work_dir / "result.png")
+        image_store.flush(self.res_path)
+        if self.session.intermediate_png_compression is None:
+            shutil.copy(self.res_path, self.work_dir / "result.png")
+        else:
+            # the intermediate PNG may be barely compressed
+            cv2.imwrite(str(self.work_dir / "result.png"), image_store.open(self.res_path).array)
+        if self.executor.output_cache is not None:
+            self.workflow_logger.info(f"Tool output cache: {self.executor.output_cache.stats}")
+        if self.executor.jax_compilation_cache is not None:
+            self.workflow_logger.info(f"JAX compilation cache: {self.executor.jax_compilation_cache.stats}")
         
 
     def _get_execution_path(self, img_path: Path) -> tuple[list[Subtask], list[ToolName]]:
         """Returns the execution path of the restored image (list of subtask and tools)."""
-        exe_path = self._img_tree.get_execution_path(img_path)
+        exe_path = self.img_tree.get_execution_path(img_path)
         if not exe_path:
             return [], []
         subtasks, tools = zip(*exe_path)
@@ -1383,6 +1734,7 @@ class Imagent:
                 ├── summary.json
                 ├── workflow.log
                 ├── llm_qa.md
+                ├── img_tree.jsonl
                 └── img_tree.html
         ```
         """
@@ -1416,6 +1768,11 @@ class Imagent:
         else:
             shutil.copy(input_path, rqd_input_path)
 
+        # in-memory index of the image tree, updated as images are produced
+        self.img_tree = ImgTree(
+            self.img_tree_dir, html_dir=self.log_dir,
+            scan=False, journal_path=self.log_dir / "img_tree.jsonl",
+        )
         self._render_img_tree()
         
 
@@ -1430,17 +1787,17 @@ class Imagent:
                          for subtask, tool in zip(subtasks, tools)])
         
 
+    def _overwrite_img(self, img_path: Path, img) -> None:
+        """Puts `img` in the image store as the image of `img_path`, whose PNG is then written in the background to a temporary file renamed over `img_path`, so that files hard-linked to `img_path` (e.g. in the tool output cache) are left untouched. Readers of the file should `image_store.flush` it first."""
+        image_store.put(img_path, img)
+        
+
     def _get_name_stem(self, name: str) -> str:
         return name[name.find("-") + 1 :]
     
 
-    @property
-    def _img_tree(self) -> ImgTree:
-        return ImgTree(self.img_tree_dir, html_dir=self.log_dir)
-    
-
     def _render_img_tree(self) -> None:
-        self._img_tree.to_html()
+        self.img_tree.to_html()
         
 
     def _dump_summary(self) -> None:
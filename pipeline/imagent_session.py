@@ -0,0 +1,247 @@
+import gc
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Optional
+
+import torch
+
+from . import prompts
+from executor import executor, ToolPool, ToolDispatcher, LocalToolCluster
+from llm import GPT4, DepictQA, PerceptionVLMAgent, LlamaVisionAgent
+
+from utils.reflection_scorer import ReflectionScorer
+from utils.face_scorer import FaceScorer
+from utils.image_handle import image_store, DEFAULT_SPOOL_MB
+from utils.metric_registry import metric_registry
+from utils.score_store import score_store
+from facexlib.utils.face_restoration_helper import FaceRestoreHelper
+from .profile_loader import load_profile_config
+
+
+class _ThreadBoundLogger:
+    """Stands for the logger bound by the current thread (see `ImagentSession.bind_logger`), so that shared models log to the QA log of the image each thread is working on."""
+
+    _unbound = logging.getLogger("Imagent session")
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def bind(self, logger: logging.Logger) -> None:
+        self._local.logger = logger
+
+    def __getattr__(self, name: str):
+        return getattr(getattr(self._local, "logger", self._unbound), name)
+
+
+class ImagentSession:
+    """Heavy components shared by the `Imagent` runs of a profile: the perception VLM, the LLM clients, the face helper, the reflection and face scorers, the experience and the executor setup. Per-image state stays in `Imagent`.
+
+    The perception VLM is loaded on first use and kept until `release_perception_agent`, so that a batch can run the perception of all its images with a single load.
+
+    A session may be used by several threads, each working on its own image (see `PipelinedRunner`): loggers are bound per thread, each thread gets its own face helper since the helper keeps the faces of the image being processed, and `perception_lock` serializes the use of a local perception VLM.
+
+    Args:
+        profile_name (str | None, optional): Name of the profile. Defaults to "FastGen4K_P".
+        llm_config_path (Path, optional): Path to the config file of LLM. Defaults to Path("config.yml").
+        with_retrieval (bool, optional): Whether to load the experience hub for scheduling. Defaults to True.
+        schedule_experience_path (Path | None, optional): Path to the experience hub. Defaults to Path("memory/schedule_experience.json").
+        silent (bool, optional): Whether to suppress the console output. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        profile_name: Optional[str] = None,
+        llm_config_path: Path = Path("config.yml"),
+        with_retrieval: bool = True,
+        schedule_experience_path: Optional[Path] = Path("memory/schedule_experience.json"),
+        silent: bool = False,
+    ) -> None:
+        self.profile_name = profile_name or "FastGen4K_P"
+        self.profile = load_profile_config(self.profile_name)
+        self.silent = silent
+        self.project_root = Path(__file__).resolve().parent.parent # 4kagent dir path
+
+        self.evaluate_degradation_by = self.profile.get("PerceptionAgent", "llama_vision")
+        self.reflect_by = self.profile.get("Reflection", "hpsv2+metric")
+        self.perception_agent_seed = self.profile.get("PerceptionAgent_Seed", 1994)
+        self._logger = _ThreadBoundLogger()
+        self._bound_loggers: set[str] = set()
+        self._lock = threading.Lock()
+
+        # perception agent, see `perception_agent`
+        self._perception_agent = None
+        local_perception_agent = self.evaluate_degradation_by in {"vlmagent", "llama_vision"}
+        self.perception_lock = threading.RLock() if local_perception_agent else _NoLock()
+
+        # language models
+        self.gpt4 = GPT4(
+            config_path=llm_config_path,
+            logger=self._logger,
+            silent=silent,
+            system_message=prompts.system_message,
+        )
+
+        self.depictqa = None
+        if self.evaluate_degradation_by == "depictqa" or self.reflect_by == "depictqa":
+            self.depictqa = DepictQA(logger=self._logger, silent=silent)
+
+        # face restore, see `face_helper`
+        self._face_helpers = threading.local()
+
+        # reflection scorer, models are loaded on first use and kept for the whole session
+        self.reflection_scorer = ReflectionScorer(
+            with_metrics=self.reflect_by == "hpsv2+metric",
+            batch_size=self.profile.get("ReflectionBatchSize", 8),
+        )
+        # face scorer of face restoration, sharing the metrics of the reflection scorer
+        face_scorer_cache_dir = self.profile.get("FaceScorerCacheDir", None)
+        self.face_scorer = FaceScorer(
+            self.reflection_scorer,
+            batch_size=self.profile.get("ReflectionBatchSize", 8),
+            cache_dir=self.project_root / Path(face_scorer_cache_dir).expanduser() if face_scorer_cache_dir else None,
+        )
+
+        # experience
+        self.schedule_experience: Optional[str] = None
+        if with_retrieval:
+            assert schedule_experience_path is not None, "Experience should be provided."
+            with open(schedule_experience_path, "r") as f:
+                self.schedule_experience = json.load(f)["distilled"]
+
+        # decoded images shared by the pipeline, the scorers and the warm workers
+        # intermediate images are written at a low PNG compression level, the final result is not affected
+        self.intermediate_png_compression = self.profile.get("IntermediatePNGCompression", None)
+        image_store.configure(
+            spool_dir=self.profile.get("ImageSpoolDir", None),
+            max_mb=self.profile.get("ImageSpoolMB", DEFAULT_SPOOL_MB),
+            png_compression=self.intermediate_png_compression,
+        )
+        # pyiqa metrics shared by perception, reflection and face scoring
+        metric_registry.configure(
+            max_gpu_mb=self.profile.get("MetricGPUBudgetMB", None),
+            offload_to_cpu=self.profile.get("MetricCPUOffload", True),
+        )
+        # scores of every scorer, by content hash of the image, kept across runs when enabled
+        score_store_path = self.profile.get("ScoreStorePath", None)
+        score_store.configure(self.project_root / Path(score_store_path).expanduser() if score_store_path else None)
+
+        # executor
+        self.executor = executor
+        self.executor.set_png_compression(self.intermediate_png_compression)
+        self.executor.set_tile_memory_budget(self.profile.get("ToolTileMemoryMB", None))
+        if self.profile.get("WarmToolWorkers", False):
+            self.executor.enable_warm_workers(max_cache_mb=self.profile.get("WarmToolWorkerCacheMB", 8192))
+        self.executor.set_diffplugin_options(
+            num_inference_steps=self.profile.get("DiffPluginSteps", 20),
+            plugin_cache_size=self.profile.get("DiffPluginCacheSize", 4),
+        )
+        self.executor.set_maxim_options(shape_buckets=self.profile.get("MaximShapeBuckets", False))
+        jax_cache_dir = self.profile.get("JaxCompilationCacheDir", None)
+        if jax_cache_dir is not None:
+            self.executor.enable_jax_compilation_cache(
+                self.project_root / Path(jax_cache_dir).expanduser(),
+                max_size_gb=self.profile.get("JaxCompilationCacheSizeGB", 10),
+            )
+        tool_output_cache_dir = self.profile.get("ToolOutputCacheDir", None)
+        if tool_output_cache_dir is not None:
+            self.executor.enable_output_cache(
+                self.project_root / Path(tool_output_cache_dir).expanduser(),
+                max_size_gb=self.profile.get("ToolOutputCacheSizeGB", 50),
+            )
+        tool_stats_path = self.profile.get("ToolStatsPath", None)
+        if tool_stats_path is None and self.profile.get("LatencyBudgetSeconds", None) is not None:
+            # the latency budget needs the cost model
+            tool_stats_path = "memory/tool_stats.jsonl"
+        if tool_stats_path is not None:
+            self.executor.enable_stats(self.project_root / Path(tool_stats_path).expanduser())
+        self.tool_pool = None
+        tool_parallelism = self.profile.get("ToolParallelism", 1)
+        if tool_parallelism > 1:
+            self.tool_pool = ToolPool(
+                max_workers=tool_parallelism,
+                resource_limits=self.profile.get("ToolResourceLimits", None) or {},
+            )
+        # runs the proxies of `Imagent._prune_by_proxy` one tool at a time without `tool_pool`
+        self.serial_tool_pool = ToolPool(max_workers=1)
+
+        # tool executors on other hosts or local stand-ins, see `Imagent.execute_subtask_distributed`
+        self.tool_dispatcher = None
+        self.local_tool_cluster = None
+        endpoints = list(self.profile.get("ToolExecutors", None) or [])
+        n_local_executors = self.profile.get("LocalToolExecutors", 0)
+        if n_local_executors > 0:
+            self.local_tool_cluster = LocalToolCluster(
+                n_local_executors, run_gpu_ids=self.profile.get("LocalToolExecutorGPUs", None))
+            endpoints += self.local_tool_cluster.endpoints
+        if endpoints:
+            self.tool_dispatcher = ToolDispatcher(endpoints, settings=self.executor.settings())
+
+    @property
+    def face_helper(self) -> FaceRestoreHelper:
+        """The face helper of the calling thread."""
+        if not hasattr(self._face_helpers, "helper"):
+            self._face_helpers.helper = FaceRestoreHelper(
+                upscale_factor=1,
+                face_size=512,
+                crop_ratio=(1, 1),
+                det_model='retinaface_resnet50',
+                save_ext='png',
+                use_parse=True,
+                model_rootpath=str(self.project_root / "executor/face_restoration/tools/GFPGAN/gfpgan/weights") # Checkpoints will be downloaded automatically
+            )
+        return self._face_helpers.helper
+
+    @property
+    def perception_agent(self):
+        """The perception VLM, loaded on first access."""
+        with self._lock:
+            return self._load_perception_agent()
+
+    def _load_perception_agent(self):
+        if self._perception_agent is None:
+            print(f"[Evaluation VLM] model: {self.evaluate_degradation_by}")
+            if self.evaluate_degradation_by in {"vlmagent", "depictqa"}:
+                self._perception_agent = PerceptionVLMAgent(
+                    seed=self.perception_agent_seed,
+                    logger=self._logger,
+                    silent=self.silent,
+                    system_message=prompts.updated_perception_system_message,
+                )
+            elif self.evaluate_degradation_by == "llama_vision":
+                self._perception_agent = LlamaVisionAgent(
+                    seed=self.perception_agent_seed,
+                    logger=self._logger,
+                    silent=self.silent,
+                    system_message=prompts.updated_perception_system_message,
+                )
+        return self._perception_agent
+
+    def release_perception_agent(self) -> None:
+        with self._lock:
+            if self._perception_agent is None:
+                return
+            self._perception_agent = None
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def bind_logger(self, logger: logging.Logger) -> None:
+        """Directs the chat logs of the shared models to the QA log of the image processed by the calling thread. A log bound for the first time gets the system messages of the loaded models, as if they were created for it."""
+        self._logger.bind(logger)
+        with self._lock:
+            if logger.name in self._bound_loggers:
+                return
+            self._bound_loggers.add(logger.name)
+            perception_agent = self._perception_agent
+        for model in (perception_agent, self.gpt4):
+            if model is not None:
+                model.log_system_message()
+
+
+class _NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
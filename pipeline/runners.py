@@ -0,0 +1,181 @@
+import gc
+import queue
+import threading
+import traceback
+from pathlib import Path
+from typing import Optional
+
+import torch
+
+from .imagent_pipeline import Imagent
+from .imagent_session import ImagentSession
+
+
+class BatchRunner:
+    """Runs `Imagent` on a batch of images with one `ImagentSession`, in two phases: the perception and planning of all images (`Imagent.prepare`), then the execution of all plans (`Imagent.execute`). The perception VLM is thus loaded once per batch and released before the tools need the GPU, instead of being loaded and released for every image.
+
+    Args:
+        session (ImagentSession): Loaded components shared by the runs.
+        output_dir (Path): Path to the output directory. The results of an image go to `output_dir / {image stem}`.
+        with_reflection (bool, optional): Whether to reflect on the results of tools. Defaults to True.
+        silent (bool, optional): Whether to suppress the console output. Defaults to False.
+        tool_run_gpu_id (int | None, optional): GPU ID to run the tools. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        session: ImagentSession,
+        output_dir: Path,
+        with_reflection: bool = True,
+        silent: bool = False,
+        tool_run_gpu_id: Optional[int] = None,
+    ) -> None:
+        self.session = session
+        self.output_dir = Path(output_dir)
+        self.with_reflection = with_reflection
+        self.silent = silent
+        self.tool_run_gpu_id = tool_run_gpu_id
+
+    def _create_agent(self, image_path: Path) -> Imagent:
+        image_output_dir = self.output_dir / image_path.stem
+        image_output_dir.mkdir(parents=True, exist_ok=True)
+        return Imagent(
+            input_path=image_path,
+            output_dir=image_output_dir,
+            with_reflection=self.with_reflection,
+            silent=self.silent,
+            tool_run_gpu_id=self.tool_run_gpu_id,
+            session=self.session,
+        )
+
+    def run(self, image_paths: list[Path]) -> None:
+        agents: list[tuple[Path, Imagent]] = []
+        for image_path in image_paths:
+            print(f"[Preparing] {image_path.name}")
+            agent = self._create_agent(image_path)
+            agent.prepare()
+            agents.append((image_path, agent))
+        self.session.release_perception_agent()
+
+        for image_path, agent in agents:
+            print(f"[Processing] {image_path.name}")
+            agent.execute()
+            gc.collect()
+            torch.cuda.empty_cache()
+
+
+class PipelinedRunner(BatchRunner):
+    """Runs `Imagent` on a queue of images as a pipeline of three stages, each with its own worker threads:
+
+    - perception: creates the `Imagent` of an image and plans it (`Imagent.prepare`);
+    - tools: runs the tools of the next subtask (`Imagent.run_subtask_tools`);
+    - reflection: scores the outputs, restores faces, rolls back on failure (`Imagent.reflect_on_subtask`), then sends the image back to the tools stage until its plan is done.
+
+    Image N+1 is perceived while the tools of image N run, so the throughput approaches that of the slowest stage rather than the sum of all stages. An image keeps its own output directory, logs and random generator, so its results are those of `Imagent.run`. The perception VLM stays loaded for the whole queue.
+
+    Args:
+        session (ImagentSession): Loaded components shared by the runs.
+        output_dir (Path): Path to the output directory. The results of an image go to `output_dir / {image stem}`.
+        with_reflection (bool, optional): Whether to reflect on the results of tools. Defaults to True.
+        silent (bool, optional): Whether to suppress the console output. Defaults to False.
+        tool_run_gpu_id (int | None, optional): GPU ID to run the tools. Defaults to None.
+        stage_workers (dict[str, int] | None, optional): Number of workers per stage ("perception", "tools", "reflection"), overriding `PipelineStageWorkers` of the profile. Unlisted stages get 1 worker. Defaults to None.
+        queue_size (int | None, optional): Maximum number of planned images that are not done yet, overriding `PipelineQueueSize` of the profile. The perception stage waits when it is reached. Defaults to None, i.e. the number of tools and reflection workers.
+    """
+
+    STAGES = ("perception", "tools", "reflection")
+
+    def __init__(
+        self,
+        session: ImagentSession,
+        output_dir: Path,
+        with_reflection: bool = True,
+        silent: bool = False,
+        tool_run_gpu_id: Optional[int] = None,
+        stage_workers: Optional[dict[str, int]] = None,
+        queue_size: Optional[int] = None,
+    ) -> None:
+        super().__init__(session, output_dir, with_reflection, silent, tool_run_gpu_id)
+        self.stage_workers = {stage: 1 for stage in self.STAGES}
+        self.stage_workers.update(session.profile.get("PipelineStageWorkers", None) or {})
+        self.stage_workers.update(stage_workers or {})
+        assert set(self.stage_workers) == set(self.STAGES), f"Unknown stage in {self.stage_workers}."
+        assert all(n >= 1 for n in self.stage_workers.values()), "Each stage needs at least one worker."
+        self.queue_size = queue_size or session.profile.get("PipelineQueueSize", None) \
+            or self.stage_workers["tools"] + self.stage_workers["reflection"]
+
+    def run(self, image_paths: list[Path]) -> list[Path]:
+        """Processes `image_paths` and returns the images that failed. The error of a failed image is printed and does not stop the others."""
+        self._queues = {stage: queue.Queue() for stage in self.STAGES}
+        self._slots = threading.Semaphore(self.queue_size)
+        self._n_left = len(image_paths)
+        self._all_done = threading.Condition()
+        self._failed: list[Path] = []
+
+        workers = [
+            threading.Thread(target=self._work, args=(stage,), name=f"{stage}-{i}", daemon=True)
+            for stage in self.STAGES for i in range(self.stage_workers[stage])
+        ]
+        for worker in workers:
+            worker.start()
+        for image_path in image_paths:
+            self._queues["perception"].put((image_path, None, None))
+
+        with self._all_done:
+            self._all_done.wait_for(lambda: self._n_left == 0)
+        for stage in self.STAGES:
+            for _ in range(self.stage_workers[stage]):
+                self._queues[stage].put(None)
+        for worker in workers:
+            worker.join()
+        return self._failed
+
+    def _work(self, stage: str) -> None:
+        while True:
+            item = self._queues[stage].get()
+            if item is None:
+                return
+            image_path, agent, step = item
+            try:
+                if stage == "perception":
+                    agent = self._perceive(image_path)
+                    self._route(image_path, agent)
+                    continue
+                self.session.bind_logger(agent.qa_logger)
+                if stage == "tools":
+                    self._queues["reflection"].put((image_path, agent, agent.run_subtask_tools(None, distributed=agent.distributable())))
+                else:
+                    if not agent.reflect_on_subtask(step):
+                        agent.recover_from_failure()
+                    self._route(image_path, agent)
+            except Exception:
+                print(f"[Failed] {image_path.name} in {stage}:\n{traceback.format_exc()}")
+                self._failed.append(image_path)
+                self._finish(release_slot=agent is not None)
+
+    def _perceive(self, image_path: Path) -> Imagent:
+        """Plans the image and waits for a slot in the queue of planned images."""
+        print(f"[Preparing] {image_path.name}")
+        with self.session.perception_lock:
+            agent = self._create_agent(image_path)
+            agent.prepare()
+        self._slots.acquire()
+        print(f"[Processing] {image_path.name}")
+        return agent
+
+    def _route(self, image_path: Path, agent: Imagent) -> None:
+        if agent.plan:
+            self._queues["tools"].put((image_path, agent, None))
+            return
+        agent.finish()
+        print(f"[Done] {image_path.name}")
+        self._finish(release_slot=True)
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def _finish(self, release_slot: bool) -> None:
+        if release_slot:
+            self._slots.release()
+        with self._all_done:
+            self._n_left -= 1
+            self._all_done.notify_all()
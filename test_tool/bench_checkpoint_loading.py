@@ -0,0 +1,62 @@
+"""Cold-start load time of the tool checkpoints, from the `.pth` with `torch.load` and from the safetensors copy with `load_checkpoint` (see `executor/convert_checkpoints.py`). Every load runs in a fresh python process, as in a cold tool run; the import of torch is not timed. Run from the project root, after the conversion:
+```
+python test_tool/bench_checkpoint_loading.py --repeat 3
+```
+The files are read through the page cache, warmed up by a first untimed load, so that both formats are compared on the cost of deserialization rather than of the disk.
+"""
+
+import sys
+import subprocess
+from pathlib import Path
+from statistics import median
+
+project_root = Path(__file__).resolve().parent.parent   # 4kagent project root path
+sys.path.append(str(project_root))
+
+from executor.convert_checkpoints import referenced_checkpoints, fresh_copy  # noqa: E402
+
+
+_LOAD_SNIPPET = """
+import sys, time
+sys.path.append({tool_utils!r})
+import torch
+from checkpoint_loading import load_checkpoint
+start = time.perf_counter()
+checkpoint = {load}({path!r}, map_location="cpu")
+print(time.perf_counter() - start)
+"""
+
+
+def cold_load_seconds(ckpt_path: Path, load: str) -> float:
+    """Time to load `ckpt_path` with `load` ("torch.load" or "load_checkpoint") in a fresh process."""
+    snippet = _LOAD_SNIPPET.format(tool_utils=str(project_root / "executor" / "tool_utils"), load=load, path=str(ckpt_path))
+    out = subprocess.run([sys.executable, "-c", snippet], check=True, capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def bench(repeat: int) -> None:
+    rows = []
+    for ckpt_path, users in referenced_checkpoints().items():
+        has_copy = fresh_copy(ckpt_path) is not None
+        # warm up the page cache
+        cold_load_seconds(ckpt_path, "torch.load")
+        if has_copy:
+            cold_load_seconds(ckpt_path, "load_checkpoint")
+        pth_s = median(cold_load_seconds(ckpt_path, "torch.load") for _ in range(repeat))
+        st_s = median(cold_load_seconds(ckpt_path, "load_checkpoint") for _ in range(repeat)) if has_copy else None
+        for user in users:
+            rows.append((user, ckpt_path.name, ckpt_path.stat().st_size / 1024 ** 2, pth_s, st_s))
+
+    print(f"{'tool':<24}{'checkpoint':<44}{'MB':>8}{'.pth s':>10}{'mmap s':>10}{'speedup':>9}")
+    for user, name, size_mb, pth_s, st_s in sorted(rows):
+        st_col = f"{st_s:>10.3f}{pth_s / st_s:>8.1f}x" if st_s is not None else f"{'-':>10}{'-':>9}"
+        print(f"{user:<24}{name:<44}{size_mb:>8.1f}{pth_s:>10.3f}{st_col}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cold-start checkpoint load time per tool")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed loads per checkpoint and format, the median is reported")
+    args = parser.parse_args()
+    bench(args.repeat)
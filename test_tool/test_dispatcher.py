@@ -0,0 +1,141 @@
+import json
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from time import localtime, strftime, time, sleep
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+
+from executor import executor, Tool, ToolJob, ToolDispatcher, LocalToolCluster
+from utils.custom_types import Subtask
+
+
+def test_dispatcher(ori_input_path: Path, subtask: Subtask, n_executors: int = 2, kill_one: bool = False):
+    """Runs the toolbox of `subtask` on a local stand-in cluster of `n_executors` tool servers. With `kill_one`, one server is killed once the jobs are sent, and its jobs should be taken over by the others."""
+    test_id = strftime("%y%m%d_%H%M%S", localtime())
+    test_dir = Path("test_tool/output").resolve() / f"{test_id}-dispatch-{subtask.replace(' ', '_')}{'-kill_one' if kill_one else ''}"
+    input_dir = test_dir / '0-img'
+    input_dir.mkdir(parents=True)
+    shutil.copy(ori_input_path, input_dir / 'input.png')
+
+    jobs = []
+    for tool in executor.toolbox_router[subtask]:
+        output_dir = test_dir / f"tool-{tool.tool_name}" / '0-img'
+        output_dir.mkdir(parents=True)
+        jobs.append(ToolJob(tool=tool, input_dir=input_dir, output_dir=output_dir))
+
+    with LocalToolCluster(n_executors) as cluster:
+        dispatcher = ToolDispatcher(cluster.endpoints, settings=executor.settings())
+        if kill_one:
+            cluster.processes[0].kill()
+        start_time = time()
+        results = dispatcher.run(jobs)
+        print(f"Time elapsed: {time() - start_time:.2f}s")
+        assert dispatcher.wait_draining(timeout=dispatcher.timeout), "Duplicate runs did not end."
+
+    for res in results:
+        print(f"{res.job.tool.tool_name}\t: {res.output_path if res.ok else res.error}")
+    print(f"Lost executors: {dispatcher.lost}")
+
+    assert [res.job for res in results] == jobs, "Results should be in the order of the jobs."
+    for res in results:
+        assert res.ok, f"{res.job.tool.tool_name} failed: {res.error}"
+        assert res.output_path == res.job.output_dir / "output.png"
+        assert cv2.imread(str(res.output_path)) is not None, f"Unreadable output of {res.job.tool.tool_name}."
+    if kill_one:
+        assert dispatcher.lost == {cluster.endpoints[0]}, f"Lost {dispatcher.lost}, expected {cluster.endpoints[0]}."
+    else:
+        assert not dispatcher.lost, f"Lost {dispatcher.lost}."
+
+
+class _StubToolServer(ThreadingHTTPServer):
+    """Tool server answering every job after `delay` seconds with the input as output, recording the settings it got."""
+    daemon_threads = True
+
+    def __init__(self, delay: float):
+        super().__init__(("127.0.0.1", 0), _StubRequestHandler)
+        self.delay = delay
+        self.settings: list[dict] = []
+        self.n_running = 0
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+    server: _StubToolServer
+
+    def do_GET(self):
+        self._reply(json.dumps({"ok": True, "busy": self.server.n_running > 0}).encode())
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.n_running += 1
+            self.server.settings.append(json.loads(self.headers.get("X-Executor-Settings", "null")))
+        sleep(self.server.delay)
+        with self.server.lock:
+            self.server.n_running -= 1
+        self._reply(body)
+
+    def _reply(self, body: bytes) -> None:
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_straggler_duplicates():
+    """Checks on stub servers, without running any tool, that a straggler is started again on an idle executor, that the first output wins, that the executor left running the duplicate gets no job until it ends, and that the settings reach the executors."""
+    fast, slow = _StubToolServer(delay=0.2), _StubToolServer(delay=3.)
+    for server in (fast, slow):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    settings = {"png_compression": 1}
+    # the slow executor gets the first job, the fast one the others
+    dispatcher = ToolDispatcher([slow.endpoint, fast.endpoint], straggler_factor=2., settings=settings)
+    tool = Tool("stub", "denoising")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_dir = Path(tmp_dir) / "0-img"
+        input_dir.mkdir()
+        (input_dir / "input.png").write_bytes(b"stub image")
+
+        def make_jobs(name: str, n: int) -> list[ToolJob]:
+            jobs = []
+            for i in range(n):
+                output_dir = Path(tmp_dir) / f"{name}-{i}" / "0-img"
+                output_dir.mkdir(parents=True)
+                jobs.append(ToolJob(tool=tool, input_dir=input_dir, output_dir=output_dir))
+            return jobs
+
+        start_time = time()
+        results = dispatcher.run(make_jobs("a", 3))
+        elapsed = time() - start_time
+        assert all(res.ok and res.output_path.read_bytes() == b"stub image" for res in results)
+        assert elapsed < slow.delay, f"The straggler was waited for: {elapsed:.2f}s."
+        assert slow.n_running == 1, "The duplicate run should still be running on the slow executor."
+
+        # the slow executor is busy with the duplicate: the next jobs all go to the fast one
+        n_slow_jobs = len(slow.settings)
+        results = dispatcher.run(make_jobs("b", 2))
+        assert all(res.ok for res in results)
+        assert len(slow.settings) == n_slow_jobs, "A job was sent to an executor still running a duplicate."
+
+        assert dispatcher.wait_draining(timeout=10.), "The duplicate run did not end."
+        assert slow.n_running == 0 and not dispatcher.lost
+        assert all(s == settings for s in fast.settings + slow.settings), "The settings did not reach the executors."
+    for server in (fast, slow):
+        server.shutdown()
+    print("Straggler duplicates: OK")
+
+
+if __name__ == "__main__":
+    test_straggler_duplicates()
+    test_dispatcher(Path('test_tool/input/motion deblurring.png'), 'motion deblurring')
+    test_dispatcher(Path('test_tool/input/motion deblurring.png'), 'motion deblurring', kill_one=True)
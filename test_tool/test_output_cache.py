@@ -0,0 +1,98 @@
+"""Checks of the tool output cache (`executor/output_cache.py`) on small files standing for images, without running any tool. Run from the project root:
+```
+python test_tool/test_output_cache.py
+```
+"""
+
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parent.parent   # 4kagent project root path
+sys.path.append(str(project_root))
+
+from executor.output_cache import ToolOutputCache  # noqa: E402
+
+SIGNATURE = {"class": "Stub", "tool_name": "stub", "subtask": "denoising"}
+
+
+def _write(path: Path, content: bytes) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+def test_hit_miss(tmp_dir: Path):
+    """An output is found under the key of the same input bytes and signature only."""
+    cache = ToolOutputCache(tmp_dir / "cache")
+    input_path = _write(tmp_dir / "in" / "input.png", b"input")
+    key = cache.key(input_path, SIGNATURE)
+    assert not cache.materialize(key, tmp_dir / "miss.png") and not (tmp_dir / "miss.png").exists()
+
+    cache.put(key, _write(tmp_dir / "run" / "output.png", b"output"))
+    assert cache.materialize(key, tmp_dir / "hit.png") and (tmp_dir / "hit.png").read_bytes() == b"output"
+
+    same_input = _write(tmp_dir / "elsewhere" / "other_name.png", b"input")
+    assert cache.key(same_input, SIGNATURE) == key, "The key should depend on the input bytes, not on its path."
+    assert cache.key(input_path, {**SIGNATURE, "opt0": "--tile=512"}) != key
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 1
+    print("Hit and miss: OK")
+
+
+def test_eviction(tmp_dir: Path, object_size: int = 1024):
+    """Least recently used objects, a hit refreshing an object, are evicted beyond `max_size_gb`."""
+    # room for 3 objects, down to 90% of that after an eviction
+    cache = ToolOutputCache(tmp_dir / "cache", max_size_gb=3.5 * object_size / 1024 ** 3)
+    keys = []
+    for i in range(3):
+        input_path = _write(tmp_dir / f"in{i}" / "input.png", f"input {i}".encode())
+        keys.append(cache.key(input_path, SIGNATURE))
+        cache.put(keys[i], _write(tmp_dir / f"run{i}" / "output.png", bytes([i]) * object_size))
+        # distinct mtimes, the oldest first
+        os.utime(cache._object_path(keys[i]), (time.time() - 100 + i, time.time() - 100 + i))
+
+    # the oldest object becomes the most recently used one
+    assert cache.materialize(keys[0], tmp_dir / "hit0.png")
+    input_path = _write(tmp_dir / "in3" / "input.png", b"input 3")
+    keys.append(cache.key(input_path, SIGNATURE))
+    cache.put(keys[3], _write(tmp_dir / "run3" / "output.png", bytes([3]) * object_size))
+
+    cached = [cache._object_path(key).exists() for key in keys]
+    assert cached == [True, False, True, True], f"Only the least recently used object should be evicted, cached: {cached}."
+    assert cache.stats["size"] == 3 * object_size
+    assert not cache.materialize(keys[1], tmp_dir / "hit1.png")
+    print("Eviction: OK")
+
+
+def test_overwrite_materialized(tmp_dir: Path):
+    """Writing into a materialized output, or into the output that was stored, leaves the stored object unchanged."""
+    cache = ToolOutputCache(tmp_dir / "cache")
+    input_path = _write(tmp_dir / "in" / "input.png", b"input")
+    key = cache.key(input_path, SIGNATURE)
+    output_path = _write(tmp_dir / "run" / "output.png", b"output")
+    cache.put(key, output_path)
+    # a later step editing the output of the run in place
+    with open(output_path, "r+b") as f:
+        f.write(b"edited")
+
+    materialized = tmp_dir / "hit" / "output.png"
+    materialized.parent.mkdir()
+    assert cache.materialize(key, materialized)
+    # a script writing its output in place, e.g. with cv2.imwrite or PIL
+    with open(materialized, "wb") as f:
+        f.write(b"overwritten by a script")
+    with open(materialized, "ab") as f:
+        f.write(b" and appended")
+
+    assert cache._object_path(key).read_bytes() == b"output", "The stored object was changed."
+    again = tmp_dir / "again.png"
+    assert cache.materialize(key, again) and again.read_bytes() == b"output"
+    print("Overwriting a materialized output: OK")
+
+
+if __name__ == "__main__":
+    for test in (test_hit_miss, test_eviction, test_overwrite_materialized):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test(Path(tmp_dir))
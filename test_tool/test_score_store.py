@@ -0,0 +1,131 @@
+"""Checks of the score store (`utils/score_store.py`) on small files standing for images, without any scorer. Run from the project root:
+```
+python test_tool/test_score_store.py
+```
+"""
+
+import sys
+import json
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parent.parent   # 4kagent project root path
+sys.path.append(str(project_root))
+
+from utils.score_store import ScoreStore  # noqa: E402
+
+
+def _make_images(image_dir: Path, n: int, prefix: str = "img") -> list[Path]:
+    image_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(n):
+        path = image_dir / f"{prefix}_{i}.png"
+        path.write_bytes(f"{prefix} content {i}".encode())
+        paths.append(path)
+    return paths
+
+
+def test_round_trip(tmp_dir: Path):
+    """`scores` computes the missing scores only, keyed by content, metric and params."""
+    store = ScoreStore(tmp_dir / "scores.sqlite")
+    paths = _make_images(tmp_dir / "images", 3)
+    calls = []
+
+    def compute(missing):
+        calls.append(list(missing))
+        return [float(len(str(path))) for path in missing]
+
+    first = store.scores(paths, "musiq", compute, params={"a": 1, "b": 2})
+    assert calls == [paths], f"All images should be computed once, got {calls}."
+    second = store.scores(paths, "musiq", compute, params={"b": 2, "a": 1})
+    assert second == first and len(calls) == 1, "Stored scores should be read back, whatever the order of the params."
+
+    store.scores(paths[:1], "musiq", compute, params={"a": 1, "b": 3})
+    store.scores(paths[:1], "maniqa", compute, params={"a": 1, "b": 2})
+    assert len(calls) == 3, "Other params or another metric should be computed again."
+
+    # same content under another name
+    copy_path = tmp_dir / "images" / "copy.png"
+    copy_path.write_bytes(paths[0].read_bytes())
+    assert store.scores([copy_path], "musiq", compute, params={"a": 1, "b": 2}) == first[:1] and len(calls) == 3
+
+    # missing and non-finite scores are not stored
+    new_paths = _make_images(tmp_dir / "images", 2, prefix="new")
+    store.scores(new_paths, "musiq", lambda missing: [float("nan"), None])
+    assert store.lookup(new_paths, "musiq") == [None, None]
+
+    # `put` replaces the stored score
+    store.put(paths[0], "clipiqa", 1.)
+    store.put(paths[0], "clipiqa", 2.)
+    assert store.get(paths[0], "clipiqa") == 2.
+    print("Round trip: OK")
+
+
+def test_export_merge(tmp_dir: Path):
+    """Export to a store and to a `.jsonl` file, then merge both into a fresh store, which keeps its own scores."""
+    store = ScoreStore(tmp_dir / "node1.sqlite")
+    paths = _make_images(tmp_dir / "images", 4)
+    store.put_many(paths, "musiq", [1., 2., 3., 4.], params={"resize": "target"})
+    store.put_many(paths[:2], "maniqa", [5., 6.])
+
+    assert store.export(tmp_dir / "export.sqlite") == 6
+    assert store.export(tmp_dir / "export.jsonl", metrics=["musiq"]) == 4
+    with open(tmp_dir / "export.jsonl") as f:
+        rows = [json.loads(line) for line in f]
+    assert {row["metric"] for row in rows} == {"musiq"} and rows[0]["params"] == {"resize": "target"}
+
+    fresh = ScoreStore(tmp_dir / "fresh.sqlite")
+    fresh.put(paths[0], "musiq", 10., params={"resize": "target"})
+    assert fresh.merge(tmp_dir / "export.jsonl") == 3, "The score already in the store should not count as new."
+    assert fresh.get(paths[0], "musiq", params={"resize": "target"}) == 10., "Merging should keep the scores of the store."
+    assert fresh.lookup(paths[1:], "musiq", params={"resize": "target"}) == [2., 3., 4.]
+    assert fresh.merge(tmp_dir / "export.sqlite") == 2, "Only the maniqa scores should be new."
+    assert fresh.lookup(paths[:2], "maniqa") == [5., 6.]
+    assert fresh.merge(tmp_dir / "export.sqlite") == 0
+    assert sorted(fresh.stats()) == [("maniqa", "{}", 2), ("musiq", '{"resize":"target"}', 4)]
+    print("Export and merge: OK")
+
+
+def _write_scores(store_path: str, image_dir: str, prefix: str, n: int, start, errors) -> None:
+    try:
+        store = ScoreStore(Path(store_path))
+        paths = _make_images(Path(image_dir), n, prefix=prefix)
+        start.wait()
+        # one transaction per score, for the writes of both processes to interleave
+        for i, path in enumerate(paths):
+            store.put(path, "musiq", float(i))
+            assert store.get(path, "musiq") == float(i)
+    except BaseException as e:
+        errors.put(f"{prefix}: {e!r}")
+
+
+def test_concurrent_writers(tmp_dir: Path, n: int = 200):
+    """Two processes write to the same store at once, none of their scores being lost."""
+    store_path = tmp_dir / "shared.sqlite"
+    ScoreStore(store_path)
+    ctx = multiprocessing.get_context("spawn")
+    start, errors = ctx.Barrier(2), ctx.Queue()
+    processes = [
+        ctx.Process(target=_write_scores, args=(str(store_path), str(tmp_dir / "images"), prefix, n, start, errors))
+        for prefix in ("proc_a", "proc_b")
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+        assert process.exitcode == 0, f"Writer exited with {process.exitcode}."
+    assert errors.empty(), errors.get()
+
+    store = ScoreStore(store_path)
+    assert store.stats() == [("musiq", "{}", 2 * n)], store.stats()
+    for prefix in ("proc_a", "proc_b"):
+        paths = [tmp_dir / "images" / f"{prefix}_{i}.png" for i in range(n)]
+        assert store.lookup(paths, "musiq") == [float(i) for i in range(n)]
+    print("Concurrent writers: OK")
+
+
+if __name__ == "__main__":
+    for test in (test_round_trip, test_export_merge, test_concurrent_writers):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test(Path(tmp_dir))
@@ -0,0 +1,116 @@
+"""Checks of the tiled inference of the tools (`executor/tool_utils/tiled_inference.py`) on the CPU, with pointwise functions and a small convolution standing for the models, on images that are not tile multiples. Run from the project root:
+```
+python test_tool/test_tiled_inference.py
+```
+"""
+
+import sys
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+
+project_root = Path(__file__).resolve().parent.parent   # 4kagent project root path
+sys.path.append(str(project_root / "executor" / "tool_utils"))
+
+from tiled_inference import TiledInference, DEFAULT_TILE  # noqa: E402
+
+
+H, W = 203, 317
+
+
+def _image(seed: int = 0) -> torch.Tensor:
+    return torch.rand(1, 3, H, W, generator=torch.Generator().manual_seed(seed))
+
+
+def _upscale(scale: int):
+    """Pointwise model: the output of a tile is the matching part of the output of the whole image."""
+    def forward(batch: torch.Tensor) -> torch.Tensor:
+        return F.interpolate(batch * 2 - 1, scale_factor=scale, mode="nearest")
+    return forward
+
+
+def _conv(scale: int = 1):
+    """Model mixing neighbouring pixels, whose tile outputs differ near the tile borders."""
+    weight = torch.rand(3, 3, 3, 3, generator=torch.Generator().manual_seed(1)) / 27
+
+    def forward(batch: torch.Tensor) -> torch.Tensor:
+        out = F.conv2d(batch, weight, padding=1)
+        return F.interpolate(out, scale_factor=scale, mode="nearest") if scale > 1 else out
+    return forward
+
+
+def _old_tile_average(forward, img: torch.Tensor, tile: int, overlap: int, scale: int = 1) -> torch.Tensor:
+    """The tile loop the scripts had (e.g. Restormer): tile outputs averaged with equal weights."""
+    b, c, h, w = img.shape
+    tile = min(tile, h, w)
+    stride = tile - overlap
+    h_idx_list = list(range(0, h - tile, stride)) + [h - tile]
+    w_idx_list = list(range(0, w - tile, stride)) + [w - tile]
+    E = torch.zeros(b, c, h * scale, w * scale)
+    W_map = torch.zeros_like(E)
+    for h_idx in h_idx_list:
+        for w_idx in w_idx_list:
+            out_patch = forward(img[..., h_idx:h_idx + tile, w_idx:w_idx + tile])
+            E[..., h_idx * scale:(h_idx + tile) * scale, w_idx * scale:(w_idx + tile) * scale].add_(out_patch)
+            W_map[..., h_idx * scale:(h_idx + tile) * scale, w_idx * scale:(w_idx + tile) * scale].add_(torch.ones_like(out_patch))
+    return E.div_(W_map)
+
+
+def test_bands_equal_one_shot():
+    """The bands of a pointwise model, stitched, equal the one-shot output, for every blend, scale and tiles per pass."""
+    img = _image()
+    for scale in (1, 2, 4):
+        forward = _upscale(scale)
+        expected = forward(img)
+        for blend in ("gaussian", "feather", "uniform"):
+            for batch_size in (1, 3):
+                tiler = TiledInference(forward, scale=scale, tile=64, overlap=16, batch_size=batch_size, blend=blend)
+                bands = list(tiler.bands(img))
+                assert bands[0][0] == 0 and bands[-1][1] == H * scale, "The bands should cover the output."
+                assert all(prev[1] == band[0] for prev, band in zip(bands, bands[1:])), "The bands should be contiguous."
+                assert all(band.shape[2] == y1 - y0 for y0, y1, band in bands)
+                assert len(bands) > 1, "The image should span several rows of tiles."
+                stitched = torch.cat([band for _, _, band in bands], dim=2)
+                assert torch.allclose(stitched, expected, atol=1e-5), f"Stitched bands differ ({blend}, x{scale}, batch {batch_size})."
+                assert torch.allclose(tiler(img), expected, atol=1e-5), f"`__call__` differs ({blend}, x{scale}, batch {batch_size})."
+    print("Bands equal one shot: OK")
+
+
+def test_uniform_blend_matches_old_loop():
+    """With a model mixing neighbouring pixels, the uniform blend reproduces the averaging of the old tile loops."""
+    img = _image(seed=2)
+    for scale in (1, 2):
+        forward = _conv(scale)
+        for tile, overlap in ((64, 16), (96, 32), (48, 8)):
+            expected = _old_tile_average(forward, img, tile, overlap, scale)
+            for batch_size in (1, 4):
+                output = TiledInference(forward, scale=scale, tile=tile, overlap=overlap, batch_size=batch_size, blend="uniform")(img)
+                assert output.shape == expected.shape
+                assert torch.allclose(output, expected, atol=1e-5), \
+                    f"Uniform blend differs from the old loop (tile {tile}, overlap {overlap}, x{scale}, batch {batch_size})."
+    print("Uniform blend matches the old loop: OK")
+
+
+def test_plan_and_small_images():
+    """On the CPU the tiles are the fixed ones (or `DEFAULT_TILE`), one per pass unless told otherwise; an image smaller than a tile runs in one pass."""
+    img = _image()
+    assert TiledInference(_upscale(1), tile=64)._plan(img) == (64, 1)
+    assert TiledInference(_upscale(1), tile=64, batch_size=4)._plan(img) == (64, 4)
+    assert TiledInference(_upscale(1))._plan(img) == (DEFAULT_TILE, 1)
+    assert TiledInference(_upscale(1), tile=64, memory_budget_mb=100)._plan(img) == (64, 1)
+
+    calls = []
+
+    def forward(batch):
+        calls.append(tuple(batch.shape))
+        return batch
+    output = TiledInference(forward, tile=512)(img)
+    assert calls == [tuple(img.shape)] and torch.equal(output, img)
+    print("Plan and small images: OK")
+
+
+if __name__ == "__main__":
+    test_bands_equal_one_shot()
+    test_uniform_blend_matches_old_loop()
+    test_plan_and_small_images()
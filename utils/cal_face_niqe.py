@@ -5,7 +5,9 @@ import math
 import numpy as np
 import os
 import torch
-import pyiqa
+
+from .score_store import score_store
+from .metric_registry import metric_registry, PYIQA_VERSION
 
 
 def img2tensor(img, bgr2rgb, float32):
@@ -30,11 +32,15 @@ def img2tensor(img, bgr2rgb, float32):
 def calculate_niqe(restored_path):
 
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    iqa_niqe = pyiqa.create_metric('niqe').to(device)
 
-    img = cv2.imread(restored_path)
-    img = img2tensor(img, bgr2rgb=True, float32=True).unsqueeze(0).contiguous().to(device)
-    niqe = iqa_niqe(img).item()
+    def compute():
+        img = cv2.imread(restored_path)
+        img = img2tensor(img, bgr2rgb=True, float32=True).unsqueeze(0).contiguous().to(device)
+        with metric_registry.use('niqe') as iqa_niqe:
+            return iqa_niqe(img).item()
+
+    # the image is scored in [0, 255], unlike the other NIQE scores
+    niqe = score_store.score(restored_path, 'niqe', compute, {'pyiqa': PYIQA_VERSION, 'range': 255})
     print(f'{restored_path} - NIQE : {niqe}')
         
     
@@ -1,3 +1,7 @@
+import os
+import hashlib
+from typing import Optional
+
 import torch
 import torch.nn.functional as F
 from itertools import product
@@ -25,9 +29,11 @@ class CLIBFIQAScorer:
     ill_map  = {i: ill for i, ill in enumerate(ill_list)}
     exp_map  = {i: exp for i, exp in enumerate(exp_list)}
 
-    def __init__(self, clip_model_path: str, clip_weights_path: str, device: str = 'cuda'):
+    def __init__(self, clip_model_path: str, clip_weights_path: str, device: str = 'cuda', text_cache_dir: Optional[str] = None):
         """
         Initialize the analyzer by loading the CLIP model and weights, and building the joint text embeddings.
+        The normalized text features of the joint prompts are computed once; with `text_cache_dir`, they are
+        also saved there and loaded by the next analyzers of the same weights.
         """
         self.device = device
         # Load CLIP backbone
@@ -49,8 +55,7 @@ class CLIBFIQAScorer:
             prompt = f"a photo of a {b}, {o}, and {p} face with {e} under {l}, which is of {q} quality"
             texts.append(prompt)
 
-        # Tokenize and move to device
-        self.joint_texts = torch.cat([clip.tokenize(t) for t in texts]).to(device)
+        self.text_features = self._load_text_features(texts, clip_model_path, clip_weights_path, text_cache_dir)
 
         # Image preprocessing pipeline
         self.transform = T.Compose([
@@ -60,12 +65,66 @@ class CLIBFIQAScorer:
                          std=[0.26862954, 0.26130258, 0.27577711]),
         ])
 
+    @torch.no_grad()
+    def _load_text_features(
+        self, texts: list[str], clip_model_path: str, clip_weights_path: str, cache_dir: Optional[str]
+    ) -> torch.Tensor:
+        """Normalized text features of the joint prompts, as computed in `CLIP.forward`."""
+        cache_path = None
+        if cache_dir is not None:
+            key = hashlib.sha256("\n".join(texts).encode())
+            for path in (clip_model_path, clip_weights_path):
+                st = os.stat(path)
+                key.update(f"{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}".encode())
+            cache_path = os.path.join(cache_dir, f"clib_fiqa_text_features-{key.hexdigest()[:16]}.pt")
+            if os.path.exists(cache_path):
+                return torch.load(cache_path, map_location=self.device)
+
+        # Tokenize and move to device
+        joint_texts = torch.cat([clip.tokenize(t) for t in texts]).to(self.device)
+        text_features = self.model.encode_text(joint_texts)
+        text_features = text_features / text_features.norm(dim=1, keepdim=True)
+
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            torch.save(text_features.cpu(), tmp_path)
+            os.replace(tmp_path, cache_path)
+        return text_features
+
     def _preprocess_image(self, image_path: str) -> torch.Tensor:
         """Load and preprocess a single image."""
         img = Image.open(image_path).convert("RGB")
         tensor = self.transform(img)
         return tensor.unsqueeze(0).to(self.device)
 
+    @torch.no_grad()
+    def quality_scores(self, images: list[Image.Image]) -> list[float]:
+        """Quality scores of RGB images, those of `analyze` batched in a single forward pass."""
+        img_tensor = torch.stack([self.transform(img) for img in images]).to(self.device)
+        batch_size = img_tensor.size(0)
+        logits_image = self._logits(img_tensor)
+        logits_image = F.softmax(logits_image.view(batch_size, -1), dim=1)
+        logits_image = logits_image.view(batch_size, *self._dims())
+        quality_dist = logits_image.sum(1).sum(1).sum(1).sum(1).sum(1)
+        return dist_to_score(quality_dist).tolist()
+
+    def _logits(self, img_tensor: torch.Tensor) -> torch.Tensor:
+        """Image-text logits of `CLIP.forward`, with the cached text features."""
+        image_features = self.model.encode_image(img_tensor.view(-1, 3, 224, 224))
+        image_features = image_features / image_features.norm(dim=1, keepdim=True)
+        return self.model.logit_scale.exp() * image_features @ self.text_features.t()
+
+    def _dims(self) -> tuple[int, ...]:
+        return (
+            len(self.blur_list),
+            len(self.occ_list),
+            len(self.pose_list),
+            len(self.exp_list),
+            len(self.ill_list),
+            len(self.quality_list)
+        )
+
     @torch.no_grad()
     def analyze(self, image_path: str) -> dict:
         """
@@ -86,19 +145,11 @@ class CLIBFIQAScorer:
         batch_size = img_tensor.size(0)
 
         # Forward pass
-        logits_image, _ = self.model.forward(img_tensor.view(-1, 3, 224, 224), self.joint_texts)
+        logits_image = self._logits(img_tensor)
         logits_image = F.softmax(logits_image.view(batch_size, -1), dim=1)
 
         # Reshape to separate dimensions
-        dims = (
-            len(self.blur_list),
-            len(self.occ_list),
-            len(self.pose_list),
-            len(self.exp_list),
-            len(self.ill_list),
-            len(self.quality_list)
-        )
-        logits_image = logits_image.view(batch_size, *dims)
+        logits_image = logits_image.view(batch_size, *self._dims())
 
         # Quality distribution and score
         quality_dist = logits_image.sum(1).sum(1).sum(1).sum(1).sum(1)
@@ -8,6 +8,7 @@ import torch
 import cv2
 import numpy as np
 from PIL import Image
+from typing import Optional
 from torch import Tensor
 from torch.nn import functional as F
 
@@ -121,6 +122,95 @@ def wavelet_reconstruction(content_feat:Tensor, style_feat:Tensor):
     return content_high_freq + style_low_freq
 
 
+# reach of the low frequency of `wavelet_decomposition`: the sum of its dilations 1 + 2 + ... + 16
+WAVELET_LEVELS = 5
+WAVELET_HALO = 2 ** WAVELET_LEVELS - 1
+
+
+def adain_color_fix_array(
+    target: np.ndarray, source: np.ndarray, out: Optional[np.ndarray] = None, band_rows: int = 1024
+) -> np.ndarray:
+    """`adain_color_fix` on uint8 H x W x C arrays (e.g. BGR images of `cv2.imread`), without float copies of the images.
+
+    The statistics of each channel are computed from its histogram, and the transform, a function of the uint8 value of each channel, is applied as a lookup table, band by band. The result is that of `adain_color_fix` within rounding.
+
+    Args:
+        target (np.ndarray): Image whose colors are fixed, e.g. the output of super-resolution.
+        source (np.ndarray): Image of the reference colors, of any size, e.g. the input of super-resolution.
+        out (np.ndarray | None, optional): Array of the result, e.g. that of `image_store.create`. Defaults to None, i.e. a new array.
+        band_rows (int, optional): Rows of the bands. Defaults to 1024.
+    """
+    assert target.dtype == np.uint8 and source.dtype == np.uint8, 'The images should be uint8 arrays.'
+    assert target.shape[2] == source.shape[2], 'The images should have the same channels.'
+    values = np.arange(256, dtype=np.float64) / 255
+    lut = np.empty((256, 1, target.shape[2]), dtype=np.uint8)
+    for c in range(target.shape[2]):
+        target_mean, target_std = _hist_mean_std(target, c)
+        source_mean, source_std = _hist_mean_std(source, c)
+        fixed = (values - target_mean) / target_std * source_std + source_mean
+        # `ToPILImage` truncates
+        lut[:, 0, c] = (np.clip(fixed, 0, 1) * 255).astype(np.uint8)
+    if out is None:
+        out = np.empty_like(target)
+    for y0 in range(0, target.shape[0], band_rows):
+        out[y0:y0 + band_rows] = cv2.LUT(target[y0:y0 + band_rows], lut)
+    return out
+
+
+def _hist_mean_std(img: np.ndarray, channel: int, eps=1e-5) -> tuple[float, float]:
+    """Mean and std of a uint8 channel in [0, 1], as `calc_mean_std` computes them."""
+    hist = cv2.calcHist([img], [channel], None, [256], [0, 256]).ravel().astype(np.float64)
+    values = np.arange(256, dtype=np.float64) / 255
+    n = hist.sum()
+    mean = (hist * values).sum() / n
+    var = (hist * (values - mean) ** 2).sum() / max(n - 1, 1) + eps
+    return mean, np.sqrt(var)
+
+
+def wavelet_color_fix_array(
+    target: np.ndarray, source: np.ndarray, out: Optional[np.ndarray] = None, band_rows: int = 512
+) -> np.ndarray:
+    """`wavelet_color_fix` on uint8 H x W x C arrays of the same size (e.g. BGR images of `cv2.imread`), in bands of `band_rows` rows.
+
+    Each band is decomposed with a halo of `WAVELET_HALO` rows on each side, the reach of the decomposition, so that the result is that of `wavelet_color_fix` within rounding while at most a band and its halo are held as floats.
+
+    Args:
+        target (np.ndarray): Image whose colors are fixed, its high frequency is kept.
+        source (np.ndarray): Image of the reference colors, its low frequency is kept.
+        out (np.ndarray | None, optional): Array of the result, e.g. that of `image_store.create`. Defaults to None, i.e. a new array.
+        band_rows (int, optional): Rows of the bands. Defaults to 512.
+    """
+    assert target.dtype == np.uint8 and source.dtype == np.uint8, 'The images should be uint8 arrays.'
+    assert target.shape == source.shape, 'The images should have the same size.'
+    h = target.shape[0]
+    result = np.empty_like(target) if out is None else out
+    for y0 in range(0, h, band_rows):
+        y1 = min(y0 + band_rows, h)
+        halo_y0, halo_y1 = max(y0 - WAVELET_HALO, 0), min(y1 + WAVELET_HALO, h)
+        target_band = target[halo_y0:halo_y1].astype(np.float32) / 255
+        source_band = source[halo_y0:halo_y1].astype(np.float32) / 255
+        fixed = target_band - _wavelet_low_freq(target_band) + _wavelet_low_freq(source_band)
+        fixed = fixed[y0 - halo_y0:y1 - halo_y0]
+        # `ToPILImage` truncates
+        result[y0:y1] = (np.clip(fixed, 0, 1) * 255).astype(np.uint8)
+    return result
+
+
+def _wavelet_low_freq(img: np.ndarray, levels=WAVELET_LEVELS) -> np.ndarray:
+    """Low frequency of `wavelet_decomposition` of an H x W x C float array."""
+    for i in range(levels):
+        img = _wavelet_blur_array(img, 2 ** i)
+    return img
+
+
+def _wavelet_blur_array(img: np.ndarray, radius: int) -> np.ndarray:
+    """`wavelet_blur` of an H x W x C float array, the kernel being separable: [1, 2, 1] / 4 dilated by `radius` along each axis, replicate padded."""
+    kernel = np.zeros(2 * radius + 1, dtype=np.float32)
+    kernel[0] = kernel[-1] = 0.25
+    kernel[radius] = 0.5
+    return cv2.sepFilter2D(img, -1, kernel, kernel, borderType=cv2.BORDER_REPLICATE)
+
+
 def cv2_to_pil(cv2_img):
     """
     Convert an OpenCV image (BGR format) to a PIL Image (RGB format).
@@ -1,9 +1,12 @@
 import torch
-import pyiqa
-import gc
+import numpy as np
 from PIL import Image
 import torchvision.transforms as transforms
 
+from .image_handle import image_store
+from .score_store import score_store
+from .metric_registry import metric_registry, PYIQA_VERSION
+
 # Define available IQA metrics
 AVAILABLE_METRICS = {
     # "Q-align": "qalign",
@@ -21,25 +24,64 @@ TARGET_METRICS = {
     "NIQE": "niqe"
 }
 
+# params of the stored scores, the metrics seeing images resized as by `compute_iqa` and by `resize_for_target_metrics`
+IQA_SCORE_PARAMS = {"resize": "compute_iqa", "pyiqa": PYIQA_VERSION}
+TARGET_SCORE_PARAMS = {"resize": "target", "pyiqa": PYIQA_VERSION}
+TARGET_BATCH_SCORE_PARAMS = {"resize": "target_batch", "pyiqa": PYIQA_VERSION}
+
+# images with a larger side are halved before the metrics
+HALVE_ABOVE_SIDE = 4200
+# output rows of the bands of `_halve_by_bands`
+HALVE_BAND_ROWS = 512
+# input rows around a band of `_halve_by_bands`, beyond the reach of the bicubic kernel
+_HALVE_HALO = 4
+
 # Check if GPU is available
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-def image_to_tensor(image_path):
-    """Convert an image to a PyTorch tensor."""
-    image = Image.open(image_path).convert("RGB")
+def image_to_tensor(image_path, halve=False, device=device):
+    """Convert an image to a PyTorch tensor, halved by bicubic interpolation if `halve`. Halving goes band by band, so that the full-resolution float tensor of a large image is never built."""
+    if halve:
+        return _halve_by_bands(image_store.open(image_path), device)
+    image = image_store.open(image_path).pil()
     transform = transforms.ToTensor()
     return transform(image).unsqueeze(0).to(device)  # Add batch dimension and move to device
 
+def _halve_by_bands(handle, device=device):
+    """`interpolate(image_to_tensor(path), scale_factor=0.5, mode='bicubic').clamp(0, 1)` of the image of `handle`. Each band of output rows is interpolated from its input rows and a halo of `_HALVE_HALO` rows, starting on an even row, so that the result is the same."""
+    h, w = handle.shape[:2]
+    out_h = h // 2
+    bands = []
+    for o0 in range(0, out_h, HALVE_BAND_ROWS):
+        o1 = min(o0 + HALVE_BAND_ROWS, out_h)
+        r0 = max(2 * o0 - _HALVE_HALO, 0)
+        band = handle.tile(r0, 0, 2 * o1 + _HALVE_HALO - r0, w)
+        # BGR uint8 -> RGB float in [0, 1], as `ToTensor` of the PIL image
+        band = torch.from_numpy(np.ascontiguousarray(band[..., ::-1].transpose(2, 0, 1))).unsqueeze(0).to(device)
+        band = band.float().div(255)
+        half = torch.nn.functional.interpolate(band, scale_factor=0.5, mode='bicubic', align_corners=False).clamp(0, 1)
+        bands.append(half[:, :, o0 - r0 // 2:o1 - r0 // 2])
+    return torch.cat(bands, dim=2)
+
 def compute_iqa(image_path):
-    """Compute IQA metrics for the given image."""
-    image_tensor = image_to_tensor(image_path)
+    """Compute IQA metrics for the given image. Scores in `score_store` are reused, the image is decoded only if some are missing."""
+    image_height, image_width = image_store.open(image_path).shape[:2]
+    stored = {
+        metric_key: score_store.get(image_path, metric_key, IQA_SCORE_PARAMS)
+        for metric_key in AVAILABLE_METRICS.values()
+    }
+    # the first halving of a large image is done as it is loaded
+    halved = max(image_height, image_width) > HALVE_ABOVE_SIDE
+    image_tensor = None if all(score is not None for score in stored.values()) else image_to_tensor(image_path, halve=halved)
     results = {}
-    image_height = image_tensor.size(2)
-    image_width = image_tensor.size(3)
 
     for metric_name, metric_key in AVAILABLE_METRICS.items():
-        iqa_model = pyiqa.create_metric(metric_key, device=device)
-        iqa_model.to(device)
+        score = stored[metric_key]
+        if image_tensor is None:
+            results[metric_name] = round(score, 4)
+            continue
+
+        # the resizes add up from one metric to the next, they are applied whether the score is stored or not
         _, _, h, w = image_tensor.size()
 
         if max(h, w) <= 120:
@@ -52,29 +94,39 @@ def compute_iqa(image_path):
             image_tensor = torch.nn.functional.interpolate(image_tensor, scale_factor=2, mode='bicubic', align_corners=False)
             image_tensor = image_tensor.clamp(0, 1)
         
-        if max(h, w) > 4200:
+        if max(h, w) > HALVE_ABOVE_SIDE and not halved:
             # downscale the image_tensor with scale factor 0.5, bicubic
             image_tensor = torch.nn.functional.interpolate(image_tensor, scale_factor=0.5, mode='bicubic', align_corners=False)
             image_tensor = image_tensor.clamp(0, 1)
+        halved = False
         
-        score = iqa_model(image_tensor).item()
+        if score is None:
+            with metric_registry.use(metric_key) as iqa_model:
+                score = iqa_model(image_tensor).item()
+            score_store.put(image_path, metric_key, score, IQA_SCORE_PARAMS)
         results[metric_name] = round(score, 4)
 
     # Release memory
-    del image_tensor, iqa_model
-    torch.cuda.empty_cache()
+    if image_tensor is not None:
+        del image_tensor
+        torch.cuda.empty_cache()
 
     # Format results
     result_str = "\n".join([f"{metric}: {score}" for metric, score in results.items()])
     return result_str, image_height, image_width
 
 
-def compute_iqa_metric_score(image_path):
-    """Compute IQA metrics for the given image. Metric target"""
-    image_tensor = image_to_tensor(image_path)
-    results = {}
-    # image_height = image_tensor.size(2)
-    # image_width = image_tensor.size(3)
+# Weights of the target metrics in the reflection score
+TARGET_METRIC_WEIGHTS = {
+    "CLIPIQA+": 1.0,
+    "MANIQA": 1.0,
+    "MUSIQ": 0.01,
+    "NIQE": 1.0
+}
+
+
+def resize_for_target_metrics(image_tensor):
+    """Resize the image tensor to the working range of the target metrics, as `compute_iqa_metric_score` does."""
     _, _, h, w = image_tensor.size()
     
     if max(h, w) <= 120:
@@ -92,23 +144,20 @@ def compute_iqa_metric_score(image_path):
         image_tensor = torch.nn.functional.interpolate(image_tensor, scale_factor=0.5, mode='bicubic', align_corners=False)
         image_tensor = image_tensor.clamp(0, 1)
 
-    for metric_name, metric_key in TARGET_METRICS.items():
-        iqa_model = pyiqa.create_metric(metric_key, device=device)
-        iqa_model.to(device)
-        score = iqa_model(image_tensor).item()
-        results[metric_name] = round(score, 4)
-        del iqa_model
-        # Release memory
-        gc.collect()
-        torch.cuda.empty_cache()
-    
-    # Define weights for each metric
-    weights = {
-        "CLIPIQA+": 1.0,
-        "MANIQA": 1.0,
-        "MUSIQ": 0.01,
-        "NIQE": 1.0
-    }
+    return image_tensor
+
+
+def target_metric_tensor(image_path, device=device):
+    """`resize_for_target_metrics(image_to_tensor(image_path))`, large images being halved band by band."""
+    h, w = image_store.open(image_path).shape[:2]
+    if max(h, w) > HALVE_ABOVE_SIDE:
+        return image_to_tensor(image_path, halve=True, device=device)
+    return resize_for_target_metrics(image_to_tensor(image_path, device=device))
+
+
+def weighted_target_metric_score(results):
+    """Combine the rounded target metric scores into the reflection metric score."""
+    weights = TARGET_METRIC_WEIGHTS
 
     # Compute weighted sum
     weighted_score = sum(
@@ -116,20 +165,36 @@ def compute_iqa_metric_score(image_path):
         for metric in results
     )
     weighted_score = round(weighted_score, 4) / len(results)
+    return weighted_score
+
+
+def compute_iqa_metric_score(image_path):
+    """Compute IQA metrics for the given image. Metric target"""
+    image_tensor = None
+    results = {}
+
+    for metric_name, metric_key in TARGET_METRICS.items():
+        score = score_store.get(image_path, metric_key, TARGET_SCORE_PARAMS)
+        if score is None:
+            if image_tensor is None:
+                image_tensor = target_metric_tensor(image_path)
+            with metric_registry.use(metric_key) as iqa_model:
+                score = iqa_model(image_tensor).item()
+            score_store.put(image_path, metric_key, score, TARGET_SCORE_PARAMS)
+        results[metric_name] = round(score, 4)
+    
+    weighted_score = weighted_target_metric_score(results)
 
     # Release memory
-    del image_tensor
-    torch.cuda.empty_cache()
+    if image_tensor is not None:
+        del image_tensor
+        torch.cuda.empty_cache()
 
     return weighted_score
 
 
 def compute_iqa_metric_score_batch(image_paths: list[str]) -> list[float]:
     """Compute IQA metric scores for a batch of images, reusing IQA models."""
-    models = {
-        metric_name: pyiqa.create_metric(metric_key, device=device).to(device)
-        for metric_name, metric_key in TARGET_METRICS.items()
-    }
 
     weights = {
         "CLIPIQA+": 1.0,
@@ -142,19 +207,23 @@ def compute_iqa_metric_score_batch(image_paths: list[str]) -> list[float]:
 
     for image_path in image_paths:
         try:
-            image_tensor = image_to_tensor(image_path)
-            _, _, h, w = image_tensor.size()
-
-            if max(h, w) <= 120:
-                image_tensor = torch.nn.functional.interpolate(image_tensor, scale_factor=4, mode='bicubic', align_corners=False).clamp(0, 1)
-            elif max(h, w) <= 240:
-                image_tensor = torch.nn.functional.interpolate(image_tensor, scale_factor=2, mode='bicubic', align_corners=False).clamp(0, 1)
-            elif max(h, w) > 4200:
-                image_tensor = torch.nn.functional.interpolate(image_tensor, scale_factor=0.5, mode='bicubic', align_corners=False).clamp(0, 1)
-                
+            image_tensor = None
             results = {}
-            for metric_name, model in models.items():
-                score = model(image_tensor).item()
+            for metric_name, metric_key in TARGET_METRICS.items():
+                score = score_store.get(image_path, metric_key, TARGET_BATCH_SCORE_PARAMS)
+                if score is None:
+                    if image_tensor is None:
+                        h, w = image_store.open(image_path).shape[:2]
+                        image_tensor = image_to_tensor(image_path, halve=max(h, w) > HALVE_ABOVE_SIDE)
+
+                        if max(h, w) <= 120:
+                            image_tensor = torch.nn.functional.interpolate(image_tensor, scale_factor=4, mode='bicubic', align_corners=False).clamp(0, 1)
+                        elif max(h, w) <= 240:
+                            image_tensor = torch.nn.functional.interpolate(image_tensor, scale_factor=2, mode='bicubic', align_corners=False).clamp(0, 1)
+
+                    with metric_registry.use(metric_key) as model:
+                        score = model(image_tensor).item()
+                    score_store.put(image_path, metric_key, score, TARGET_BATCH_SCORE_PARAMS)
                 results[metric_name] = round(score, 4)
                 
             weighted_score = sum(
@@ -164,16 +233,13 @@ def compute_iqa_metric_score_batch(image_paths: list[str]) -> list[float]:
             weighted_score = round(weighted_score / len(results), 4)
             scores.append(weighted_score)
             
-            del image_tensor
-            torch.cuda.empty_cache()
+            if image_tensor is not None:
+                del image_tensor
+                torch.cuda.empty_cache()
 
         except Exception as e:
             print(f"[Warning] Failed to process {image_path}: {e}")
             scores.append(None)
-            
-    for model in models.values():
-        del model
-    torch.cuda.empty_cache()
 
     return scores
 
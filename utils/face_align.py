@@ -0,0 +1,166 @@
+"""Face alignment helpers for restoring faces on an upscaled image without running the face detector on the whole of it.
+
+The landmarks found on the input image are projected onto the upscaled image (`project_landmarks`), refined by detecting faces only in padded boxes around the projected faces (`refine_landmarks`), and the restored faces are pasted back within the bounding box of each face (`paste_faces`). The blending of `paste_faces` is that of `FaceRestoreHelper.paste_faces_to_input_image` of facexlib.
+"""
+
+from typing import Optional
+
+import cv2
+import numpy as np
+import torch
+from torchvision.transforms.functional import normalize
+from facexlib.utils.misc import img2tensor
+from facexlib.utils.face_restoration_helper import FaceRestoreHelper
+
+
+# padding of the detection box of a face, relative to the size of the face
+REDETECT_PAD_RATIO = 1.0
+# max side of the detection box, larger boxes are downscaled before detection
+REDETECT_MAX_SIDE = 1024
+# rows of the bands in which the image is copied to the result of `paste_faces`
+COPY_BAND_ROWS = 1024
+# labels of the face parsing net kept in the paste mask, as in facexlib
+_PARSE_MASK_COLORMAP = [0, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 0, 255, 0, 0, 0]
+
+
+def project_landmarks(
+    landmarks: list[np.ndarray], src_shape: tuple[int, ...], dst_shape: tuple[int, ...], tolerance: float = 0.01
+) -> Optional[list[np.ndarray]]:
+    """Landmarks found on an image of shape `src_shape`, moved to the same image resized to `dst_shape`. Returns None if `dst_shape` is not a uniform scaling of `src_shape` within `tolerance`, e.g. the image was cropped or padded."""
+    scale_y = dst_shape[0] / src_shape[0]
+    scale_x = dst_shape[1] / src_shape[1]
+    if abs(scale_x - scale_y) > tolerance * max(scale_x, scale_y):
+        return None
+    # pixel centers: (x + 0.5) * scale - 0.5
+    return [
+        (landmark + 0.5) * np.array([scale_x, scale_y]) - 0.5 for landmark in landmarks
+    ]
+
+
+def _face_box(landmark: np.ndarray, pad_ratio: float, img_shape: tuple[int, ...]) -> tuple[int, int, int, int]:
+    """Padded box (x0, y0, x1, y1) around the face of the 5 landmarks, clipped to the image."""
+    size = max(np.ptp(landmark[:, 0]), np.ptp(landmark[:, 1]), 1.) * 2  # landmarks span about half of the face
+    center = landmark.mean(axis=0)
+    half = size * (0.5 + pad_ratio)
+    h, w = img_shape[:2]
+    x0, y0 = max(int(center[0] - half), 0), max(int(center[1] - half), 0)
+    x1, y1 = min(int(np.ceil(center[0] + half)), w), min(int(np.ceil(center[1] + half)), h)
+    return x0, y0, x1, y1
+
+
+def refine_landmarks(
+    face_helper: FaceRestoreHelper,
+    img: np.ndarray,
+    landmarks: list[np.ndarray],
+    pad_ratio: float = REDETECT_PAD_RATIO,
+    max_side: int = REDETECT_MAX_SIDE,
+) -> tuple[list[np.ndarray], int]:
+    """Re-detects each face of `landmarks` within a padded box around it, keeping the detection closest to the projected face. Faces not found in their box keep their projected landmarks. Returns the landmarks and the number of faces found.
+
+    Args:
+        face_helper (FaceRestoreHelper): Helper whose face detector is used.
+        img (np.ndarray): BGR image.
+        landmarks (list[np.ndarray]): 5x2 landmarks of each face, projected onto `img`.
+        pad_ratio (float, optional): Padding of the detection boxes, relative to the size of the face. Defaults to 1.
+        max_side (int, optional): Max side of the detection boxes, larger boxes are downscaled. Defaults to 1024.
+    """
+    refined = []
+    n_found = 0
+    for landmark in landmarks:
+        x0, y0, x1, y1 = _face_box(landmark, pad_ratio, img.shape)
+        crop = img[y0:y1, x0:x1]
+        scale = min(max_side / max(crop.shape[:2]), 1.)
+        if scale < 1:
+            crop = cv2.resize(crop, (round(crop.shape[1] * scale), round(crop.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+        with torch.no_grad():
+            bboxes = face_helper.face_det.detect_faces(crop, 0.97)
+        candidates = [
+            np.array([[bbox[i], bbox[i + 1]] for i in range(5, 15, 2)]) / scale + np.array([x0, y0])
+            for bbox in bboxes
+        ]
+        # the detection must be the same face, not a neighbour caught by the padding
+        tolerance = np.linalg.norm(landmark[0] - landmark[1]) / 2
+        candidates = [
+            candidate for candidate in candidates
+            if np.linalg.norm(candidate.mean(axis=0) - landmark.mean(axis=0)) < tolerance
+        ]
+        if candidates:
+            refined.append(min(candidates, key=lambda c: np.linalg.norm(c.mean(axis=0) - landmark.mean(axis=0))))
+            n_found += 1
+        else:
+            refined.append(landmark)
+    return refined, n_found
+
+
+def paste_faces(face_helper: FaceRestoreHelper, img: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """`face_helper.paste_faces_to_input_image(upsample_img=img)` for an upscale factor of 1 and a BGR uint8 image, warping and blending each face within its bounding box instead of the whole image. Expects `get_inverse_affine` to have been called.
+
+    The result is written to `out` if given (e.g. the array of `image_store.create`), copied from `img` band by band, otherwise to a copy of `img`.
+    """
+    assert len(face_helper.restored_faces) == len(face_helper.inverse_affine_matrices), \
+        'length of restored_faces and affine_matrices are different.'
+    h, w = img.shape[:2]
+    if out is None:
+        img = img.copy()
+    else:
+        for y0 in range(0, h, COPY_BAND_ROWS):
+            out[y0:y0 + COPY_BAND_ROWS] = img[y0:y0 + COPY_BAND_ROWS]
+        img = out
+    for restored_face, inverse_affine in zip(face_helper.restored_faces, face_helper.inverse_affine_matrices):
+        face_h, face_w = restored_face.shape[:2]
+        corners = np.array([[0, 0, 1], [face_w, 0, 1], [0, face_h, 1], [face_w, face_h, 1]], dtype=np.float64)
+        corners = corners @ inverse_affine.T
+        face_area = abs(np.linalg.det(inverse_affine[:, :2])) * face_h * face_w
+        # margin for the erosion and the blur of the square mask
+        margin = int(face_area ** 0.5) // 10 + 4
+        x0 = max(int(np.floor(corners[:, 0].min())) - margin, 0)
+        y0 = max(int(np.floor(corners[:, 1].min())) - margin, 0)
+        x1 = min(int(np.ceil(corners[:, 0].max())) + margin, w)
+        y1 = min(int(np.ceil(corners[:, 1].max())) + margin, h)
+        if x0 >= x1 or y0 >= y1:
+            continue  # face out of the image
+        roi_size = (x1 - x0, y1 - y0)
+        roi_affine = inverse_affine.copy()
+        roi_affine[:, 2] -= (x0, y0)
+
+        inv_restored = cv2.warpAffine(restored_face, roi_affine, roi_size)
+        if face_helper.use_parse:
+            mask = _parse_mask(face_helper, restored_face)
+            inv_soft_mask = cv2.warpAffine(mask, roi_affine, roi_size, flags=3)[:, :, None]
+            pasted_face = inv_restored
+        else:
+            inv_mask = cv2.warpAffine(np.ones(face_helper.face_size, dtype=np.float32), roi_affine, roi_size)
+            inv_mask_erosion = cv2.erode(inv_mask, np.ones((2, 2), np.uint8))
+            pasted_face = inv_mask_erosion[:, :, None] * inv_restored
+            w_edge = int(np.sum(inv_mask_erosion) ** 0.5) // 20
+            inv_mask_center = cv2.erode(inv_mask_erosion, np.ones((w_edge * 2, w_edge * 2), np.uint8))
+            inv_soft_mask = cv2.GaussianBlur(inv_mask_center, (w_edge * 2 + 1, w_edge * 2 + 1), 0)[:, :, None]
+
+        roi = img[y0:y1, x0:x1]
+        img[y0:y1, x0:x1] = (inv_soft_mask * pasted_face + (1 - inv_soft_mask) * roi).astype(np.uint8)
+    return img
+
+
+def _parse_mask(face_helper: FaceRestoreHelper, restored_face: np.ndarray) -> np.ndarray:
+    """Soft mask of the face in `restored_face`, from the face parsing net of `face_helper`."""
+    face_input = cv2.resize(restored_face, (512, 512), interpolation=cv2.INTER_LINEAR)
+    face_input = img2tensor(face_input.astype('float32') / 255., bgr2rgb=True, float32=True)
+    normalize(face_input, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+    face_input = torch.unsqueeze(face_input, 0).to(face_helper.device)
+    with torch.no_grad():
+        out = face_helper.face_parse(face_input)[0]
+    out = out.argmax(dim=1).squeeze().cpu().numpy()
+
+    mask = np.zeros(out.shape)
+    for idx, color in enumerate(_PARSE_MASK_COLORMAP):
+        mask[out == idx] = color
+    mask = cv2.GaussianBlur(mask, (101, 101), 11)
+    mask = cv2.GaussianBlur(mask, (101, 101), 11)
+    # remove the black borders
+    thres = 10
+    mask[:thres, :] = 0
+    mask[-thres:, :] = 0
+    mask[:, :thres] = 0
+    mask[:, -thres:] = 0
+    mask = mask / 255.
+    return cv2.resize(mask, restored_face.shape[:2])
@@ -0,0 +1,140 @@
+import gc
+import math
+import threading
+from pathlib import Path
+from typing import Optional
+
+import torch
+import numpy as np
+
+from .config import Config
+from .resnet import resnet_face18
+from .score_store import score_store
+from .image_handle import image_store
+from .reflection_scorer import ReflectionScorer
+from .scorer import load_image, cosin_metric, load_checkpoint
+from .clib_fiqa.face_iqa_analyzer import CLIBFIQAScorer
+
+
+DEFAULT_CKPT_DIR = Path(__file__).resolve().parents[1] / "pretrained_ckpts" / "Face_eval"
+
+
+class FaceScorer:
+    """Scores restored faces against the faces of the input image for `Imagent.face_restore`, keeping the models loaded between calls:
+
+    `CLIB-FIQA quality + metric score - identity distance / 1000`
+
+    The identity distance is that of `calculate_cos_dist` (angle in degrees between the `resnet_face18` embeddings), the quality that of `compute_face_scores`, and the metric score that of `compute_iqa_metric_score`, computed by the reflection scorer. Qualities and distances are read through `score_store`, the distances keyed by the input face. The embeddings of the faces of the input image are computed once per face, and the text features of CLIB-FIQA once per weights, cached on disk in `cache_dir`. Calls from several threads are serialized.
+
+    Args:
+        reflection_scorer (ReflectionScorer): Scorer of the metric scores, sharing its loaded metrics.
+        batch_size (int, optional): Maximum number of faces per forward pass. Defaults to 8.
+        ckpt_dir (Path | None, optional): Directory of `resnet18_110.pth` and `clib_fiqa/{RN50.pt, CLIB-FIQA_R50.pth}`. Defaults to None, i.e. `pretrained_ckpts/Face_eval`.
+        cache_dir (Path | None, optional): Directory of the cached text features, None keeps them in memory only. Defaults to None.
+        device (str | None, optional): Defaults to "cuda" if available, otherwise "cpu".
+    """
+
+    def __init__(
+        self,
+        reflection_scorer: ReflectionScorer,
+        batch_size: int = 8,
+        ckpt_dir: Optional[Path] = None,
+        cache_dir: Optional[Path] = None,
+        device: Optional[str] = None,
+    ):
+        self.reflection_scorer = reflection_scorer
+        self.batch_size = max(1, batch_size)
+        self.ckpt_dir = Path(ckpt_dir) if ckpt_dir is not None else DEFAULT_CKPT_DIR
+        self.cache_dir = cache_dir
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self._identity_model: Optional[torch.nn.Module] = None
+        self._fiqa: Optional[CLIBFIQAScorer] = None
+        # path of a face -> (stat, embedding), the input faces being scored against every candidate
+        self._embeddings: dict[str, tuple[tuple[int, int], np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def score(self, faces: list[tuple[Path, Path]]) -> list[float]:
+        """Combined scores of `(restored face, input face)` pairs, in order."""
+        if not faces:
+            return []
+        restored_paths = list(dict.fromkeys(str(restored) for restored, _ in faces))
+        metric_scores = dict(zip(restored_paths, self.reflection_scorer.metric_scores(restored_paths)))
+        with self._lock:
+            quality_scores = dict(zip(restored_paths, score_store.scores(restored_paths, "clib_fiqa", self._quality_scores)))
+            distances = self._identity_distances([(str(restored), str(ori)) for restored, ori in faces])
+        return [
+            quality_scores[str(restored)] + metric_scores[str(restored)] - (distance / 1000)
+            for (restored, _), distance in zip(faces, distances)
+        ]
+
+    def release(self) -> None:
+        """Unloads the models, the cached text features stay on disk."""
+        with self._lock:
+            self._identity_model = self._fiqa = None
+            self._embeddings.clear()
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def _load_identity_model(self) -> None:
+        model = resnet_face18(Config().use_se)
+        # the checkpoint is that of a `DataParallel` model
+        state_dict = load_checkpoint(self.ckpt_dir / "resnet18_110.pth", map_location="cpu")
+        model.load_state_dict({k.removeprefix("module."): v for k, v in state_dict.items()})
+        self._identity_model = model.to(self.device).eval()
+
+    def _identity_distances(self, pairs: list[tuple[str, str]]) -> list[float]:
+        distances = [0.] * len(pairs)
+        for ori in dict.fromkeys(ori for _, ori in pairs):
+            indices = [idx for idx, (_, pair_ori) in enumerate(pairs) if pair_ori == ori]
+            params = {"ref": score_store.digest(ori)} if score_store.enabled else None
+            ori_distances = score_store.scores(
+                [pairs[idx][0] for idx in indices],
+                "face_identity_deg",
+                lambda paths, ori=ori: self._compute_identity_distances([(path, ori) for path in paths]),
+                params,
+            )
+            for idx, distance in zip(indices, ori_distances):
+                distances[idx] = distance
+        return distances
+
+    def _compute_identity_distances(self, pairs: list[tuple[str, str]]) -> list[float]:
+        if self._identity_model is None:
+            self._load_identity_model()
+        embeddings = self._embed(list(dict.fromkeys(path for pair in pairs for path in pair)))
+        return [
+            np.arccos(cosin_metric(embeddings[restored], embeddings[ori])) / math.pi * 180
+            for restored, ori in pairs
+        ]
+
+    def _embed(self, paths: list[str]) -> dict[str, np.ndarray]:
+        """`resnet_face18` embeddings of `paths`, those of unchanged files being reused."""
+        embeddings = {}
+        missing = []
+        for path in paths:
+            stat = image_store.open(path).stat
+            cached = self._embeddings.get(path)
+            if cached is not None and cached[0] == stat:
+                embeddings[path] = cached[1]
+            else:
+                missing.append(path)
+        with torch.no_grad():
+            for i in range(0, len(missing), self.batch_size):
+                batch_paths = missing[i:i + self.batch_size]
+                data = torch.stack([load_image(path) for path in batch_paths]).to(self.device)
+                for path, embedding in zip(batch_paths, self._identity_model(data).cpu().numpy()):
+                    embeddings[path] = embedding
+                    self._embeddings[path] = (image_store.open(path).stat, embedding)
+        return embeddings
+
+    def _quality_scores(self, paths: list[str]) -> list[float]:
+        if self._fiqa is None:
+            self._fiqa = CLIBFIQAScorer(
+                clip_model_path=str(self.ckpt_dir / "clib_fiqa" / "RN50.pt"),
+                clip_weights_path=str(self.ckpt_dir / "clib_fiqa" / "CLIB-FIQA_R50.pth"),
+                device=self.device,
+                text_cache_dir=None if self.cache_dir is None else str(self.cache_dir),
+            )
+        scores = []
+        for i in range(0, len(paths), self.batch_size):
+            scores += self._fiqa.quality_scores([image_store.open(path).pil() for path in paths[i:i + self.batch_size]])
+        return scores
@@ -0,0 +1,60 @@
+"""Content hashes of files, memoized on (path, size, mtime) so that a file is read once while it does not change. Shared by the tool output cache and the score store.
+
+The memo is an LRU of `MEMO_MAX_ENTRIES` entries, keyed by the hash function as well: `content_hash` and `file_fingerprint` of the same file are different values."""
+
+import os
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+
+_HASH_CHUNK_SIZE = 1 << 20
+MEMO_MAX_ENTRIES = 16384
+# (hash function, path, size, mtime_ns) -> hash, least recently used first
+_memo: OrderedDict[tuple[str, str, int, int], str] = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def _memoized(path: Path, fn) -> str:
+    stat = path.stat()
+    memo_key = (fn.__name__, str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    with _memo_lock:
+        if memo_key in _memo:
+            _memo.move_to_end(memo_key)
+            return _memo[memo_key]
+    value = fn(path, stat.st_size)
+    with _memo_lock:
+        _memo[memo_key] = value
+        _memo.move_to_end(memo_key)
+        while len(_memo) > MEMO_MAX_ENTRIES:
+            _memo.popitem(last=False)
+    return value
+
+
+def _sha256_file(path: Path, size: int) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _sha256_head_tail(path: Path, size: int) -> str:
+    h = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(_HASH_CHUNK_SIZE))
+        if size > 2 * _HASH_CHUNK_SIZE:
+            f.seek(-_HASH_CHUNK_SIZE, os.SEEK_END)
+            h.update(f.read(_HASH_CHUNK_SIZE))
+    return h.hexdigest()
+
+
+def content_hash(path: Path) -> str:
+    """SHA-256 of the file content, memoized on (path, size, mtime)."""
+    return _memoized(Path(path), _sha256_file)
+
+
+def file_fingerprint(path: Path) -> str:
+    """Cheap fingerprint of a possibly huge file (e.g. a checkpoint): its size and the hash of its first and last MiB, memoized on (path, size, mtime)."""
+    return _memoized(Path(path), _sha256_head_tail)
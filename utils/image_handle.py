@@ -0,0 +1,283 @@
+"""Decoded images shared by the pipeline, the scorers and the warm tool workers, so that an image is decoded from PNG once rather than by every consumer.
+
+An `ImageHandle` holds a decoded image (H x W x 3 uint8 BGR, as returned by `cv2.imread`) in a raw memory-mapped `.npy` file of the spool directory, on tmpfs when available. Consumers in this process map it through `image_store`, and warm tool workers map it when a script calls `cv2.imread` on the PNG (see `executor/worker.py`).
+
+Images produced by the pipeline itself (e.g. color fixes, pasted faces) are put in the store and their PNG is written by a background thread, at the compression level of the store if set. Readers going through the store see the new image at once; readers of the file (tools, VLMs, copies) must call `image_store.flush(path)` first.
+
+Images larger than the memory cap of the store and `DISK_SPOOL_MIN_BYTES` (e.g. 8K/16K outputs) are mapped from a raw file on disk rather than tmpfs, so that their pages can be dropped under memory pressure instead of swapped. Stages working on them go through `ImageHandle.tile` and `ImageHandle.bands`, and write their result band by band into a handle of `image_store.create`, published by `image_store.commit`, so that no full-frame copy is made:
+```
+out = image_store.create(path, handle.shape)
+for y0, y1, halo_y0, band in handle.bands(512):
+    out.array[y0:y1] = process(band)
+image_store.commit(out)
+```
+"""
+
+import os
+import uuid
+import atexit
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Iterator, Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+DEFAULT_SPOOL_MB = 4096
+# images over the cap and this size (e.g. 8K and larger) are mapped from disk rather than copied in memory
+DISK_SPOOL_MIN_BYTES = 192 * 1024 ** 2
+# rows of the bands of `ImageHandle.bands`, 48 MiB of uint8 BGR at 16K
+DEFAULT_BAND_ROWS = 1024
+
+
+def _file_stat(path: str) -> Optional[tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class ImageHandle:
+    """A decoded image of `path`. `array` is read-only and stays valid after the handle is evicted from the store."""
+
+    def __init__(self, path: str, array: np.ndarray, raw_path: Optional[str] = None):
+        self.path = path
+        self.array = array
+        self.raw_path = raw_path
+        self.stat: Optional[tuple[int, int]] = None  # (mtime_ns, size) of the PNG matching `array`
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.array.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes
+
+    def copy(self) -> np.ndarray:
+        """A writable copy, as `cv2.imread` would return."""
+        return np.array(self.array)
+
+    def pil(self) -> Image.Image:
+        """RGB PIL image, as `Image.open(path).convert("RGB")` would return."""
+        return Image.fromarray(np.ascontiguousarray(self.array[..., ::-1]))
+
+    def tile(self, y0: int, x0: int, h: int, w: int) -> np.ndarray:
+        """Read-only view of the `h` x `w` tile at (`y0`, `x0`), clipped to the image. Only the pages of the tile are read from the raw file."""
+        return self.array[max(y0, 0):max(y0 + h, 0), max(x0, 0):max(x0 + w, 0)]
+
+    def bands(self, band_rows: int = DEFAULT_BAND_ROWS, halo: int = 0) -> Iterator[tuple[int, int, int, np.ndarray]]:
+        """Full-width bands of `band_rows` rows, top to bottom, each with `halo` rows above and below, clipped to the image. Yields `(y0, y1, halo_y0, band)`: rows `y0:y1` of the image are rows `y0 - halo_y0:y1 - halo_y0` of `band`, a read-only view of rows `halo_y0:` of the image."""
+        h = self.shape[0]
+        for y0 in range(0, h, max(1, band_rows)):
+            y1 = min(y0 + band_rows, h)
+            halo_y0 = max(y0 - halo, 0)
+            yield y0, y1, halo_y0, self.array[halo_y0:min(y1 + halo, h)]
+
+
+class ImageStore:
+    """Process-wide registry of `ImageHandle`s keyed by PNG path, least recently used handles being evicted beyond `max_mb`. Thread safe.
+
+    Args:
+        spool_dir (Path | None, optional): Directory of the raw files. Defaults to None, i.e. a directory under `/dev/shm` if it exists, else under the temporary directory.
+        max_mb (int, optional): Memory cap of the handles, 0 keeps no image besides those waiting for their PNG. Defaults to 4096.
+        png_compression (int | None, optional): Compression level (0-9) of the PNGs written by the store. Defaults to None, i.e. OpenCV's default, its fastest setting.
+    """
+
+    def __init__(self, spool_dir: Optional[Path] = None, max_mb: int = DEFAULT_SPOOL_MB, png_compression: Optional[int] = None):
+        self._lock = threading.Lock()
+        self._handles: OrderedDict[str, ImageHandle] = OrderedDict()
+        self._pending: dict[str, Future] = {}
+        self._n_bytes = 0
+        self._exporter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="png_export")
+        self._spool_dir: Optional[str] = None
+        self._disk_spool_dir: Optional[str] = None  # raw files of the images over the cap
+        self.png_compression = png_compression
+        self.configure(spool_dir, max_mb)
+        atexit.register(self.close)
+
+    def configure(
+        self, spool_dir: Optional[Path] = None, max_mb: Optional[int] = None, png_compression: Optional[int] = None
+    ) -> None:
+        """Sets the spool directory, the memory cap (kept if None) and the PNG compression level."""
+        with self._lock:
+            self.png_compression = png_compression
+            if max_mb is not None:
+                self.max_bytes = max_mb * 1024 ** 2
+            parent = str(Path(spool_dir).expanduser()) if spool_dir is not None else \
+                "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            if self._spool_dir is not None and os.path.dirname(self._spool_dir) != parent:
+                # mapped arrays of the handles outlive their files
+                shutil.rmtree(self._spool_dir, ignore_errors=True)
+                self._spool_dir = None
+                for handle in self._handles.values():
+                    handle.raw_path = None
+            self._spool_parent = parent
+            self._evict()
+
+    def open(self, path: Path | str) -> ImageHandle:
+        """The handle of the image at `path`, decoded if the store has no up-to-date one. Raises `FileNotFoundError` if the image cannot be read."""
+        key = os.path.abspath(path)
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and (key in self._pending or handle.stat == _file_stat(key)):
+                self._handles.move_to_end(key)
+                return handle
+        stat = _file_stat(key)
+        img = cv2.imread(key, cv2.IMREAD_COLOR)
+        if img is None:
+            raise FileNotFoundError(f"Cannot read image {path}.")
+        handle = self._new_handle(key, img)
+        handle.stat = stat
+        with self._lock:
+            if key in self._pending:
+                # put while decoding, the put image is newer
+                return self._handles[key]
+            self._add(key, handle)
+        return handle
+
+    def read(self, path: Path | str) -> np.ndarray:
+        """Drop-in for `cv2.imread(path)`: a writable copy of the image."""
+        return self.open(path).copy()
+
+    def put(self, path: Path | str, img: np.ndarray) -> ImageHandle:
+        """Makes `img` the image of `path` and writes its PNG in the background, atomically."""
+        key = os.path.abspath(path)
+        handle = self._new_handle(key, img)
+        self._publish(key, handle)
+        return handle
+
+    def create(self, path: Path | str, shape: tuple[int, ...], dtype: np.dtype = np.uint8) -> ImageHandle:
+        """A handle of a new, zeroed image of `shape` for `path`, whose `array` is writable, e.g. band by band. The image is not that of `path` until `commit`."""
+        key = os.path.abspath(path)
+        raw_path = self._new_raw_path(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return ImageHandle(key, np.lib.format.open_memmap(raw_path, mode="w+", dtype=dtype, shape=tuple(shape)), raw_path)
+
+    def commit(self, handle: ImageHandle) -> ImageHandle:
+        """Makes the image of `handle`, from `create`, the image of its path and writes its PNG in the background, atomically. The array of the handle becomes read-only."""
+        handle.array.flush()
+        handle.array.flags.writeable = False
+        self._publish(handle.path, handle)
+        return handle
+
+    def flush(self, path: Optional[Path | str] = None) -> None:
+        """Waits for the PNG of `path` (all pending PNGs if None) to be written. Raises the error of a failed write."""
+        with self._lock:
+            if path is None:
+                futures = list(self._pending.values())
+            else:
+                future = self._pending.get(os.path.abspath(path))
+                futures = [future] if future is not None else []
+        for future in futures:
+            future.result()
+
+    def raw_spec(self, path: Path | str) -> Optional[dict]:
+        """What a worker process needs to map the image of `path` instead of decoding it: `{"path", "raw_path", "stat"}` with the real path of the PNG, or None if there is no shareable up-to-date handle."""
+        key = os.path.abspath(path)
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is None or handle.raw_path is None or key in self._pending:
+                return None
+            stat = _file_stat(key)
+            if handle.stat != stat:
+                return None
+            return {"path": os.path.realpath(key), "raw_path": handle.raw_path, "stat": list(stat)}
+
+    def discard(self, path: Path | str) -> None:
+        self.flush(path)
+        with self._lock:
+            handle = self._handles.pop(os.path.abspath(path), None)
+            if handle is not None:
+                self._drop(handle)
+
+    def close(self) -> None:
+        self._exporter.shutdown(wait=True)
+        with self._lock:
+            self._handles.clear()
+            self._n_bytes = 0
+            for spool_dir in (self._spool_dir, self._disk_spool_dir):
+                if spool_dir is not None:
+                    shutil.rmtree(spool_dir, ignore_errors=True)
+
+    def _new_handle(self, key: str, img: np.ndarray) -> ImageHandle:
+        img = np.ascontiguousarray(img)
+        if self.max_bytes < img.nbytes < DISK_SPOOL_MIN_BYTES:
+            array = img.copy()
+            array.flags.writeable = False
+            return ImageHandle(key, array)
+        raw_path = self._new_raw_path(img.nbytes)
+        array = np.lib.format.open_memmap(raw_path, mode="w+", dtype=img.dtype, shape=img.shape)
+        array[...] = img
+        array.flush()
+        array.flags.writeable = False
+        return ImageHandle(key, array, raw_path)
+
+    def _new_raw_path(self, n_bytes: int) -> str:
+        """Path of a new raw file: in the spool directory, or on disk for images over the cap (see `DISK_SPOOL_MIN_BYTES`), whose pages are then dropped rather than swapped under memory pressure."""
+        with self._lock:
+            if n_bytes <= self.max_bytes:
+                if self._spool_dir is None:
+                    os.makedirs(self._spool_parent, exist_ok=True)
+                    self._spool_dir = tempfile.mkdtemp(prefix="imagent_images_", dir=self._spool_parent)
+                spool_dir = self._spool_dir
+            else:
+                if self._disk_spool_dir is None:
+                    self._disk_spool_dir = tempfile.mkdtemp(prefix="imagent_large_images_", dir=tempfile.gettempdir())
+                spool_dir = self._disk_spool_dir
+            return os.path.join(spool_dir, f"{uuid.uuid4().hex}.npy")
+
+    def _publish(self, key: str, handle: ImageHandle) -> None:
+        with self._lock:
+            self._add(key, handle)
+            self._pending[key] = self._exporter.submit(self._export, key, handle)
+
+    def _add(self, key: str, handle: ImageHandle) -> None:
+        old_handle = self._handles.pop(key, None)
+        if old_handle is not None:
+            self._drop(old_handle)
+        self._handles[key] = handle
+        self._n_bytes += handle.nbytes
+        self._evict()
+
+    def _drop(self, handle: ImageHandle) -> None:
+        self._n_bytes -= handle.nbytes
+        if handle.raw_path is not None:
+            try:
+                os.remove(handle.raw_path)
+            except OSError:
+                pass
+
+    def _evict(self) -> None:
+        for key in list(self._handles):
+            if self._n_bytes <= self.max_bytes:
+                break
+            if key not in self._pending:
+                self._drop(self._handles.pop(key))
+
+    def _export(self, key: str, handle: ImageHandle) -> None:
+        try:
+            with self._lock:
+                if self._handles.get(key) is not handle:
+                    return  # superseded by a later put, whose export follows
+            tmp_path = os.path.join(os.path.dirname(key), f".tmp-{os.path.basename(key)}")
+            # OpenCV's default is level 1 with run-length encoding, faster than an explicit level 1
+            params = [] if self.png_compression in (None, 1) else [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+            if not cv2.imwrite(tmp_path, handle.array, params):
+                raise OSError(f"Cannot write image {key}.")
+            os.replace(tmp_path, key)
+            handle.stat = _file_stat(key)
+        finally:
+            with self._lock:
+                if self._pending.get(key) is not None and self._handles.get(key) is handle:
+                    del self._pending[key]
+                    self._evict()
+
+
+image_store = ImageStore()
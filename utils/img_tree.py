@@ -1,4 +1,5 @@
 import os
+import json
 from pathlib import Path
 from typing import Optional
 
@@ -16,17 +17,21 @@ class ImgNode:
         - subtask (Subtask)
         - tool (Tool)
     - name (str)
+    - parent (ImgNode | None)
     - children_dict (dict[Subtask, list[ImgNode]])
     """
 
-    def __init__(self, img_dir: Path, is_root: bool = False):
+    def __init__(self, img_dir: Path, is_root: bool = False, img_path: Optional[Path] = None):
         self.img_dir = img_dir
 
-        try:
-            img_name: str = next(img_dir.glob('*.png')).name
-            self.img_path: Path = img_dir / img_name
-        except:
-            self.img_path = None
+        if img_path is not None:
+            self.img_path: Optional[Path] = img_path
+        else:
+            try:
+                img_name: str = next(img_dir.glob('*.png')).name
+                self.img_path = img_dir / img_name
+            except:
+                self.img_path = None
 
         self.is_root: bool = is_root
         if not is_root:
@@ -40,16 +45,17 @@ class ImgNode:
 
         self.name = "input" if is_root else self.tool
 
-        children: list[ImgNode] = [
-            ImgNode(child_dir)
-            for child_dir in sorted_glob(img_dir.parent, '*/*/0-img')
-        ]
-        # group by subtask
+        self.parent: Optional[ImgNode] = None
+        # grouped by subtask, ordered by path as on disk
         self.children_dict: dict[Subtask, list[ImgNode]] = {}
-        for child in children:
-            if child.subtask not in self.children_dict:
-                self.children_dict[child.subtask] = []
-            self.children_dict[child.subtask].append(child)
+
+    def add_child(self, child: "ImgNode") -> None:
+        child.parent = self
+        children = self.children_dict.setdefault(child.subtask, [])
+        children.append(child)
+        children.sort(key=lambda node: node.img_dir)
+        self.children_dict = dict(sorted(
+            self.children_dict.items(), key=lambda item: item[1][0].img_dir))
 
 
 class ImgTree:
@@ -59,6 +65,7 @@ class ImgTree:
     node_dict (dict[Path, ImgNode])
     html_dir (Path)
     html_page (str)
+    journal_path (Path | None)
 
     Structure of the directory is like:
     ```
@@ -85,37 +92,116 @@ class ImgTree:
             └── 0-img
                 └── output.png
     ```
+
+    With `scan=True` the tree is read from the directory once. With `scan=False` only the root is read, and nodes are added with `add` as the images are produced, which also appends them to the journal at `journal_path` if given (see `from_journal`).
+
+    A node whose image was deleted to save disk space (see `prune`) keeps its place in the tree, shown by its thumbnail if any.
     """
 
-    def __init__(self, tree_dir: Path, html_dir: Optional[Path] = None):
+    def __init__(self, tree_dir: Path, html_dir: Optional[Path] = None,
+                 scan: bool = True, journal_path: Optional[Path] = None):
         self.tree_dir: Path = tree_dir
         self.root: ImgNode = ImgNode(
             self.tree_dir / '0-img', is_root=True)
 
         self.node_dict: dict[Path, ImgNode] = {self.root.img_dir: self.root}
-        self.node_dict.update({
-            img_dir: ImgNode(img_dir)
-            for img_dir in sorted_rglob(self.tree_dir, '0-img')
-            if img_dir != self.root.img_dir
-        })
-
-        self.n_nodes = len(self.node_dict)
-        self.n_leaves = 0
-        for node in self.node_dict.values():
-            if not node.children_dict:
-                self.n_leaves += 1
+        if scan:
+            nodes = [
+                ImgNode(img_dir)
+                for img_dir in sorted_rglob(self.tree_dir, '0-img')
+                if img_dir != self.root.img_dir
+            ]
+            self.node_dict.update({node.img_dir: node for node in nodes})
+            for node in nodes:
+                parent = self.node_dict.get(node.parent_img_dir)
+                if parent is not None:
+                    parent.add_child(node)
 
         if html_dir is None:
             html_dir = tree_dir.parent
         self.html_dir = html_dir  # to enable using relative path in html
+        self.journal_path = journal_path
 
         self._set_html_templates()
 
+    @classmethod
+    def from_journal(cls, tree_dir: Path, journal_path: Path,
+                     html_dir: Optional[Path] = None) -> "ImgTree":
+        """Rebuilds the tree from the journal written by `add`, without walking the directory."""
+        tree = cls(tree_dir, html_dir=html_dir, scan=False)
+        with open(journal_path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if "pruned_to" in entry:
+                    thumbnail_path = entry["pruned_to"]
+                    tree.prune(tree_dir / entry["img_path"],
+                               None if thumbnail_path is None else tree_dir / thumbnail_path)
+                else:
+                    tree.add(tree_dir / entry["img_path"])
+        tree.journal_path = journal_path
+        return tree
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.node_dict)
+
+    @property
+    def n_leaves(self) -> int:
+        return sum(1 for node in self.node_dict.values() if not node.children_dict)
+
+    def add(self, img_path: Path) -> ImgNode:
+        """Adds the image at `img_path` (`.../{subtask_dir}/{tool_dir}/0-img/{name}`) as a child of the image of its parent directory."""
+        img_dir = img_path.parent
+        if img_dir in self.node_dict:
+            node = self.node_dict[img_dir]
+            node.img_path = img_path
+            return node
+
+        node = ImgNode(img_dir, img_path=img_path)
+        self.node_dict[node.parent_img_dir].add_child(node)
+        self.node_dict[img_dir] = node
+        if self.journal_path is not None:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps({
+                    "img_path": str(img_path.relative_to(self.tree_dir))
+                }) + '\n')
+        return node
+
+    def prune(self, img_path: Path, thumbnail_path: Optional[Path] = None) -> None:
+        """Records that the image at `img_path` was deleted, leaving `thumbnail_path` (in the same directory) if given."""
+        node = self.node_dict[img_path.parent]
+        node.img_path = thumbnail_path
+        if self.journal_path is not None:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps({
+                    "img_path": str(img_path.relative_to(self.tree_dir)),
+                    "pruned_to": None if thumbnail_path is None
+                    else str(thumbnail_path.relative_to(self.tree_dir)),
+                }) + '\n')
+
+    def parent_img_path(self, img_path: Path) -> Optional[Path]:
+        node = self.node_dict.get(img_path.parent)
+        if node is None or node.parent is None:
+            return None
+        return node.parent.img_path
+
     def get_execution_path(self, img_path: Path
                            ) -> list[tuple[Subtask, ToolName]]:
         """Returns the execution path of the restored image, which is a list of tuples (subtask, tool)."""
         execution_path: list[tuple[Subtask, ToolName]] = []
 
+        node = self.node_dict.get(img_path.parent)
+        if node is not None:
+            while not node.is_root:
+                execution_path.append((node.subtask, node.tool))
+                if node.parent is None:
+                    break
+                node = node.parent
+            return execution_path[::-1]
+
+        # not indexed, walk the directory
         def get_stem(name: str):
             return name[name.find('-')+1:]
         cur_img_path = img_path
@@ -140,7 +226,8 @@ class ImgTree:
     def _get_img_html(self, node: ImgNode):
         img_html = self._img_html_template.format(
             name=node.name,
-            img_path=os.path.relpath(node.img_path, self.html_dir),
+            img=self._pruned_img_html if node.img_path is None else
+            f"<img src='{os.path.relpath(node.img_path, self.html_dir)}'/>",
             subtasks="\n".join(
                 self._get_subtask_html(subtask, children)
                 for subtask, children in node.children_dict.items()
@@ -182,10 +269,11 @@ class ImgTree:
         self._img_html_template = (
             """<details open>"""
             """  <summary>{name}</summary>"""
-            """  <img src='{img_path}'/>"""
+            """  {img}"""
             """  {subtasks}"""
             """</details>"""
         )
+        self._pruned_img_html = "<p><i>(image not kept)</i></p>"
         self._subtask_html_template = (
             """<details open>"""
             """  <summary>{subtask}</summary>"""
@@ -0,0 +1,159 @@
+"""Process-wide registry of pyiqa metrics, so that perception, reflection, face scoring and evaluation share one instance of each metric instead of creating their own, sometimes per image.
+
+A metric is created on first use, by name and `pyiqa.create_metric` options, and kept for the process. With a GPU memory budget, the least recently used metrics are moved to the CPU (or dropped, without offloading) to make room for the metric being used; a metric in use is never moved.
+```
+from utils.metric_registry import metric_registry
+
+with metric_registry.use("musiq") as musiq:
+    score = musiq(image_tensor).item()
+
+scores = metric_registry.score(image_tensors, ["musiq", "niqe"])  # {"musiq": [...], "niqe": [...]}
+```
+"""
+
+import gc
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import torch
+import pyiqa
+
+
+# version of pyiqa, part of the params of stored scores (see `score_store`)
+PYIQA_VERSION = getattr(pyiqa, "__version__", "unknown")
+
+@dataclass
+class _Entry:
+    metric: torch.nn.Module
+    n_bytes: int
+    on_device: bool = True
+    n_users: int = 0
+
+
+def _module_bytes(module: torch.nn.Module) -> int:
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+
+def _metric_key(name: str, options: dict) -> tuple:
+    return (name, tuple(sorted((k, repr(v)) for k, v in options.items())))
+
+
+class MetricRegistry:
+    """
+    Args:
+        device (str | None, optional): Device of the metrics in use. Defaults to None, i.e. "cuda" if available, otherwise "cpu".
+        max_gpu_mb (int | None, optional): Memory budget of the metrics on the GPU. Defaults to None, i.e. no limit.
+        offload_to_cpu (bool, optional): Whether metrics evicted from the GPU are kept on the CPU rather than dropped. Defaults to True.
+    """
+
+    def __init__(self, device: Optional[str] = None, max_gpu_mb: Optional[int] = None, offload_to_cpu: bool = True):
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self._lock = threading.Lock()
+        self._entries: dict[tuple, _Entry] = {}  # least recently used first
+        self.configure(max_gpu_mb, offload_to_cpu)
+
+    def configure(self, max_gpu_mb: Optional[int] = None, offload_to_cpu: bool = True) -> None:
+        """Sets the GPU memory budget and the eviction mode, evicting metrics beyond the budget."""
+        with self._lock:
+            self.max_gpu_bytes = None if max_gpu_mb is None else max_gpu_mb * 1024 ** 2
+            self.offload_to_cpu = offload_to_cpu
+            self._evict(0)
+
+    def get(self, name: str, **options) -> torch.nn.Module:
+        """The metric `name` created with `options`, on the device. It may be moved by later calls once the budget is exceeded, use `use` to keep it in place."""
+        with self.use(name, **options) as metric:
+            return metric
+
+    @contextmanager
+    def use(self, name: str, **options) -> Iterator[torch.nn.Module]:
+        """Context of the metric `name` created with `options`, kept on the device until the context exits."""
+        key = _metric_key(name, options)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                metric = pyiqa.create_metric(name, device=self.device, **options)
+                entry = _Entry(metric, _module_bytes(metric))
+                self._evict(entry.n_bytes)
+            elif not entry.on_device:
+                self._evict(entry.n_bytes)
+                self._move(entry.metric, self.device)
+                entry.on_device = True
+            self._entries[key] = entry
+            entry.n_users += 1
+        try:
+            yield entry.metric
+        finally:
+            with self._lock:
+                entry.n_users -= 1
+                self._evict(0)
+
+    def score(
+        self,
+        images: list[torch.Tensor],
+        metrics: list[str],
+        ref_images: Optional[list[torch.Tensor]] = None,
+        batch_size: int = 8,
+    ) -> dict[str, list[float]]:
+        """Scores of each image (1 x 3 x H x W tensors in [0, 1]) by each metric, in order. Images of the same size are scored in batches of `batch_size`, against `ref_images` for full-reference metrics."""
+        groups: dict[tuple[int, ...], list[int]] = {}
+        for idx, image in enumerate(images):
+            groups.setdefault(tuple(image.shape), []).append(idx)
+
+        scores: dict[str, list[float]] = {}
+        for name in metrics:
+            scores[name] = [0.] * len(images)
+            with self.use(name) as metric:
+                for indices in groups.values():
+                    for i in range(0, len(indices), max(1, batch_size)):
+                        batch_indices = indices[i:i + batch_size]
+                        batch = torch.cat([images[idx] for idx in batch_indices]).to(self.device)
+                        if ref_images is None:
+                            batch_scores = metric(batch)
+                        else:
+                            ref_batch = torch.cat([ref_images[idx] for idx in batch_indices]).to(self.device)
+                            batch_scores = metric(batch, ref_batch)
+                        for idx, score in zip(batch_indices, batch_scores.flatten().tolist()):
+                            scores[name][idx] = score
+                        del batch
+        return scores
+
+    def release(self, *names: str) -> None:
+        """Drops the metrics of `names` (all metrics if none) that are not in use."""
+        with self._lock:
+            for key in list(self._entries):
+                if (not names or key[0] in names) and self._entries[key].n_users == 0:
+                    del self._entries[key]
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def _move(self, metric: torch.nn.Module, device: str) -> None:
+        metric.to(device)
+        # some pyiqa versions move their inputs to the device they were created on
+        if hasattr(metric, "device"):
+            metric.device = torch.device(device)
+
+    def _evict(self, n_new_bytes: int) -> None:
+        """Evicts the least recently used metrics not in use until `n_new_bytes` more bytes fit in the budget."""
+        if self.max_gpu_bytes is None or self.device == "cpu":
+            return
+        n_bytes = sum(entry.n_bytes for entry in self._entries.values() if entry.on_device)
+        evicted = False
+        for key, entry in list(self._entries.items()):
+            if n_bytes + n_new_bytes <= self.max_gpu_bytes:
+                break
+            if not entry.on_device or entry.n_users > 0:
+                continue
+            if self.offload_to_cpu:
+                self._move(entry.metric, "cpu")
+                entry.on_device = False
+            else:
+                del self._entries[key]
+            n_bytes -= entry.n_bytes
+            evicted = True
+        if evicted:
+            torch.cuda.empty_cache()
+
+
+metric_registry = MetricRegistry()
@@ -0,0 +1,126 @@
+import gc
+import hashlib
+import threading
+from pathlib import Path
+from typing import Optional
+
+import torch
+from PIL import Image
+
+from .score_store import score_store
+from .image_handle import image_store
+from .metric_registry import metric_registry
+from .expert_IQA_eval import (
+    TARGET_METRICS,
+    TARGET_SCORE_PARAMS,
+    target_metric_tensor,
+    weighted_target_metric_score,
+)
+
+
+class ReflectionScorer:
+    """Scores the candidates of a subtask for reflection (`hpsv2` or `hpsv2+metric`), keeping HPSv2 loaded between calls. The target pyiqa metrics are those of `metric_registry`, shared with the other scorers.
+
+    Scores are read through `score_store`, only candidates missing from it are scored. Each candidate is decoded once, through `image_store`, and shared by HPSv2 and the metrics. Calls from several threads are serialized. HPSv2 inputs are always the same size and run in batches of `batch_size`; the metrics run in batches of same-size candidates. The scores equal those of `hpsv2.score` and `compute_iqa_metric_score` per candidate.
+
+    Args:
+        with_metrics (bool, optional): Whether to compute the metric score besides HPSv2. Defaults to True.
+        hps_version (str, optional): Version of HPSv2 checkpoint. Defaults to "v2.1".
+        batch_size (int, optional): Maximum number of candidates per forward pass. Defaults to 8.
+        device (str | None, optional): Defaults to "cuda" if available, otherwise "cpu".
+    """
+
+    def __init__(
+        self,
+        with_metrics: bool = True,
+        hps_version: str = "v2.1",
+        batch_size: int = 8,
+        device: Optional[str] = None,
+    ):
+        self.with_metrics = with_metrics
+        self.hps_version = hps_version
+        self.batch_size = max(1, batch_size)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self._hps_model = None
+        self._hps_preprocess = None
+        self._hps_tokenizer = None
+        self._lock = threading.Lock()
+
+    def score(self, candidates: list[Path], prompt: str) -> tuple[list[float], Optional[list[float]]]:
+        """Returns HPSv2 scores and metric scores (None if `with_metrics` is False) of `candidates` in order."""
+        with self._lock:
+            hps_scores = score_store.scores(
+                candidates,
+                f"hpsv2-{self.hps_version}",
+                lambda paths: self._hps_scores([image_store.open(p).pil() for p in paths], prompt),
+                {"prompt": hashlib.sha256(prompt.encode()).hexdigest()},
+            )
+            metric_scores = self._metric_scores(candidates) if self.with_metrics else None
+        return hps_scores, metric_scores
+
+    def metric_scores(self, candidates: list[Path]) -> list[float]:
+        """Metric scores of `candidates` in order, whether `with_metrics` or not."""
+        with self._lock:
+            return self._metric_scores(candidates)
+
+    def release(self) -> None:
+        """Unloads all models."""
+        with self._lock:
+            self._hps_model = self._hps_preprocess = self._hps_tokenizer = None
+        metric_registry.release(*TARGET_METRICS.values())
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def _load_hps(self) -> None:
+        import huggingface_hub
+        from hpsv2 import img_score
+        from hpsv2.src.open_clip import get_tokenizer
+
+        # same model and checkpoint as `hpsv2.score`, which reloads the checkpoint on every call
+        img_score.initialize_model()
+        model = img_score.model_dict['model']
+        ckpt_path = huggingface_hub.hf_hub_download("xswu/HPSv2", img_score.hps_version_map[self.hps_version])
+        checkpoint = torch.load(ckpt_path, map_location=self.device)
+        model.load_state_dict(checkpoint['state_dict'])
+        del checkpoint
+        self._hps_model = model.to(self.device).eval()
+        self._hps_preprocess = img_score.model_dict['preprocess_val']
+        self._hps_tokenizer = get_tokenizer('ViT-H-14')
+
+    def _hps_scores(self, images: list[Image.Image], prompt: str) -> list[float]:
+        if self._hps_model is None:
+            self._load_hps()
+        scores = []
+        with torch.no_grad():
+            text = self._hps_tokenizer([prompt]).to(device=self.device, non_blocking=True)
+            for i in range(0, len(images), self.batch_size):
+                batch = torch.stack([self._hps_preprocess(img) for img in images[i:i + self.batch_size]])
+                batch = batch.to(device=self.device, non_blocking=True)
+                with torch.cuda.amp.autocast():
+                    outputs = self._hps_model(batch, text)
+                    logits_per_image = outputs["image_features"] @ outputs["text_features"].T
+                scores += [float(s) for s in logits_per_image[:, 0].cpu().numpy()]
+        return scores
+
+    def _metric_scores(self, candidates: list[Path]) -> list[float]:
+        tensors: dict[str, torch.Tensor] = {}
+
+        def compute(metric_key: str, paths: list[Path]) -> list[float]:
+            for path in paths:
+                if str(path) not in tensors:
+                    tensors[str(path)] = target_metric_tensor(path, device="cpu")
+            batch = [tensors[str(path)] for path in paths]
+            return metric_registry.score(batch, [metric_key], batch_size=self.batch_size)[metric_key]
+
+        scores = {
+            metric_key: score_store.scores(
+                candidates, metric_key, lambda paths, metric_key=metric_key: compute(metric_key, paths), TARGET_SCORE_PARAMS
+            )
+            for metric_key in TARGET_METRICS.values()
+        }
+        return [
+            weighted_target_metric_score({
+                metric_name: round(scores[metric_key][idx], 4) for metric_name, metric_key in TARGET_METRICS.items()
+            })
+            for idx in range(len(candidates))
+        ]
@@ -0,0 +1,257 @@
+"""Persistent store of image scores keyed by (content hash of the image, metric, metric params), so that an image is scored once by each metric across perception, reflection, rollback and the offline evaluation, and across runs.
+
+The store is a local SQLite database in WAL mode, shared by the processes of a node. Scoring paths read through `score_store`, which does nothing until configured (see `ImagentSession`):
+```
+from utils.score_store import score_store
+
+score_store.configure("memory/scores.sqlite")
+scores = score_store.scores(paths, "musiq", compute=lambda missing: [...], params={"resize": "target"})
+```
+Stores of several nodes are exported and merged with the CLI:
+```
+python -m utils.score_store stats memory/scores.sqlite
+python -m utils.score_store export memory/scores.sqlite node1.sqlite [--metric musiq ...]
+python -m utils.score_store export memory/scores.sqlite node1.jsonl
+python -m utils.score_store merge memory/scores.sqlite node1.sqlite node2.jsonl
+```
+"""
+
+import json
+import math
+import time
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from .file_hash import content_hash
+from .image_handle import image_store
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    digest TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    params TEXT NOT NULL,
+    value REAL NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (digest, metric, params)
+) WITHOUT ROWID
+"""
+# max number of host parameters of a query in old SQLite versions
+_MAX_QUERY_PARAMS = 900
+
+
+def _params_key(params: Optional[dict]) -> str:
+    return json.dumps(params or {}, sort_keys=True, separators=(",", ":"))
+
+
+def _connect(path: Path, timeout_s: float) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path), timeout=timeout_s, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(_SCHEMA)
+    return conn
+
+
+class ScoreStore:
+    """
+    Args:
+        path (Path | None, optional): SQLite file of the store, created if missing. Defaults to None, i.e. disabled: lookups miss and nothing is stored.
+        timeout_s (float, optional): How long a process waits for the write lock held by another one. Defaults to 60.
+    """
+
+    def __init__(self, path: Optional[Path] = None, timeout_s: float = 60.):
+        self.timeout_s = timeout_s
+        self._local = threading.local()
+        self.configure(path)
+
+    def configure(self, path: Optional[Path] = None) -> None:
+        """Sets the SQLite file of the store, None disables it."""
+        self.path = None if path is None else Path(path).expanduser().resolve()
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def digest(self, path: Path | str) -> str:
+        """Content hash of the image at `path`, once its pending PNG is written (see `image_store.flush`)."""
+        image_store.flush(path)
+        return content_hash(Path(path))
+
+    def get(self, path: Path | str, metric: str, params: Optional[dict] = None) -> Optional[float]:
+        return self.lookup([path], metric, params)[0]
+
+    def put(self, path: Path | str, metric: str, value: float, params: Optional[dict] = None) -> None:
+        self.put_many([path], metric, [value], params)
+
+    def lookup(self, paths: list[Path | str], metric: str, params: Optional[dict] = None) -> list[Optional[float]]:
+        """Stored scores of the images at `paths` by `metric` with `params`, None for those not stored."""
+        if not self.enabled:
+            return [None] * len(paths)
+        digests = [self.digest(path) for path in paths]
+        found = {}
+        unique_digests = list(dict.fromkeys(digests))
+        for i in range(0, len(unique_digests), _MAX_QUERY_PARAMS):
+            chunk = unique_digests[i:i + _MAX_QUERY_PARAMS]
+            found.update(self._conn().execute(
+                f"SELECT digest, value FROM scores WHERE metric = ? AND params = ? AND digest IN ({','.join('?' * len(chunk))})",
+                [metric, _params_key(params), *chunk],
+            ).fetchall())
+        return [found.get(digest) for digest in digests]
+
+    def put_many(self, paths: list[Path | str], metric: str, values: list[float], params: Optional[dict] = None) -> None:
+        """Stores the scores `values` of the images at `paths` by `metric` with `params`, replacing stored ones. Missing (None) and non-finite scores are not stored."""
+        if not self.enabled:
+            return
+        now = time.time()
+        params_key = _params_key(params)
+        rows = [
+            (self.digest(path), metric, params_key, float(value), now)
+            for path, value in zip(paths, values) if value is not None and math.isfinite(value)
+        ]
+        self._write("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", rows)
+
+    def scores(
+        self,
+        paths: list[Path | str],
+        metric: str,
+        compute: Callable[[list[Path | str]], list[float]],
+        params: Optional[dict] = None,
+    ) -> list[float]:
+        """Scores of the images at `paths` by `metric` with `params`: the stored ones, and those of `compute(paths not stored)`, which are stored."""
+        values = self.lookup(paths, metric, params)
+        missing = [idx for idx, value in enumerate(values) if value is None]
+        if missing:
+            computed = compute([paths[idx] for idx in missing])
+            self.put_many([paths[idx] for idx in missing], metric, computed, params)
+            for idx, value in zip(missing, computed):
+                values[idx] = value
+        return values
+
+    def score(self, path: Path | str, metric: str, compute: Callable[[], float], params: Optional[dict] = None) -> float:
+        """Score of the image at `path` by `metric` with `params`: the stored one, or that of `compute()`, which is stored."""
+        return self.scores([path], metric, lambda _: [compute()], params)[0]
+
+    def stats(self) -> list[tuple[str, str, int]]:
+        """(metric, params, number of scores) of the stored scores."""
+        return self._conn().execute(
+            "SELECT metric, params, COUNT(*) FROM scores GROUP BY metric, params ORDER BY metric, params"
+        ).fetchall()
+
+    def export(self, dst: Path, metrics: Optional[Iterable[str]] = None) -> int:
+        """Copies the scores of `metrics` (all if None) to `dst`, a SQLite store or a `.jsonl` file, and returns their number. Scores already in a `dst` store are replaced."""
+        dst = Path(dst)
+        metrics = list(metrics or [])
+        where = f"WHERE metric IN ({','.join('?' * len(metrics))})" if metrics else ""
+        if dst.suffix == ".jsonl":
+            rows = self._conn().execute(f"SELECT digest, metric, params, value, created FROM scores {where}", metrics)
+            n_rows = 0
+            with open(dst, "w") as f:
+                for digest, metric, params, value, created in rows:
+                    f.write(json.dumps({
+                        "digest": digest, "metric": metric, "params": json.loads(params), "value": value, "created": created,
+                    }) + "\n")
+                    n_rows += 1
+            return n_rows
+        _connect(dst, self.timeout_s).close()
+        conn = self._conn()
+        conn.execute("ATTACH DATABASE ? AS dst", [str(dst)])
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            n_rows = conn.execute(f"INSERT OR REPLACE INTO dst.scores SELECT * FROM main.scores {where}", metrics).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.execute("DETACH DATABASE dst")
+        return n_rows
+
+    def merge(self, src: Path) -> int:
+        """Adds the scores of `src`, a SQLite store or a `.jsonl` file written by `export`, and returns the number of new scores. Scores already in the store are kept, scores being deterministic."""
+        src = Path(src)
+        if src.suffix == ".jsonl":
+            rows = []
+            with open(src, "r") as f:
+                for line in f:
+                    row = json.loads(line)
+                    rows.append((row["digest"], row["metric"], _params_key(row["params"]), row["value"], row["created"]))
+            return self._write("INSERT OR IGNORE INTO scores VALUES (?, ?, ?, ?, ?)", rows)
+        conn = self._conn()
+        conn.execute("ATTACH DATABASE ? AS src", [str(src)])
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            n_rows = conn.execute("INSERT OR IGNORE INTO main.scores SELECT * FROM src.scores").rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.execute("DETACH DATABASE src")
+        return n_rows
+
+    def _write(self, sql: str, rows: list[tuple]) -> int:
+        conn = self._conn()
+        # take the write lock up front, readers of other processes are not blocked in WAL mode
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            n_rows = conn.executemany(sql, rows).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return n_rows
+
+    def _conn(self) -> sqlite3.Connection:
+        """Connection of the current thread to the store, SQLite connections being bound to their thread."""
+        if self.path is None:
+            raise RuntimeError("The score store is not configured.")
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.path != self.path:
+            if conn is not None:
+                conn.close()
+            conn = self._local.conn = _connect(self.path, self.timeout_s)
+            self._local.path = self.path
+        return conn
+
+
+score_store = ScoreStore()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect, export and merge score stores.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stats_parser = subparsers.add_parser("stats", help="Number of scores per metric and params.")
+    stats_parser.add_argument("store", type=Path, help="SQLite file of the store.")
+
+    export_parser = subparsers.add_parser("export", help="Copy the scores of a store to another store or a .jsonl file.")
+    export_parser.add_argument("store", type=Path, help="SQLite file of the store.")
+    export_parser.add_argument("dst", type=Path, help="SQLite file, or .jsonl file, to export to.")
+    export_parser.add_argument("--metric", nargs="+", default=None, help="Metrics to export. Defaults to all.")
+
+    merge_parser = subparsers.add_parser("merge", help="Add the scores of other stores or .jsonl files to a store.")
+    merge_parser.add_argument("store", type=Path, help="SQLite file of the store, created if missing.")
+    merge_parser.add_argument("src", type=Path, nargs="+", help="SQLite or .jsonl files to merge.")
+
+    args = parser.parse_args()
+    if args.command != "merge" and not args.store.exists():
+        parser.error(f"{args.store} does not exist.")
+    store = ScoreStore(args.store)
+    if args.command == "stats":
+        for metric, params, n_scores in store.stats():
+            print(f"{metric}\t{params}\t{n_scores}")
+    elif args.command == "export":
+        print(f"Exported {store.export(args.dst, args.metric)} scores to {args.dst}.")
+    else:
+        for src in args.src:
+            print(f"Merged {store.merge(src)} new scores from {src}.")
+
+
+if __name__ == "__main__":
+    main()
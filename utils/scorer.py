@@ -2,7 +2,6 @@ import os
 import cv2
 import math
 import torch
-import pyiqa
 import numpy as np
 
 from pathlib import Path
@@ -14,7 +13,10 @@ from basicsr.utils.matlab_functions import imresize
 
 from .config import Config
 from .resnet import resnet_face18
+from .score_store import score_store
+from .metric_registry import metric_registry, PYIQA_VERSION
 from pyiqa.models.inference_model import InferenceModel
+from executor.tool_utils.checkpoint_loading import load_checkpoint
 
 
 FR_METRIC_NAME_LST = ["psnr", "ssim", "lpips"]
@@ -26,38 +28,48 @@ class Scorer:
     """Computes image quality scores using full-reference and no-reference metrics."""
 
     def __init__(self):
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.fr_metric_name_lst = FR_METRIC_NAME_LST
         self.nr_metric_name_lst = NR_METRIC_NAME_LST
         self.metric_name_lst = self.fr_metric_name_lst + self.nr_metric_name_lst
 
-        self.fr_metrics = [pyiqa.create_metric(name, device=device) for name in self.fr_metric_name_lst]
-        self.nr_metrics = [pyiqa.create_metric(name, device=device) for name in self.nr_metric_name_lst]
-        self.metrics = self.fr_metrics + self.nr_metrics
-
-        self.lower_better_dict = {metric.metric_name: metric.lower_better for metric in self.metrics}
+        # metrics are those of `metric_registry`, shared with the other scorers
+        self.lower_better_dict = {name: metric_registry.get(name).lower_better for name in self.metric_name_lst}
 
     def __call__(self, img_path: Path, ref_img_path: Optional[Path] = None) -> list[tuple[str, bool, float]]:
-        img = self._get_img_tensor(img_path)
-
+        """Scores of `img_path` by each metric, read through `score_store`. With a reference image, all scores are keyed by it, `img_path` being upscaled to its size."""
+        params = {"pyiqa": PYIQA_VERSION}
         if ref_img_path:
-            ref_img = self._get_img_tensor(ref_img_path)
-
-            if img.shape != ref_img.shape:
-                if img.shape[2] * 4 == ref_img.shape[2] and img.shape[3] * 4 == ref_img.shape[3]:
-                    img = imresize(img[0], scale=4).unsqueeze(0).clamp(0, 1)
-                else:
-                    raise ValueError("Image shapes do not match.")
-
-            metric_lst = self.metrics
+            metric_name_lst = self.metric_name_lst
+            if score_store.enabled:
+                params["ref"] = score_store.digest(ref_img_path)
         else:
-            ref_img = None
-            metric_lst = self.nr_metrics
-
-        return [
-            (metric.metric_name, metric.lower_better, self._get_score(metric, img, ref_img))
-            for metric in metric_lst
-        ]
+            metric_name_lst = self.nr_metric_name_lst
+
+        tensors = {}
+
+        def get_tensors() -> tuple[torch.Tensor, Optional[torch.Tensor]]:
+            if not tensors:
+                img = self._get_img_tensor(img_path)
+                ref_img = None
+                if ref_img_path:
+                    ref_img = self._get_img_tensor(ref_img_path)
+                    if img.shape != ref_img.shape:
+                        if img.shape[2] * 4 == ref_img.shape[2] and img.shape[3] * 4 == ref_img.shape[3]:
+                            img = imresize(img[0], scale=4).unsqueeze(0).clamp(0, 1)
+                        else:
+                            raise ValueError("Image shapes do not match.")
+                tensors["img"], tensors["ref_img"] = img, ref_img
+            return tensors["img"], tensors["ref_img"]
+
+        def compute(name: str) -> float:
+            with metric_registry.use(name) as metric:
+                return float(self._get_score(metric, *get_tensors()))
+
+        results = []
+        for name in metric_name_lst:
+            score = score_store.score(img_path, name, lambda name=name: compute(name), params)
+            results.append((name, self.lower_better_dict[name], score))
+        return results
 
     def _get_img_tensor(self, img_path: Path) -> torch.Tensor:
         img = cv2.imread(str(img_path))
@@ -115,7 +127,7 @@ def calculate_cos_dist(restored_path, gt_path, model_path="../pretrained_ckpts/F
     opt = Config()
     model = resnet_face18(opt.use_se)
     model = DataParallel(model)
-    model.load_state_dict(torch.load(model_path))
+    model.load_state_dict(load_checkpoint(model_path))
     model.to(torch.device("cuda")).eval()
 
     img1 = load_image(gt_path)
@@ -136,11 +148,14 @@ def img2tensorniqe(img, bgr2rgb=True, float32=True):
 
 def calculate_niqe(restored_path):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    iqa_niqe = pyiqa.create_metric("niqe").to(device)
 
-    img = cv2.imread(restored_path)
-    img_tensor = img2tensorniqe(img, bgr2rgb=True, float32=True).unsqueeze(0).to(device)
-    niqe = iqa_niqe(img_tensor).item()
+    def compute() -> float:
+        img = cv2.imread(restored_path)
+        img_tensor = img2tensorniqe(img, bgr2rgb=True, float32=True).unsqueeze(0).to(device)
+        with metric_registry.use("niqe") as iqa_niqe:
+            return iqa_niqe(img_tensor).item()
+
+    niqe = score_store.score(restored_path, "niqe", compute, {"pyiqa": PYIQA_VERSION})
     print(f"{restored_path} - NIQE: {niqe:.4f}")
     return niqe
 